@@ -0,0 +1,89 @@
+"""
+Compares tag queries answered with SQL to the same queries answered with
+the bitmap index of the ``TAG_BITMAP_INDEX`` setting.
+
+Run it from the root of the distribution::
+
+    python benchmarks/bitmap_index.py [items]
+
+It creates ``items`` tagged items (1000000 by default) for a tenth as many
+objects, spread over 1000 tags of which a few are used much more often than
+the others.
+"""
+import random
+import sys
+import time
+
+from common import bench, setup
+
+def create_items(count):
+    from django.contrib.contenttypes.models import ContentType
+    from django.db import connection, transaction
+    from tagging.models import Tag
+    from tagging.tests.models import Perch
+
+    random.seed(1)
+    object_count = max(count // 10, 1)
+    content_type = ContentType.objects.get_for_model(Perch)
+    cursor = connection.cursor()
+    cursor.executemany('INSERT INTO tagging_tag (name) VALUES (%s)',
+                       [('t%d' % i,) for i in range(1000)])
+    cursor.executemany(
+        'INSERT INTO tests_perch (id, size, smelly) VALUES (%s, 1, 1)',
+        [(i,) for i in xrange(1, object_count + 1)])
+    tag_ids = list(Tag.objects.order_by('pk').values_list('pk', flat=True))
+    rows = set()
+    while len(rows) < count:
+        tag_id = tag_ids[int(len(tag_ids) * random.random() ** 3)]
+        rows.add((tag_id, content_type.pk, random.randint(1, object_count)))
+    cursor.executemany('INSERT INTO tagging_taggeditem '
+                       '(tag_id, content_type_id, object_id) '
+                       'VALUES (%s, %s, %s)', list(rows))
+    transaction.commit_unless_managed()
+    return object_count, content_type
+
+def main():
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    else:
+        count = 1000000
+    setup()
+    from tagging import settings
+    from tagging.bitmap import bitmap_index
+    from tagging.models import TaggedItem
+    from tagging.tests.models import Perch
+
+    object_count, content_type = create_items(count)
+    queries = (
+        ('intersection t0 t1 (count)', lambda:
+            TaggedItem.objects.get_intersection_by_model(Perch, 't0 t1').count()),
+        ('intersection t1 t5 t9 (count)', lambda:
+            TaggedItem.objects.get_intersection_by_model(Perch, 't1 t5 t9').count()),
+        ('intersection t20 t30 (rows)', lambda:
+            len(TaggedItem.objects.get_intersection_by_model(Perch, 't20 t30'))),
+        ('union t0 t1 (count)', lambda:
+            TaggedItem.objects.get_union_by_model(Perch, 't0 t1').count()),
+        ('get_by_model t3 t50 (rows)', lambda:
+            len(TaggedItem.objects.get_by_model(Perch, 't3 t50'))),
+    )
+    print '%d tagged items of %d objects' % (count, object_count)
+    print '-- SQL'
+    for label, function in queries:
+        bench(label, function)
+    bench('t0 without t1 (count)', lambda:
+        TaggedItem.objects.get_by_model(Perch, 't0').exclude(
+            pk__in=TaggedItem.objects.filter(
+                content_type=content_type, tag__name='t1',
+            ).values('object_id')).count())
+
+    settings.TAG_BITMAP_INDEX = True
+    start = time.time()
+    bitmap_index.load(content_type.pk)
+    print '-- bitmap index (loaded in %.1f s)' % (time.time() - start)
+    for label, function in queries:
+        bench(label, function)
+    bench('t0 without t1 (count)', lambda:
+        len(bitmap_index.query(Perch, with_all='t0', without='t1')))
+
+if __name__ == '__main__':
+    main()
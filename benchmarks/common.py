@@ -0,0 +1,29 @@
+"""
+Helpers shared by the benchmarks.
+"""
+import os
+import sys
+import time
+
+def setup():
+    """
+    Makes the distribution importable, selects the benchmark settings unless
+    ``DJANGO_SETTINGS_MODULE`` is set and creates the tables.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if root not in sys.path:
+        sys.path.insert(0, root)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    from django.core import management
+    management.call_command('syncdb', verbosity=0, interactive=False)
+
+def bench(label, function, repeat=5):
+    """
+    Calls ``function`` ``repeat`` times and prints the average time of a
+    call with its last result.
+    """
+    start = time.time()
+    for i in range(repeat):
+        result = function()
+    elapsed = (time.time() - start) / repeat
+    print '%-40s %9.1f ms  (%s)' % (label, elapsed * 1000, result)
@@ -0,0 +1,7 @@
+# Settings for the benchmarks: the test models in an in-memory SQLite
+# database, which is created by each benchmark.
+from tagging.tests.settings import *
+
+DATABASE_ENGINE = 'sqlite3'
+DATABASE_NAME = ':memory:'
+DATABASE_HOST = ''
@@ -0,0 +1,65 @@
+"""
+Compares tagging many objects by calling ``update_tags`` for each of them
+to tagging them with ``update_tags_many``.
+
+Run it from the root of the distribution::
+
+    python benchmarks/update_tags_many.py [objects] [tags] [vocabulary]
+
+Each way tags ``objects`` objects (2000 by default) with ``tags`` random
+tags each (10 by default), chosen from ``vocabulary`` existing tags (500 by
+default), and then tags them again with new random tags.
+"""
+import random
+import sys
+import time
+
+from common import setup
+
+def create_objects(count, vocabulary):
+    from django.db import connection, transaction
+    from tagging.tests.models import Perch
+
+    cursor = connection.cursor()
+    cursor.executemany('INSERT INTO tagging_tag (name) VALUES (%s)',
+                       [('t%d' % i,) for i in range(vocabulary)])
+    cursor.executemany(
+        'INSERT INTO tests_perch (id, size, smelly) VALUES (%s, 1, 1)',
+        [(i,) for i in xrange(1, 2 * count + 1)])
+    transaction.commit_unless_managed()
+    objects = list(Perch.objects.order_by('pk'))
+    return objects[:count], objects[count:]
+
+def random_tags(objects, tags, vocabulary):
+    return [(obj, ' '.join(['t%d' % i for i in
+                            random.sample(xrange(vocabulary), tags)]))
+            for obj in objects]
+
+def run(label, update, tag_input):
+    start = time.time()
+    update(tag_input)
+    elapsed = time.time() - start
+    print '%-40s %8.2f s  %8.0f objects/s' % (
+        label, elapsed, len(tag_input) / elapsed)
+
+def main():
+    args = [int(arg) for arg in sys.argv[1:4]]
+    count, tags, vocabulary = args + [2000, 10, 500][len(args):]
+    setup()
+    from tagging.models import Tag
+
+    def update_tags_loop(tag_input):
+        for obj, tag_names in tag_input:
+            Tag.objects.update_tags(obj, tag_names)
+
+    random.seed(1)
+    loop_objects, many_objects = create_objects(count, vocabulary)
+    print '%d objects, %d tags each out of %d' % (count, tags, vocabulary)
+    for label in ('tag', 'retag'):
+        run('update_tags loop (%s)' % label, update_tags_loop,
+            random_tags(loop_objects, tags, vocabulary))
+        run('update_tags_many (%s)' % label, Tag.objects.update_tags_many,
+            random_tags(many_objects, tags, vocabulary))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,471 @@
+"""
+An optional in-process index of the tagged objects of each tag, stored as
+compressed bitmaps.
+"""
+import time
+from array import array
+from bisect import bisect_left
+from itertools import islice
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+
+from tagging import settings
+
+# Object ids are split into chunks of 65536 ids by their high bits. Chunks
+# with fewer ids than this are stored as sorted arrays of their low 16 bits,
+# denser chunks as the bits of an integer.
+SPARSE_LIMIT = 4096
+
+# The largest number of object ids which is passed to the database in a
+# query. Larger results of the index are queried with SQL instead.
+BITMAP_MAX_IDS = 500
+
+# The set bits of each byte value.
+_BITS = [tuple([bit for bit in range(8) if byte >> bit & 1])
+         for byte in range(256)]
+
+# The number of set bits of each non-zero hexadecimal digit.
+_DIGIT_BITS = [('%x' % digit, len(_BITS[digit])) for digit in range(1, 16)]
+
+def _bit_count(dense):
+    digits = '%x' % dense
+    return sum([digits.count(digit) * bits for digit, bits in _DIGIT_BITS])
+
+def _to_dense(values):
+    bits = array('B', [0]) * 8192
+    for value in values:
+        bits[value >> 3] |= 1 << (value & 7)
+    bits.reverse()
+    return long(bits.tostring().encode('hex'), 16)
+
+def _to_bytes(dense):
+    """
+    Returns the bits of a dense chunk as a little-endian ``array`` of bytes.
+    """
+    digits = '%x' % dense
+    if len(digits) % 2:
+        digits = '0' + digits
+    bits = array('B', digits.decode('hex'))
+    bits.reverse()
+    return bits
+
+def _to_sparse(dense):
+    values = array('H')
+    for i, byte in enumerate(_to_bytes(dense)):
+        if byte:
+            base = i << 3
+            values.extend([base + bit for bit in _BITS[byte]])
+    return values
+
+def _as_dense(chunk):
+    if isinstance(chunk, array):
+        return _to_dense(chunk)
+    return chunk
+
+def _compress(dense):
+    count = _bit_count(dense)
+    if count == 0:
+        return None
+    elif count < SPARSE_LIMIT:
+        return _to_sparse(dense)
+    return dense
+
+def _count(chunk):
+    if isinstance(chunk, array):
+        return len(chunk)
+    return _bit_count(chunk)
+
+def _values(chunk):
+    if isinstance(chunk, array):
+        return chunk
+    return _to_sparse(chunk)
+
+def _filter(sparse, dense, keep):
+    """
+    Returns the values of a sparse chunk whose bit in a dense chunk is set
+    if ``keep`` is ``True``, or not set if it is ``False``.
+    """
+    bits = _to_bytes(dense)
+    size = len(bits)
+    return [value for value in sparse if keep == bool(
+        value >> 3 < size and bits[value >> 3] >> (value & 7) & 1)]
+
+def _and(a, b):
+    if isinstance(a, array):
+        if isinstance(b, array):
+            values = list(set(a).intersection(b))
+            values.sort()
+        else:
+            values = _filter(a, b, True)
+        return len(values) and array('H', values) or None
+    elif isinstance(b, array):
+        return _and(b, a)
+    return _compress(a & b)
+
+def _or(a, b):
+    if isinstance(a, array) and isinstance(b, array):
+        values = set(a)
+        values.update(b)
+        if len(values) < SPARSE_LIMIT:
+            values = list(values)
+            values.sort()
+            return array('H', values)
+        return _to_dense(values)
+    return _as_dense(a) | _as_dense(b)
+
+def _andnot(a, b):
+    if isinstance(a, array):
+        if isinstance(b, array):
+            excluded = set(b)
+            values = [value for value in a if value not in excluded]
+        else:
+            values = _filter(a, b, False)
+        return len(values) and array('H', values) or None
+    return _compress(a & ~_as_dense(b))
+
+class Bitmap(object):
+    """
+    A compressed set of non-negative integers, supporting the ``&``, ``|``
+    and ``-`` operators of sets. Iterating over a bitmap yields its integers
+    in ascending order.
+
+    Chunks are replaced rather than changed in place, so bitmaps created by
+    the operators may share chunks with their operands.
+    """
+    def __init__(self, values=()):
+        self._chunks = {}
+        values = list(values)
+        values.sort()
+        start = 0
+        while start < len(values):
+            high = values[start] >> 16
+            end = start
+            while end < len(values) and values[end] >> 16 == high:
+                end += 1
+            low = dict.fromkeys([value & 0xFFFF
+                                 for value in values[start:end]]).keys()
+            low.sort()
+            if len(low) < SPARSE_LIMIT:
+                self._chunks[high] = array('H', low)
+            else:
+                self._chunks[high] = _to_dense(low)
+            start = end
+
+    def _from_chunks(cls, chunks):
+        bitmap = cls()
+        bitmap._chunks = chunks
+        return bitmap
+    _from_chunks = classmethod(_from_chunks)
+
+    def add(self, value):
+        high, low = value >> 16, value & 0xFFFF
+        chunk = self._chunks.get(high)
+        if chunk is None:
+            self._chunks[high] = array('H', [low])
+        elif isinstance(chunk, array):
+            i = bisect_left(chunk, low)
+            if i == len(chunk) or chunk[i] != low:
+                chunk = chunk[:i] + array('H', [low]) + chunk[i:]
+                if len(chunk) >= SPARSE_LIMIT:
+                    chunk = _to_dense(chunk)
+                self._chunks[high] = chunk
+        else:
+            self._chunks[high] = chunk | (1 << low)
+
+    def discard(self, value):
+        high, low = value >> 16, value & 0xFFFF
+        chunk = self._chunks.get(high)
+        if chunk is None:
+            return
+        elif isinstance(chunk, array):
+            i = bisect_left(chunk, low)
+            if i == len(chunk) or chunk[i] != low:
+                return
+            chunk = chunk[:i] + chunk[i + 1:]
+            if not len(chunk):
+                chunk = None
+        else:
+            chunk = _compress(chunk & ~(1 << low))
+        if chunk is None:
+            del self._chunks[high]
+        else:
+            self._chunks[high] = chunk
+
+    def copy(self):
+        return Bitmap._from_chunks(self._chunks.copy())
+
+    def update(self, other):
+        """
+        Adds all integers of another bitmap.
+        """
+        for high, chunk in other._chunks.items():
+            if high in self._chunks:
+                self._chunks[high] = _or(self._chunks[high], chunk)
+            else:
+                self._chunks[high] = chunk
+
+    def ids(self, offset=0, limit=None):
+        """
+        Returns a list of the integers from position ``offset`` on, at most
+        ``limit`` of them.
+        """
+        stop = limit is not None and offset + limit or None
+        return list(islice(self, offset, stop))
+
+    def __contains__(self, value):
+        chunk = self._chunks.get(value >> 16)
+        if chunk is None:
+            return False
+        low = value & 0xFFFF
+        if isinstance(chunk, array):
+            i = bisect_left(chunk, low)
+            return i < len(chunk) and chunk[i] == low
+        return bool(chunk >> low & 1)
+
+    def __iter__(self):
+        highs = self._chunks.keys()
+        highs.sort()
+        for high in highs:
+            base = high << 16
+            for low in _values(self._chunks[high]):
+                yield base | low
+
+    def __len__(self):
+        return sum([_count(chunk) for chunk in self._chunks.values()])
+
+    def __nonzero__(self):
+        return bool(self._chunks)
+
+    def __and__(self, other):
+        chunks = {}
+        for high, chunk in self._chunks.items():
+            if high in other._chunks:
+                chunk = _and(chunk, other._chunks[high])
+                if chunk is not None:
+                    chunks[high] = chunk
+        return Bitmap._from_chunks(chunks)
+
+    def __or__(self, other):
+        chunks = self._chunks.copy()
+        for high, chunk in other._chunks.items():
+            if high in chunks:
+                chunks[high] = _or(chunks[high], chunk)
+            else:
+                chunks[high] = chunk
+        return Bitmap._from_chunks(chunks)
+
+    def __sub__(self, other):
+        chunks = {}
+        for high, chunk in self._chunks.items():
+            if high in other._chunks:
+                chunk = _andnot(chunk, other._chunks[high])
+            if chunk is not None:
+                chunks[high] = chunk
+        return Bitmap._from_chunks(chunks)
+
+    def __repr__(self):
+        return '<Bitmap: %d ids>' % len(self)
+
+class TagBitmapIndex(object):
+    """
+    Keeps a ``Bitmap`` of the object ids tagged with each tag, for each
+    content type, if the ``TAG_BITMAP_INDEX`` setting is enabled.
+
+    The bitmaps of a content type are loaded from the tagged items in
+    chunks of ``chunk_size`` rows when they are first used. Tagged items
+    written by this process update them, changes made by other processes
+    are picked up when they are loaded again after
+    ``TAG_BITMAP_INDEX_TIMEOUT`` seconds.
+    """
+    def __init__(self, chunk_size=10000):
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._bitmaps = {}
+
+    def _get_enabled(self):
+        return bool(settings.TAG_BITMAP_INDEX)
+    enabled = property(_get_enabled)
+
+    def get_bitmaps(self, content_type_id):
+        """
+        Returns the dictionary mapping tag ids to the ``Bitmap`` of their
+        object ids for a content type, which is loaded if it's missing or
+        expired, or ``None`` if the index is disabled.
+        """
+        if not self.enabled:
+            return None
+        entry = self._bitmaps.get(content_type_id)
+        timeout = settings.TAG_BITMAP_INDEX_TIMEOUT
+        if entry is None or \
+                timeout is not None and time.time() - entry[1] > timeout:
+            return self.load(content_type_id)
+        return entry[0]
+
+    def load(self, content_type_id):
+        """
+        Loads the bitmaps of a content type from the database and returns
+        them.
+        """
+        from tagging.models import TaggedItem
+        loaded_at = time.time()
+        bitmaps = {}
+        # The object ids read for each tag, which are added to its bitmap
+        # once there are ``chunk_size`` of them.
+        object_ids = {}
+
+        def add_object_ids(tag_id):
+            if tag_id in bitmaps:
+                bitmaps[tag_id].update(Bitmap(object_ids.pop(tag_id)))
+            else:
+                bitmaps[tag_id] = Bitmap(object_ids.pop(tag_id))
+        last_id = 0
+        while True:
+            rows = list(TaggedItem._default_manager.filter(
+                content_type__pk=content_type_id, pk__gt=last_id,
+            ).order_by('pk').values_list('pk', 'tag', 'object_id')[
+                :self.chunk_size])
+            if not len(rows):
+                break
+            for item_id, tag_id, object_id in rows:
+                ids = object_ids.setdefault(tag_id, [])
+                ids.append(object_id)
+                if len(ids) == self.chunk_size:
+                    add_object_ids(tag_id)
+            last_id = rows[-1][0]
+        for tag_id in object_ids.keys():
+            add_object_ids(tag_id)
+        self._lock.acquire()
+        try:
+            self._bitmaps[content_type_id] = (bitmaps, loaded_at)
+        finally:
+            self._lock.release()
+        return bitmaps
+
+    def clear(self, content_type_id=None):
+        """
+        Discards the bitmaps of a content type, or of all content types.
+        They will be loaded again when they are used next.
+        """
+        self._lock.acquire()
+        try:
+            if content_type_id is None:
+                self._bitmaps = {}
+            else:
+                self._bitmaps.pop(content_type_id, None)
+        finally:
+            self._lock.release()
+
+    def add_items(self, items):
+        """
+        Adds tagged items, given as ``(tag_id, content_type_id, object_id)``
+        tuples, to the loaded bitmaps.
+        """
+        self._lock.acquire()
+        try:
+            for tag_id, content_type_id, object_id in items:
+                entry = self._bitmaps.get(content_type_id)
+                if entry is None:
+                    continue
+                bitmap = entry[0].get(tag_id)
+                if bitmap is None:
+                    entry[0][tag_id] = Bitmap([object_id])
+                else:
+                    bitmap.add(object_id)
+        finally:
+            self._lock.release()
+
+    def discard_items(self, items):
+        """
+        Removes tagged items, given as ``(tag_id, content_type_id,
+        object_id)`` tuples, from the loaded bitmaps.
+        """
+        self._lock.acquire()
+        try:
+            for tag_id, content_type_id, object_id in items:
+                entry = self._bitmaps.get(content_type_id)
+                if entry is not None and tag_id in entry[0]:
+                    entry[0][tag_id].discard(object_id)
+        finally:
+            self._lock.release()
+
+    def query(self, queryset_or_model, with_all=None, with_any=None,
+              without=None, default_namespace=None):
+        """
+        Returns a ``Bitmap`` of the ids of the instances of a model which
+        have all of the tags in ``with_all``, any of the tags in
+        ``with_any`` and none of the tags in ``without``, or ``None`` if the
+        index is disabled. At least one of ``with_all`` and ``with_any``
+        must be given.
+
+        Use ``len()`` to count the instances, and ``ids()`` to get a page of
+        ids for ``in_bulk``.
+        """
+        from django.contrib.contenttypes.models import ContentType
+        from tagging.utils import get_queryset_and_model, get_tag_list
+        if with_all is None and with_any is None:
+            raise ValueError('Either with_all or with_any must be given.')
+        queryset, model = get_queryset_and_model(queryset_or_model)
+        bitmaps = self.get_bitmaps(ContentType.objects.get_for_model(model).pk)
+        if bitmaps is None:
+            return None
+
+        def get_bitmaps(tags):
+            tags = get_tag_list(tags, default_namespace=default_namespace)
+            return [bitmaps.get(tag.pk, Bitmap()) for tag in tags]
+        result = None
+        if with_all is not None:
+            result = intersect(get_bitmaps(with_all))
+        if with_any is not None:
+            union = unite(get_bitmaps(with_any))
+            if result is None:
+                result = union
+            else:
+                result = result & union
+        if without is not None:
+            result = result - unite(get_bitmaps(without))
+        return result
+
+    def item_saved(self, sender, instance, created=False, **kwargs):
+        """
+        Signal handler: adds tagged items created by the ORM.
+        """
+        if created:
+            self.add_items([(instance.tag_id, instance.content_type_id,
+                             instance.object_id)])
+
+    def item_deleted(self, sender, instance, **kwargs):
+        """
+        Signal handler: removes tagged items deleted by the ORM.
+        """
+        self.discard_items([(instance.tag_id, instance.content_type_id,
+                             instance.object_id)])
+
+def intersect(bitmaps):
+    """
+    Returns the ``Bitmap`` of the integers in all of the given bitmaps,
+    combining them from the smallest to the largest.
+    """
+    if not len(bitmaps):
+        return Bitmap()
+    bitmaps = list(bitmaps)
+    bitmaps.sort(key=len)
+    result = bitmaps[0].copy()
+    for bitmap in bitmaps[1:]:
+        if not result:
+            break
+        result = result & bitmap
+    return result
+
+def unite(bitmaps):
+    """
+    Returns the ``Bitmap`` of the integers in any of the given bitmaps.
+    """
+    result = Bitmap()
+    for bitmap in bitmaps:
+        result = result | bitmap
+    return result
+
+# The bitmap index shared by the whole process.
+bitmap_index = TagBitmapIndex()
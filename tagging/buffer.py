@@ -0,0 +1,173 @@
+"""
+Write-behind buffering of tagging operations.
+"""
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
+from django.utils import tree
+
+from tagging.utils import ParsedTags
+
+_local = threading.local()
+
+def get_active_buffer():
+    """
+    Returns the ``TaggingBuffer`` which is active in the current thread, or
+    ``None``.
+    """
+    return getattr(_local, 'buffer', None)
+
+def flush_active_buffer():
+    """
+    Writes the pending changes of the active ``TaggingBuffer``, if any, to
+    the database.
+    """
+    buffer = get_active_buffer()
+    if buffer is not None:
+        buffer.flush()
+
+def _matches(q, tag_parts):
+    """
+    Evaluates a ``Q`` object (or one of its nodes) on the namespace, name
+    and value of a tag. Raises ``ValueError`` for lookups which can't be evaluated in memory.
+    """
+    results = []
+    for child in q.children:
+        if isinstance(child, tree.Node):
+            results.append(_matches(child, tag_parts))
+            continue
+        lookup, value = child
+        if '__' in lookup:
+            field, lookup_type = lookup.split('__', 1)
+        else:
+            field, lookup_type = lookup, 'exact'
+        if field not in ('namespace', 'name', 'value'):
+            raise ValueError('Unsupported lookup: %s' % lookup)
+        field_value = getattr(tag_parts, field)
+        if lookup_type == 'exact':
+            results.append(field_value == value)
+        elif lookup_type == 'in':
+            results.append(field_value in value)
+        elif lookup_type == 'isnull':
+            results.append((field_value is None) == bool(value))
+        else:
+            raise ValueError('Unsupported lookup: %s' % lookup)
+    if q.connector == Q.OR:
+        result = True in results
+    else:
+        result = False not in results
+    return result != q.negated
+
+class TaggingBuffer(object):
+    """
+    Collects the tags set by ``Tag.objects.update_tags`` and
+    ``Tag.objects.add_tag`` (and so by ``TagField`` and ``TagDescriptor``)
+    in memory, and writes them at once when it is flushed::
+
+        with TaggingBuffer():
+            Tag.objects.add_tag(widget, 'house')
+            widget.tags = 'house thing'
+
+    All changes of an object are merged into the set of tags it ends up
+    with. When the block ends, the tags of all changed objects are written
+    with ``Tag.objects.update_tags_many``. If the block raises an exception
+    the pending changes are discarded.
+
+    Missing tags are still created immediately. ``Tag.objects.get_for_object``
+    returns the pending tags of an object; other queries flush the buffer
+    before they are run.
+    """
+    def __init__(self):
+        self._pending = {}
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = get_active_buffer()
+        if self._previous is not None:
+            self._previous.flush()
+        _local.buffer = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.buffer = self._previous
+        if exc_type is None:
+            self.flush()
+        else:
+            self.discard()
+        return False
+
+    def _get_key(self, obj):
+        return (ContentType.objects.get_for_model(obj).pk, obj.pk)
+
+    def _get_pending_tags(self, obj):
+        """
+        Returns the dictionary mapping the ``TagParts`` of an object's
+        pending tags to ``Tag`` objects, loading its current tags first.
+        """
+        from tagging.models import Tag
+        key = self._get_key(obj)
+        if key not in self._pending:
+            tags = Tag._default_manager.filter(items__content_type__pk=key[0],
+                items__object_id=key[1])
+            self._pending[key] = (obj, dict([(tag.parts, tag) for tag in tags]))
+        return self._pending[key][1]
+
+    def get_tags(self, obj):
+        """
+        Returns the list of pending ``Tag`` objects of an object, or
+        ``None`` if it has no pending changes.
+        """
+        pending = self._pending.get(self._get_key(obj))
+        if pending is None:
+            return None
+        return pending[1].values()
+
+    def update_tags(self, obj, tag_parts, q=None):
+        """
+        Records that the tags of an object which match ``q`` are replaced
+        by the given ``TagParts``. Returns ``False`` if ``q`` can't be
+        evaluated in memory, after flushing the buffer.
+        """
+        from tagging.models import Tag
+        tags = self._get_pending_tags(obj)
+        updated_tags = Tag._default_manager._get_or_create_tags(tag_parts)
+        try:
+            removed = [parts for parts in tags
+                       if parts not in updated_tags and
+                          (q is None or _matches(q, parts))]
+        except ValueError:
+            self.flush()
+            return False
+        for parts in removed:
+            del tags[parts]
+        tags.update(updated_tags)
+        return True
+
+    def add_tag(self, obj, tag_parts):
+        """
+        Records that an object is associated with the given ``TagParts``.
+        """
+        from tagging.models import Tag
+        self._get_pending_tags(obj).update(
+            Tag._default_manager._get_or_create_tags([tag_parts]))
+
+    def flush(self):
+        """
+        Writes the pending changes to the database.
+        """
+        from tagging.models import Tag
+        pending, self._pending = self._pending, {}
+        if len(pending):
+            Tag._default_manager.update_tags_many(
+                [(obj, ParsedTags(u'', tags.keys()))
+                 for obj, tags in pending.values()])
+
+    def discard(self):
+        """
+        Discards the pending changes.
+        """
+        self._pending = {}
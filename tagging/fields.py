@@ -1,18 +1,15 @@
 """
 A custom Model Field for tagging.
 """
+from django.contrib.contenttypes.models import ContentType
 from django.db.models import signals, Q
 from django.db.models.fields import CharField
 from django.utils.translation import ugettext_lazy as _
 
 from tagging import settings
-from tagging.models import Tag
-from tagging.utils import edit_string_for_tags, get_tag_parts, parse_tag_input
-
-try:
-    set
-except NameError:
-    from sets import Set as set
+from tagging.models import Tag, TaggedItem, _get_instance_tags
+from tagging.utils import edit_string_for_tags, get_tag_parts, parse_tag_input, parse_tags
+from tagging.utils import MAX_TAGS_PER_QUERY
 
 class TagField(CharField):
     """
@@ -23,11 +20,22 @@ class TagField(CharField):
     This field will only accept tags from a specific namespace if the
     ``namespace`` parameter is given. Any athor tag that is assigned will be
     thrown away.
+
+    If the ``denormalized`` parameter is ``True``, the tags of an instance
+    are read from the field's own column, which is kept in sync by all
+    tagging operations, instead of being queried.
+
+    The field remembers the tags an instance was loaded or last saved with,
+    and saving an instance whose tags haven't changed doesn't touch the
+    tagged items.
     """
     def __init__(self, *args, **kwargs):
         self.namespace = kwargs.get('namespace', None)
         if 'namespace' in kwargs:
             del kwargs['namespace']
+        self.denormalized = kwargs.get('denormalized', False)
+        if 'denormalized' in kwargs:
+            del kwargs['denormalized']
         kwargs['max_length'] = kwargs.get('max_length', 255)
         kwargs['blank'] = kwargs.get('blank', True)
         kwargs['default'] = kwargs.get('default', '')
@@ -42,10 +50,10 @@ class TagField(CharField):
         # Save tags back to the database post-save
         signals.post_save.connect(self._save, cls, True)
 
-        # Update tags from Tag objects post-init
+        # Load tags from Tag objects lazily post-init
         signals.post_init.connect(self._update, cls, True)
 
-    def _get_edit_string_for_tags(self, owner=None, instance=None):
+    def _get_edit_string_kwargs(self):
         kwargs = {'default_namespace': self.namespace}
         # if there are more than one tag field on this model,
         # skip the tags with namespaces of athor fields.
@@ -54,14 +62,30 @@ class TagField(CharField):
             kwargs['filter_namespaces'] = (self.namespace,)
         elif self._has_instance_multiple_tag_fields:
             kwargs['exclude_namespaces'] = self._foreign_namespaces
+        return kwargs
 
+    def _get_edit_string_for_tags(self, owner=None, instance=None):
         # Handle access on the model (i.e. Link.tags)
         if instance is None:
             queryset = Tag.objects.usage_for_model(owner)
         # Handle access on the model instance
         else:
-            queryset = Tag.objects.get_for_object(instance)
-        return edit_string_for_tags(queryset, **kwargs)
+            queryset = _get_instance_tags(instance)
+        return edit_string_for_tags(queryset, **self._get_edit_string_kwargs())
+
+    def _get_canonical_edit_string(self, tags):
+        """
+        Returns the edit string of the given tag string or list of ``Tag``
+        objects, with the tags in the order of the ``Tag`` model, as it is
+        stored in denormalized columns.
+        """
+        if isinstance(tags, basestring):
+            tags = parse_tags(tags, default_namespace=self.namespace).tags
+        else:
+            tags = [tag.parts for tag in tags]
+        tags = sorted(tags,
+            key=lambda parts: (parts.namespace, parts.name, parts.value))
+        return edit_string_for_tags(tags, **self._get_edit_string_kwargs())
 
     def __get__(self, instance, owner=None):
         """
@@ -125,9 +149,12 @@ class TagField(CharField):
 
     def _save(self, **kwargs): #signal, sender, instance):
         """
-        Save tags back to the database
+        Save tags back to the database, unless they haven't changed since
+        they were loaded or last saved.
         """
         instance = kwargs['instance']
+        if not self._has_changed(instance):
+            return
         tags = self._get_instance_tag_cache(kwargs['instance'])
         q = Q()
         if self.namespace is not None:
@@ -135,16 +162,64 @@ class TagField(CharField):
         elif self._has_instance_multiple_tag_fields and \
                 self._foreign_namespaces:
             q &= ~Q(namespace__in=self._foreign_namespaces)
-        Tag.objects.update_tags(instance, tags, q=q,
-            default_namespace=self.namespace)
+        if not self.denormalized:
+            Tag.objects.update_tags(instance, tags, q=q,
+                default_namespace=self.namespace)
+        else:
+            # The columns were written by pre_save, they must not be synced
+            # before the tags of the other fields of the instance are saved.
+            instance._saving_tag_field = True
+            try:
+                Tag.objects.update_tags(instance, tags, q=q,
+                    default_namespace=self.namespace)
+            finally:
+                del instance._saving_tag_field
+        self._set_clean_tags(instance, tags)
 
     def _update(self, **kwargs): #signal, sender, instance):
         """
-        Update tag cache from TaggedItem objects.
+        Discard the tag cache of saved instances, so it is updated from
+        TaggedItem objects when it is first accessed. The value of the
+        column is kept to be saved again as long as the tags aren't loaded.
+        Denormalized fields keep the value of their column as their tags.
         """
         instance = kwargs['instance']
         self._init(instance)
-        self._update_instance_tag_cache(instance)
+        if instance.pk is None:
+            return
+        if self.denormalized:
+            self._set_clean_tags(instance,
+                instance.__dict__.get(self._get_cache_name()))
+        else:
+            instance.__dict__[self._get_column_cache_name()] = \
+                instance.__dict__.pop(self._get_cache_name(), None)
+
+    def pre_save(self, model_instance, add):
+        """
+        Stores the canonical edit string of the tags in denormalized
+        columns. The columns of other fields keep their value if the tags
+        haven't been loaded.
+        """
+        if not self.denormalized:
+            if self._get_cache_name() not in model_instance.__dict__:
+                return model_instance.__dict__.get(
+                    self._get_column_cache_name())
+            return super(TagField, self).pre_save(model_instance, add)
+        self._init(model_instance)
+        value = unicode(self._get_canonical_edit_string(
+            self._get_instance_tag_cache(model_instance) or u''))
+        setattr(model_instance, self._get_cache_name(), value)
+        return value
+
+    def get_prep_value(self, value):
+        """
+        Stores ``ParsedTags`` as plain unicode, which is the only string
+        type all database adapters accept.
+        """
+        value = super(TagField, self).get_prep_value(value)
+        if isinstance(value, unicode):
+            value = unicode(value)
+        return value
 
     def __delete__(self, instance):
         """
@@ -152,11 +227,58 @@ class TagField(CharField):
         """
         self._set_instance_tag_cache(instance, '')
 
+    def _get_cache_name(self):
+        return '_%s_cache' % self.attname
+
+    def _get_clean_cache_name(self):
+        return '_%s_clean' % self.attname
+
+    def _get_column_cache_name(self):
+        return '_%s_column' % self.attname
+
+    def _get_tag_set(self, tags):
+        """
+        Helper: returns the set of ``TagParts`` of a tag string, as it
+        would be saved by ``Tag.objects.update_tags``.
+        """
+        tags = parse_tags(tags or u'', default_namespace=self.namespace)
+        if settings.FORCE_LOWERCASE_TAGS:
+            tags = tags.lower()
+        return set(tags.tags)
+
+    def _set_clean_tags(self, instance, tags):
+        """
+        Helper: remember the tags of an instance as they are stored in the
+        database.
+        """
+        instance.__dict__[self._get_clean_cache_name()] = tags or u''
+
+    def _has_changed(self, instance):
+        """
+        Helper: returns whether the tags of an instance may differ from the
+        tags it was loaded or last saved with. The tags of an instance whose
+        tag cache has never been loaded or set haven't changed.
+        """
+        cache_name = self._get_cache_name()
+        if cache_name not in instance.__dict__:
+            return False
+        clean = instance.__dict__.get(self._get_clean_cache_name())
+        if clean is None:
+            return True
+        tags = instance.__dict__[cache_name]
+        if tags == clean:
+            return False
+        return self._get_tag_set(tags) != self._get_tag_set(clean)
+
     def _get_instance_tag_cache(self, instance):
         """
-        Helper: get an instance's tag cache.
+        Helper: get an instance's tag cache, which is updated from actual
+        Tags if it hasn't been loaded yet.
         """
-        return getattr(instance, '_%s_cache' % self.attname, None)
+        cache_name = self._get_cache_name()
+        if cache_name not in instance.__dict__:
+            self._update_instance_tag_cache(instance)
+        return getattr(instance, cache_name, None)
 
     def _set_instance_tag_cache(self, instance, tags):
         """
@@ -175,7 +297,7 @@ class TagField(CharField):
             else:
                 kwargs['filter_namespaces'] = (self.namespace,)
             tags = edit_string_for_tags(tags, **kwargs)
-        setattr(instance, '_%s_cache' % self.attname, tags)
+        setattr(instance, self._get_cache_name(), tags)
 
     def _update_instance_tag_cache(self, instance):
         """
@@ -185,6 +307,8 @@ class TagField(CharField):
         if instance.pk is not None:
             tags = self._get_edit_string_for_tags(instance=instance)
             self._set_instance_tag_cache(instance, tags)
+            self._set_clean_tags(instance,
+                getattr(instance, self._get_cache_name()))
 
     def get_internal_type(self):
         return 'CharField'
@@ -199,6 +323,62 @@ class TagField(CharField):
         return super(TagField, self).formfield(**defaults)
 
 
+def get_denormalized_tag_fields(model):
+    """
+    Returns the ``TagField`` fields of a model which store their tags in
+    their own column.
+    """
+    return [field for field in model._meta.fields
+            if isinstance(field, TagField) and field.denormalized]
+
+def sync_tag_fields(model, object_ids, instances=()):
+    """
+    Writes the current tags of the instances of ``model`` with the given
+    ids to their denormalized ``TagField`` columns, where they differ.
+    The tag caches of the model instances given as ``instances`` are
+    updated too.
+
+    Returns the number of rows updated.
+    """
+    fields = get_denormalized_tag_fields(model)
+    if not len(fields):
+        return 0
+    for field in fields:
+        field._init(model)
+    content_type = ContentType.objects.get_for_model(model)
+    object_ids = list(object_ids)
+    edit_strings = {}
+    updated = 0
+    for i in range(0, len(object_ids), MAX_TAGS_PER_QUERY):
+        chunk = object_ids[i:i + MAX_TAGS_PER_QUERY]
+        tags = {}
+        for object_id, tag_id, namespace, name, value in \
+                TaggedItem._default_manager.filter(
+                    content_type__pk=content_type.pk, object_id__in=chunk,
+                ).values_list('object_id', 'tag', 'tag__namespace',
+                              'tag__name', 'tag__value'):
+            tags.setdefault(object_id, []).append(Tag(id=tag_id,
+                namespace=namespace, name=name, value=value))
+        for row in model._default_manager.filter(pk__in=chunk).values_list(
+                'pk', *[field.attname for field in fields]):
+            changes = {}
+            for field, stored in zip(fields, row[1:]):
+                edit_string = unicode(field._get_canonical_edit_string(
+                    tags.get(row[0], [])))
+                edit_strings[(row[0], field.attname)] = edit_string
+                if (stored or u'') != edit_string:
+                    changes[field.attname] = edit_string
+            if changes:
+                model._default_manager.filter(pk=row[0]).update(**changes)
+                updated += 1
+    for instance in instances:
+        for field in fields:
+            edit_string = edit_strings.get((instance.pk, field.attname))
+            if edit_string is not None:
+                setattr(instance, field._get_cache_name(), edit_string)
+                field._set_clean_tags(instance, edit_string)
+    return updated
+
 def validate_tag_fields(sender, **kwargs):
     '''
     Validates ``TagField``s on models.
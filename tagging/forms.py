@@ -6,7 +6,7 @@ from django.utils.translation import ugettext as _
 
 from tagging import settings
 from tagging.models import Tag
-from tagging.utils import check_tag_length, get_tag_parts, parse_tag_input
+from tagging.utils import check_tag_length, get_tag_parts, iter_tag_input, ParsedTags
 
 class TagAdminForm(forms.ModelForm):
     class Meta:
@@ -50,32 +50,47 @@ class TagField(forms.CharField):
     """
     A ``CharField`` which validates that its input is a valid list of
     tag names and checks the allowed length of the tag parts.
+
+    If ``max_tags`` is given, input with more unique tags is rejected
+    without parsing the rest of it.
+
+    The cleaned value is returned as ``ParsedTags``, so the model's
+    ``TagField`` and ``Tag.objects.update_tags`` don't parse it again.
     """
     def __init__(self, *args, **kwargs):
         if 'default_namespace' in kwargs:
             self.default_namespace = kwargs.pop('default_namespace')
         else:
             self.default_namespace = None
+        self.max_tags = kwargs.pop('max_tags', None)
         super(TagField, self).__init__(*args, **kwargs)
     def clean(self, value):
         value = super(TagField, self).clean(value)
         if value == u'':
             return value
-        for tag_name in parse_tag_input(value, default_namespace=self.default_namespace):
-            try:
-                check_tag_length(get_tag_parts(tag_name))
-            except ValueError, e:
-                if len(e.args) < 3:
-                    raise
-                part, max_len = e.args[1:3]
-                if part == 'tag':
-                    raise forms.ValidationError(_('Each tag may be no more than %s characters long.') % max_len)
-                elif part == 'namespace':
-                    raise forms.ValidationError(_('Each tag\'s namespace may be no more than %s characters long.') % max_len)
-                elif part == 'name':
-                    raise forms.ValidationError(_('Each tag\'s name may be no more than %s characters long.') % max_len)
-                elif part == 'value':
-                    raise forms.ValidationError(_('Each tag\'s value may be no more than %s characters long.') % max_len)
-                else:
-                    raise
-        return value
+        tags = []
+        try:
+            for tag_name in iter_tag_input(value,
+                    default_namespace=self.default_namespace,
+                    max_tags=self.max_tags):
+                tag = get_tag_parts(tag_name)
+                check_tag_length(tag)
+                tags.append(tag)
+        except ValueError, e:
+            if len(e.args) < 3:
+                raise
+            part, max_len = e.args[1:3]
+            if part == 'tag':
+                raise forms.ValidationError(_('Each tag may be no more than %s characters long.') % max_len)
+            elif part == 'namespace':
+                raise forms.ValidationError(_('Each tag\'s namespace may be no more than %s characters long.') % max_len)
+            elif part == 'name':
+                raise forms.ValidationError(_('Each tag\'s name may be no more than %s characters long.') % max_len)
+            elif part == 'value':
+                raise forms.ValidationError(_('Each tag\'s value may be no more than %s characters long.') % max_len)
+            elif part == 'tags':
+                raise forms.ValidationError(_('Please enter no more than %s tags.') % max_len)
+            else:
+                raise
+        tags.sort(key=unicode)
+        return ParsedTags(value, tags, default_namespace=self.default_namespace)
@@ -38,3 +38,66 @@ def fetch_content_objects(tagged_items, select_related_for=None):
     for item in tagged_items:
         item._object_cache = objects[item.content_type_id][item.object_id]
         item._content_type_cache = content_types[item.content_type_id]
+
+def prefetch_tags(objects, fields=None):
+    """
+    Retrieves the tags of all given model instances at once, so accessing
+    their ``TagField`` fields and ``TagDescriptor`` attributes doesn't
+    query the database for each instance.
+
+    ``objects`` is a ``QuerySet`` or a list of model instances. The tags
+    are retrieved with one query per content type and chunk of
+    ``MAX_TAGS_PER_QUERY`` instances.
+
+    If ``fields`` is given, only the ``TagField`` fields with these names
+    are filled. ``TagDescriptor`` attributes and
+    ``Tag.objects.get_for_object`` return the retrieved tags until this
+    process changes any tags.
+
+    Returns the list of instances.
+    """
+    from tagging.buffer import flush_active_buffer
+    from tagging.fields import TagField
+    from tagging import models
+    from tagging.models import Tag, TaggedItem
+    from tagging.utils import MAX_TAGS_PER_QUERY
+
+    flush_active_buffer()
+    objects = list(objects)
+    # Tags changed by this process after this point discard the prefetched
+    # tags again.
+    version = models._tags_version
+
+    # Group the instances by their content type pks
+    instances = {}
+    for obj in objects:
+        content_type = ContentType.objects.get_for_model(obj)
+        instances.setdefault(content_type.pk, {}).setdefault(obj.pk, []).append(obj)
+
+    tags = {}
+    for content_type_pk, objects_by_pk in instances.items():
+        object_pks = objects_by_pk.keys()
+        object_tags = dict([(object_pk, []) for object_pk in object_pks])
+        for i in range(0, len(object_pks), MAX_TAGS_PER_QUERY):
+            for object_pk, tag_pk, namespace, name, value in \
+                    TaggedItem._default_manager.filter(
+                        content_type__pk=content_type_pk,
+                        object_id__in=object_pks[i:i + MAX_TAGS_PER_QUERY],
+                    ).values_list('object_id', 'tag', 'tag__namespace',
+                                  'tag__name', 'tag__value'):
+                if tag_pk not in tags:
+                    tags[tag_pk] = Tag(id=tag_pk, namespace=namespace,
+                        name=name, value=value)
+                object_tags[object_pk].append(tags[tag_pk])
+        for object_pk, instance_tags in object_tags.items():
+            # Same order as the ordering of the Tag model
+            instance_tags.sort(key=lambda tag: (tag.namespace, tag.name,
+                                                tag.value))
+            for obj in objects_by_pk[object_pk]:
+                obj._prefetched_tags_cache = (version, instance_tags)
+                for field in obj._meta.fields:
+                    if isinstance(field, TagField) and \
+                            (fields is None or field.name in fields):
+                        field._init(obj)
+                        field._update_instance_tag_cache(obj)
+    return objects
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from tagging import settings
+from tagging.snapshot import write_snapshot
+
+class Command(BaseCommand):
+    help = 'Writes a snapshot of all tagged items to a file, by default to TAG_SNAPSHOT_PATH.'
+    args = '[path]'
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError('Only a single path may be given.')
+        if len(args):
+            path = args[0]
+        else:
+            path = settings.TAG_SNAPSHOT_PATH
+        if not path:
+            raise CommandError('No path was given and TAG_SNAPSHOT_PATH is not set.')
+        write_snapshot(path)
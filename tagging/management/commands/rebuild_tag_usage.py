@@ -0,0 +1,9 @@
+from django.core.management.base import NoArgsCommand
+
+from tagging.models import TagUsage
+
+class Command(NoArgsCommand):
+    help = 'Counts all tagged items again to rebuild the tag usage table.'
+
+    def handle_noargs(self, **options):
+        TagUsage.objects.rebuild()
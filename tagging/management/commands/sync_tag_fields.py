@@ -0,0 +1,49 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models, transaction
+
+from tagging.fields import get_denormalized_tag_fields, sync_tag_fields
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', default=1000, dest='batch_size', type='int',
+            help='The number of instances checked in each transaction.'),
+    )
+    help = 'Writes the current tags to the denormalized TagField columns which differ from them.'
+    args = '[appname.ModelName ...]'
+
+    def handle(self, *args, **options):
+        if len(args):
+            model_list = []
+            for label in args:
+                try:
+                    app_label, model_name = label.split('.')
+                except ValueError:
+                    raise CommandError('Expected appname.ModelName, got: %s' % label)
+                model = models.get_model(app_label, model_name)
+                if model is None:
+                    raise CommandError('Unknown model: %s' % label)
+                model_list.append(model)
+        else:
+            model_list = [model for model in models.get_models()
+                          if len(get_denormalized_tag_fields(model))]
+        verbosity = int(options.get('verbosity', 1))
+        batch_size = options.get('batch_size', 1000)
+        for model in model_list:
+            updated = 0
+            last_pk = None
+            while True:
+                queryset = model._default_manager.order_by('pk')
+                if last_pk is not None:
+                    queryset = queryset.filter(pk__gt=last_pk)
+                object_ids = list(queryset.values_list('pk', flat=True)[:batch_size])
+                if not len(object_ids):
+                    break
+                updated += transaction.commit_on_success(sync_tag_fields)(
+                    model, object_ids)
+                last_pk = object_ids[-1]
+            if verbosity > 0:
+                sys.stdout.write('%s.%s: %d rows updated\n' % (
+                    model._meta.app_label, model._meta.object_name, updated))
@@ -5,7 +5,8 @@ application.
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
 
-from tagging.models import Tag, TaggedItem
+from tagging.buffer import flush_active_buffer
+from tagging.models import Tag, TaggedItem, _get_instance_tags
 from tagging.utils import edit_string_for_tags
 
 class ModelTagManager(models.Manager):
@@ -13,6 +14,7 @@ class ModelTagManager(models.Manager):
     A manager for retrieving tags for a particular model.
     """
     def get_query_set(self):
+        flush_active_buffer()
         ctype = ContentType.objects.get_for_model(self.model)
         return Tag.objects.filter(
             items__content_type__pk=ctype.pk).distinct()
@@ -58,20 +60,24 @@ class TagDescriptor(object):
 
     You can limit the actions made by the descriptor to a specific namespace
     through the ``namespace`` parameter.
+
+    The tags of an instance are returned as a list, taken from the tags
+    which are retrieved once for all descriptors and fields of the instance.
     """
     def __init__(self, **kwargs):
         self.namespace = kwargs.get('namespace', None)
 
     def __get__(self, instance, owner):
-        if not instance:
-            tag_manager = ModelTagManager()
-            tag_manager.model = owner
-            queryset = tag_manager
-        else:
-            queryset = Tag.objects.get_for_object(instance)
+        if instance:
+            tags = _get_instance_tags(instance)
+            if self.namespace is not None:
+                return [tag for tag in tags if tag.namespace == self.namespace]
+            return list(tags)
+        tag_manager = ModelTagManager()
+        tag_manager.model = owner
         if self.namespace is not None:
-            queryset = queryset.filter(namespace=self.namespace)
-        return queryset
+            return tag_manager.filter(namespace=self.namespace)
+        return tag_manager
 
     def __set__(self, instance, value):
         kwargs = {'default_namespace': self.namespace}
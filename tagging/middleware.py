@@ -0,0 +1,30 @@
+"""
+Middleware for the tagging application.
+"""
+from tagging.buffer import TaggingBuffer
+
+class TaggingBufferMiddleware(object):
+    """
+    Collects the tagging operations of each request in a ``TaggingBuffer``
+    and writes them when the response is returned. The pending changes are
+    discarded if the view raises an exception.
+
+    Put it after ``django.middleware.transaction.TransactionMiddleware``
+    so the changes are written before the transaction is committed.
+    """
+    def process_request(self, request):
+        request._tagging_buffer = TaggingBuffer()
+        request._tagging_buffer.__enter__()
+
+    def process_exception(self, request, exception):
+        buffer = getattr(request, '_tagging_buffer', None)
+        if buffer is not None:
+            del request._tagging_buffer
+            buffer.__exit__(type(exception), exception, None)
+
+    def process_response(self, request, response):
+        buffer = getattr(request, '_tagging_buffer', None)
+        if buffer is not None:
+            del request._tagging_buffer
+            buffer.__exit__(None, None, None)
+        return response
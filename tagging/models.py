@@ -1,59 +1,466 @@
 """
 Models and managers for generic tagging.
 """
-# Python 2.3 compatibility
+from itertools import islice
 try:
-    set
-except NameError:
-    from sets import Set as set
+    import threading
+except ImportError:
+    import dummy_threading as threading
 
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
-from django.db import connection, models
+from django.db import IntegrityError, connection, models, transaction
+from django.utils.functional import wraps
 from django.utils.translation import ugettext_lazy as _
 
 from tagging import settings
-from tagging.utils import calculate_cloud, get_tag_list, get_tag_parts, get_queryset_and_model, normalize_tag_part, parse_tag_input
+from tagging.bitmap import BITMAP_MAX_IDS, bitmap_index, unite
+from tagging.buffer import flush_active_buffer, get_active_buffer
+from tagging.planner import plan_query
+from tagging.snapshot import get_snapshot
+from tagging.utils import calculate_cloud, calculate_cloud_count_thresholds, get_tag_list, get_tag_parts, get_tags_in_bulk, get_queryset_and_model, parse_tag_input, parse_tags
+from tagging.utils import MAX_TAGS_PER_QUERY
+from tagging.utils import TagParts, _get_tags_by_parts, _group_tag_lookups
 from tagging.utils import LOGARITHMIC
+from tagging.vocabulary import vocabulary
 
 qn = connection.ops.quote_name
 
+def _commit_on_success(func):
+    """
+    Runs ``func`` in a transaction which is committed if it returns
+    successfully, unless the caller already manages the transaction.
+    """
+    def _run(*args, **kwargs):
+        if transaction.is_managed():
+            return func(*args, **kwargs)
+        return transaction.commit_on_success(func)(*args, **kwargs)
+    return wraps(func)(_run)
+
+def _get_insert_sql(ignore_conflicts=False):
+    """
+    Returns the keywords starting an ``INSERT`` statement and the clause
+    ending it, which make it skip rows violating a unique constraint if
+    ``ignore_conflicts`` is ``True``.
+    """
+    engine = connection.settings_dict['ENGINE']
+    if ignore_conflicts:
+        if 'sqlite' in engine:
+            return 'INSERT OR IGNORE', ''
+        elif 'mysql' in engine:
+            return 'INSERT IGNORE', ''
+        elif 'postgresql' in engine or 'postgis' in engine:
+            return 'INSERT', ' ON CONFLICT DO NOTHING'
+    return 'INSERT', ''
+
+def _supports_multirow_insert():
+    """
+    Returns whether the backend accepts ``INSERT`` statements with several
+    rows in their ``VALUES`` clause.
+    """
+    engine = connection.settings_dict['ENGINE']
+    for name in ('sqlite', 'mysql', 'postgresql', 'postgis'):
+        if name in engine:
+            return True
+    return False
+
+def _get_locking_read_sql():
+    """
+    Returns the clause ending a ``SELECT`` statement which reads the latest
+    committed rows and locks them. SQLite doesn't need one, because it
+    never runs writing transactions concurrently.
+    """
+    if 'sqlite' in connection.settings_dict['ENGINE']:
+        return ''
+    return ' FOR UPDATE'
+
+def _get_pk_subquery_sql(queryset):
+    """
+    Returns the SQL and parameters of a subquery selecting the primary keys
+    of the instances in ``queryset``.
+    """
+    query = queryset.order_by().values_list('pk', flat=True).query
+    if getattr(query, 'get_compiler', None):
+        # Django 1.2+
+        sql, params = query.get_compiler(using=queryset.db).as_sql()
+    else:
+        # Django pre-1.2
+        sql, params = query.as_sql()
+    # The extra derived table lets MySQL use the subquery in statements
+    # which change a table the subquery reads from.
+    return 'SELECT %s FROM (%s) %s' % (qn(queryset.model._meta.pk.column),
+        sql, qn('pks')), params
+
+# Incremented whenever this process changes tags or tagged items, which
+# discards the tags prefetched for or shared by all model instances.
+_tags_version = 0
+_tags_version_lock = threading.Lock()
+
+def _tags_changed(**kwargs):
+    global _tags_version
+    _tags_version_lock.acquire()
+    try:
+        _tags_version += 1
+    finally:
+        _tags_version_lock.release()
+
+def _get_instance_tags(obj):
+    """
+    Returns the list of all tags of an object. They are retrieved with a
+    single query and shared by all ``TagField`` fields and
+    ``TagDescriptor`` attributes of the object, which take the tags of
+    their namespace from it, until this process changes any tags.
+
+    ``Tag.objects.get_for_object`` doesn't use the shared tags, it only
+    returns the tags retrieved by ``tagging.generic.prefetch_tags``.
+    """
+    tags = _get_prefetched_tags(obj)
+    if tags is not None:
+        return tags
+    version = _tags_version
+    shared = obj.__dict__.get('_shared_tags_cache')
+    if shared is not None and shared[0] == version:
+        return shared[1]
+    tags = list(Tag.objects.get_for_object(obj))
+    if obj.pk is not None:
+        obj._shared_tags_cache = (version, tags)
+    return tags
+
+def _get_prefetched_tags(obj):
+    """
+    Returns the tags of an object retrieved by
+    ``tagging.generic.prefetch_tags``, or ``None`` if they weren't
+    retrieved or this process has changed tags since.
+    """
+    prefetched = obj.__dict__.get('_prefetched_tags_cache')
+    if prefetched is not None and prefetched[0] == _tags_version:
+        return prefetched[1]
+    return None
+
+def _clear_prefetched_tags(obj):
+    """
+    Discards the tags of an object retrieved by ``_get_instance_tags`` or
+    ``tagging.generic.prefetch_tags``, after its tags have changed.
+    """
+    obj.__dict__.pop('_prefetched_tags_cache', None)
+    obj.__dict__.pop('_shared_tags_cache', None)
+
+def _parse_single_tag(tag_name, default_namespace=None):
+    """
+    Parses the input of a single tag, which is lowercased if
+    ``FORCE_LOWERCASE_TAGS`` is set, and returns its ``TagParts``.
+
+    Raises ``AttributeError`` unless the input contains exactly one tag.
+    """
+    tag_names = parse_tag_input(tag_name,
+        default_namespace=default_namespace)
+    if not len(tag_names):
+        raise AttributeError(_('No tags were given: "%s".') % tag_name)
+    if len(tag_names) > 1:
+        raise AttributeError(_('Multiple tags were given: "%s".') % tag_name)
+    tag_name = tag_names[0]
+    if settings.FORCE_LOWERCASE_TAGS:
+        tag_name = tag_name.lower()
+    return get_tag_parts(tag_name)
+
+def _has_denormalized_tag_fields(model):
+    for field in model._meta.fields:
+        if getattr(field, 'denormalized', False):
+            return True
+    return False
+
+def _sync_tag_fields(model, object_ids, instances=()):
+    """
+    Updates the denormalized ``TagField`` columns of the objects of
+    ``model`` with the given ids, if it has any.
+    """
+    if _has_denormalized_tag_fields(model):
+        from tagging.fields import sync_tag_fields
+        sync_tag_fields(model, object_ids, instances)
+
+def _insert_rows(table, columns, rows, ignore_conflicts=False):
+    """
+    Inserts the given rows into ``table`` using multi-row ``INSERT``
+    statements of up to ``MAX_TAGS_PER_QUERY`` rows each.
+
+    The rows are inserted in sorted order, so concurrent transactions lock
+    them in the same order. If ``ignore_conflicts`` is ``True``, rows which
+    violate a unique constraint are skipped instead of raising an error,
+    using the upsert of the backends that support it (SQLite, PostgreSQL
+    9.5+ and MySQL). Other backends insert the rows one by one, each in a
+    savepoint which is rolled back on conflicts.
+
+    Returns the number of rows inserted.
+    """
+    insert_sql, conflict_sql = _get_insert_sql(ignore_conflicts)
+    rows = list(rows)
+    rows.sort()
+    cursor = connection.cursor()
+    row_sql = '(%s)' % ', '.join(['%s'] * len(columns))
+    inserted = 0
+    if not _supports_multirow_insert():
+        sql = '%s INTO %s (%s) VALUES %s' % (insert_sql, qn(table),
+            ', '.join([qn(column) for column in columns]), row_sql)
+        for row in rows:
+            if not ignore_conflicts:
+                cursor.execute(sql, list(row))
+                inserted += cursor.rowcount
+                continue
+            sid = transaction.savepoint()
+            try:
+                cursor.execute(sql, list(row))
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+            else:
+                transaction.savepoint_commit(sid)
+                inserted += cursor.rowcount
+        transaction.commit_unless_managed()
+        return inserted
+    for i in range(0, len(rows), MAX_TAGS_PER_QUERY):
+        chunk = rows[i:i + MAX_TAGS_PER_QUERY]
+        params = []
+        for row in chunk:
+            params.extend(row)
+        cursor.execute('%s INTO %s (%s) VALUES %s%s' % (
+            insert_sql,
+            qn(table),
+            ', '.join([qn(column) for column in columns]),
+            ', '.join([row_sql] * len(chunk)),
+            conflict_sql), params)
+        inserted += cursor.rowcount
+    transaction.commit_unless_managed()
+    return inserted
+
 ############
 # Managers #
 ############
 
 class TagManager(models.Manager):
+    @_commit_on_success
     def update_tags(self, obj, tag_names, default_namespace=None, q=None):
         """
         Update tags associated with an object.
 
         Accepts a ``default_namespace`` parameter that is assigned to tags
         with no namespace specified.
+
+        ``tag_names`` may also be ``ParsedTags``, which are not parsed again
+        if they were parsed with the same ``default_namespace``.
+
+        The changes are written in bulk within a single transaction: missing
+        tags and new tagged items are inserted with one statement each, and
+        the tagged items which no longer apply are deleted with another.
         """
+        updated_tags = parse_tags(tag_names,
+            default_namespace=default_namespace)
+        if settings.FORCE_LOWERCASE_TAGS:
+            updated_tags = updated_tags.lower()
+        updated_tags = updated_tags.tags
+        _clear_prefetched_tags(obj)
+        _tags_changed()
+        buffer = get_active_buffer()
+        if buffer is not None and buffer.update_tags(obj, updated_tags, q=q):
+            return
+        updated_tag_set = set(updated_tags)
         ctype = ContentType.objects.get_for_model(obj)
         current_tags = self.filter(items__content_type__pk=ctype.pk,
             items__object_id=obj.pk)
         if q is not None:
             current_tags = current_tags.filter(q)
         current_tags = list(current_tags)
-        updated_tag_names = parse_tag_input(tag_names,
-            default_namespace=default_namespace)
-        if settings.FORCE_LOWERCASE_TAGS:
-            updated_tag_names = [t.lower() for t in updated_tag_names]
 
         # Remove tags which no longer apply
         tags_for_removal = [tag for tag in current_tags \
-                            if unicode(tag) not in updated_tag_names]
+                            if tag.parts not in updated_tag_set]
+        usage = _TagUsageChanges()
         if len(tags_for_removal):
-            TaggedItem._default_manager.filter(content_type__pk=ctype.pk,
-                object_id=obj.pk, tag__in=tags_for_removal).delete()
+            cursor = connection.cursor()
+            cursor.execute('DELETE FROM %s WHERE content_type_id = %%s AND object_id = %%s AND tag_id IN (%s)' % (
+                qn(TaggedItem._meta.db_table),
+                ', '.join(['%s'] * len(tags_for_removal))),
+                [ctype.pk, obj.pk] + [tag.pk for tag in tags_for_removal])
+            transaction.commit_unless_managed()
+            usage.add([(tag.pk, ctype.pk) for tag in tags_for_removal], -1,
+                cursor.rowcount)
+            bitmap_index.discard_items([(tag.pk, ctype.pk, obj.pk)
+                                        for tag in tags_for_removal])
+        # Add new tags
+        current_tag_set = set([tag.parts for tag in current_tags])
+        new_tags = [tag_parts for tag_parts in updated_tags
+                    if tag_parts not in current_tag_set]
+        if len(new_tags):
+            tags = self._get_or_create_tags(new_tags)
+            new_items = [(tags[tag_parts].pk, ctype.pk, obj.pk)
+                         for tag_parts in new_tags]
+            inserted = _insert_rows(TaggedItem._meta.db_table,
+                ('tag_id', 'content_type_id', 'object_id'), new_items,
+                ignore_conflicts=True)
+            usage.add([(tag_id, ctype_id)
+                       for tag_id, ctype_id, object_id in new_items], 1,
+                inserted)
+            bitmap_index.add_items(new_items)
+        usage.save()
+        if not getattr(obj, '_saving_tag_field', False):
+            _sync_tag_fields(obj.__class__, [obj.pk], [obj])
+
+    def update_tags_many(self, tag_input, default_namespace=None,
+                         batch_size=500):
+        """
+        Updates the tags of many objects, like calling ``update_tags`` for
+        each of them.
+
+        ``tag_input`` is a dictionary or an iterable of pairs, mapping
+        objects to the tag names they should be tagged with.
+
+        The objects are processed in batches of ``batch_size``, each in its
+        own transaction. The current tags of a whole batch are loaded at
+        once, the missing tags are created in bulk and the tagged items are
+        inserted and deleted with multi-row statements.
+        """
+        flush_active_buffer()
+        if hasattr(tag_input, 'iteritems'):
+            tag_input = tag_input.iteritems()
+        tag_input = iter(tag_input)
+        while True:
+            batch = list(islice(tag_input, batch_size))
+            if not len(batch):
+                break
+            self._update_tags_batch(batch, default_namespace)
+
+    @_commit_on_success
+    def _update_tags_batch(self, batch, default_namespace):
+        updated_tags = {}
+        _tags_changed()
+        for obj, tag_names in batch:
+            _clear_prefetched_tags(obj)
+            ctype = ContentType.objects.get_for_model(obj)
+            tags = parse_tags(tag_names, default_namespace=default_namespace)
+            if settings.FORCE_LOWERCASE_TAGS:
+                tags = tags.lower()
+            updated_tags[(ctype.pk, obj.pk)] = set(tags.tags)
+
+        object_ids = {}
+        for ctype_id, object_id in updated_tags:
+            object_ids.setdefault(ctype_id, []).append(object_id)
+        current_tags = {}
+        items_for_removal = []
+        removed_items = []
+        for ctype_id, ids in object_ids.items():
+            for i in range(0, len(ids), MAX_TAGS_PER_QUERY):
+                for item_id, object_id, tag_id, namespace, name, value in \
+                        TaggedItem._default_manager.filter(
+                            content_type__pk=ctype_id,
+                            object_id__in=ids[i:i + MAX_TAGS_PER_QUERY],
+                        ).values_list('id', 'object_id', 'tag',
+                            'tag__namespace', 'tag__name', 'tag__value'):
+                    key = (ctype_id, object_id)
+                    tag_parts = TagParts(namespace, name, value)
+                    if tag_parts in updated_tags[key]:
+                        current_tags.setdefault(key, set()).add(tag_parts)
+                    else:
+                        items_for_removal.append(item_id)
+                        removed_items.append((tag_id, ctype_id, object_id))
+
+        # Remove tags which no longer apply
+        usage = _TagUsageChanges()
+        if len(items_for_removal):
+            cursor = connection.cursor()
+            deleted = 0
+            for i in range(0, len(items_for_removal), MAX_TAGS_PER_QUERY):
+                chunk = items_for_removal[i:i + MAX_TAGS_PER_QUERY]
+                cursor.execute('DELETE FROM %s WHERE id IN (%s)' % (
+                    qn(TaggedItem._meta.db_table),
+                    ', '.join(['%s'] * len(chunk))), chunk)
+                deleted += cursor.rowcount
+            transaction.commit_unless_managed()
+            usage.add([(tag_id, ctype_id)
+                       for tag_id, ctype_id, object_id in removed_items], -1,
+                deleted)
+            bitmap_index.discard_items(removed_items)
         # Add new tags
-        current_tag_names = [unicode(tag) for tag in current_tags]
-        for tag_name in updated_tag_names:
-            if tag_name not in current_tag_names:
-                tag, created = self.get_or_create(**get_tag_parts(tag_name))
-                TaggedItem._default_manager.create(tag=tag, object=obj)
+        new_items = []
+        new_tags = set()
+        for key, tags in updated_tags.items():
+            for tag_parts in tags - current_tags.get(key, set()):
+                new_items.append((tag_parts, key))
+                new_tags.add(tag_parts)
+        if len(new_items):
+            tags = self._get_or_create_tags(list(new_tags))
+            new_items = [(tags[tag_parts].pk, ctype_id, object_id)
+                         for tag_parts, (ctype_id, object_id) in new_items]
+            inserted = _insert_rows(TaggedItem._meta.db_table,
+                ('tag_id', 'content_type_id', 'object_id'), new_items,
+                ignore_conflicts=True)
+            usage.add([(tag_id, ctype_id)
+                       for tag_id, ctype_id, object_id in new_items], 1,
+                inserted)
+            bitmap_index.add_items(new_items)
+        usage.save()
+        instances = {}
+        for obj, tag_names in batch:
+            instances.setdefault(obj.__class__, []).append(obj)
+        for model, objs in instances.items():
+            _sync_tag_fields(model, [obj.pk for obj in objs], objs)
 
+    def _get_or_create_tags(self, tag_parts):
+        """
+        Returns a dictionary mapping each of the given ``TagParts`` to its
+        ``Tag``. The missing tags are created with a multi-row ``INSERT``.
+
+        A tag which a concurrent transaction committed after this one
+        started is skipped by the ``INSERT``, but isn't visible to a plain
+        ``SELECT`` either under ``REPEATABLE READ`` isolation (MySQL's
+        default). Such tags are read with a locking read, which sees the
+        latest committed rows, or with ``get_or_create`` as a last resort.
+
+        The tags are always looked up in the database rather than in the tag
+        vocabulary cache, which may still know tags that were rolled back or
+        deleted by another process.
+        """
+        tags = _get_tags_by_parts(tag_parts)
+        missing = [parts for parts in tag_parts if parts not in tags]
+        if len(missing):
+            _insert_rows(self.model._meta.db_table,
+                ('namespace', 'name', 'value'),
+                [(parts.namespace, parts.name, parts.value)
+                 for parts in missing], ignore_conflicts=True)
+            created = _get_tags_by_parts(missing)
+            missing = [parts for parts in missing if parts not in created]
+            if len(missing):
+                created.update(self._get_tags_for_update(missing))
+            for parts in missing:
+                if parts not in created:
+                    created[parts] = self.get_or_create(**parts)[0]
+            tags.update(created)
+            vocabulary.add_tags(created.values())
+        return tags
+
+    def _get_tags_for_update(self, tag_parts):
+        """
+        Returns a dictionary mapping the given ``TagParts`` to their
+        ``Tag``, read with a locking read. Missing tags are left out.
+        """
+        tag_parts = list(tag_parts)
+        tags = {}
+        cursor = connection.cursor()
+        for i in range(0, len(tag_parts), MAX_TAGS_PER_QUERY):
+            query = self.filter(_group_tag_lookups([dict(parts.items())
+                for parts in tag_parts[i:i + MAX_TAGS_PER_QUERY]])).order_by(
+                ).values_list('id', 'namespace', 'name', 'value').query
+            if getattr(query, 'get_compiler', None):
+                # Django 1.2+
+                sql, params = query.get_compiler(using='default').as_sql()
+            else:
+                # Django pre-1.2
+                sql, params = query.as_sql()
+            cursor.execute(sql + _get_locking_read_sql(), params)
+            for tag_id, namespace, name, value in cursor.fetchall():
+                tag = self.model(id=tag_id, namespace=namespace, name=name,
+                    value=value)
+                tags[tag.parts] = tag
+        return tags
+
+    @_commit_on_success
     def add_tag(self, obj, tag_name, default_namespace=None):
         """
         Associates the given object with a tag.
@@ -61,40 +468,105 @@ class TagManager(models.Manager):
         Accepts a ``default_namespace`` parameter that is assigned to a tag
         with no namespace specified.
         """
-        tag_names = parse_tag_input(tag_name,
-            default_namespace=default_namespace)
-        if not len(tag_names):
-            raise AttributeError(_('No tags were given: "%s".') % tag_name)
-        if len(tag_names) > 1:
-            raise AttributeError(_('Multiple tags were given: "%s".') % tag_name)
-        tag_name = tag_names[0]
-        if settings.FORCE_LOWERCASE_TAGS:
-            tag_name = tag_name.lower()
-        tag, created = self.get_or_create(**get_tag_parts(tag_name))
+        tag_parts = _parse_single_tag(tag_name, default_namespace)
+        _clear_prefetched_tags(obj)
+        _tags_changed()
+        buffer = get_active_buffer()
+        if buffer is not None:
+            buffer.add_tag(obj, tag_parts)
+            return
+        tag = self._get_or_create_tags([tag_parts])[tag_parts]
         ctype = ContentType.objects.get_for_model(obj)
-        TaggedItem._default_manager.get_or_create(
-            tag=tag, content_type=ctype, object_id=obj.pk)
+        inserted = _insert_rows(TaggedItem._meta.db_table,
+            ('tag_id', 'content_type_id', 'object_id'),
+            [(tag.pk, ctype.pk, obj.pk)], ignore_conflicts=True)
+        usage = _TagUsageChanges()
+        usage.add([(tag.pk, ctype.pk)], 1, inserted)
+        usage.save()
+        bitmap_index.add_items([(tag.pk, ctype.pk, obj.pk)])
+        _sync_tag_fields(obj.__class__, [obj.pk], [obj])
 
     def get_for_object(self, obj):
         """
         Create a queryset matching all tags associated with the given
         object.
+
+        If the tags of the object were retrieved by
+        ``tagging.generic.prefetch_tags``, a list of them is returned
+        instead, without querying the database.
         """
+        buffer = get_active_buffer()
+        if buffer is not None:
+            tags = buffer.get_tags(obj)
+            if tags is not None:
+                return self.filter(pk__in=[tag.pk for tag in tags])
+        tags = _get_prefetched_tags(obj)
+        if tags is not None:
+            return list(tags)
         ctype = ContentType.objects.get_for_model(obj)
         return self.filter(items__content_type__pk=ctype.pk,
                            items__object_id=obj.pk)
 
-    def _get_usage(self, model, counts=False, min_count=None, extra_joins=None, extra_criteria=None, params=None):
+    def _get_usage(self, model, counts=False, min_count=None, extra_joins=None, extra_criteria=None, params=None, num=None, font_size_sql=None):
         """
         Perform the custom SQL query for ``usage_for_model`` and
         ``usage_for_queryset``.
+
+        If ``num`` is given, only the ``num`` most used tags are returned.
+        If ``font_size_sql`` is given, it is a SQL expression of the tag's
+        count and its result is assigned as ``font_size`` attribute.
         """
-        if min_count is not None: counts = True
+        flush_active_buffer()
+        if min_count is not None or num is not None or font_size_sql:
+            counts = True
 
+        query, params = self._get_usage_sql(model, counts, min_count,
+            extra_joins, extra_criteria, params, num, font_size_sql)
+        cursor = connection.cursor()
+        cursor.execute(query, params)
+        tags = []
+        for row in cursor.fetchall():
+            t = self.model(*row[:4])
+            if counts:
+                t.count = row[4]
+            if font_size_sql and row[5] is not None:
+                t.font_size = row[5]
+            tags.append(t)
+        return tags
+
+    def _get_usage_sql(self, model, counts=False, min_count=None, extra_joins=None, extra_criteria=None, params=None, num=None, font_size_sql=None):
+        """
+        Build the SQL query and its parameters for ``_get_usage``.
+        """
         model_table = qn(model._meta.db_table)
         model_pk = '%s.%s' % (model_table, qn(model._meta.pk.column))
-        query = """
-        SELECT DISTINCT %(tag)s.id, %(tag)s.namespace, %(tag)s.name, %(tag)s.value%(count_sql)s
+        use_counts_table = settings.TAG_USAGE_COUNTS and \
+            not extra_joins and not extra_criteria
+        if use_counts_table:
+            count_sql = '%s.%s' % (qn(TagUsage._meta.db_table), qn('count'))
+        else:
+            count_sql = 'COUNT(%s)' % model_pk
+        select_sql = ''
+        if counts:
+            select_sql = ', %s AS %s' % (count_sql, qn('count'))
+        if font_size_sql:
+            select_sql += ', %s AS %s' % (font_size_sql % {'count': count_sql},
+                qn('font_size'))
+        if use_counts_table:
+            # The counts of unfiltered queries are kept up to date in the
+            # tag usage table.
+            query = """
+        SELECT %(tag)s.id, %(tag)s.namespace, %(tag)s.name, %(tag)s.value%(select_sql)s
+        FROM
+            %(tag)s
+            INNER JOIN %(tag_usage)s
+                ON %(tag)s.id = %(tag_usage)s.tag_id
+        WHERE %(tag_usage)s.content_type_id = %(content_type_id)s
+            AND %(count)s > 0
+            %%s"""
+        else:
+            query = """
+        SELECT DISTINCT %(tag)s.id, %(tag)s.namespace, %(tag)s.name, %(tag)s.value%(select_sql)s
         FROM
             %(tag)s
             INNER JOIN %(tagged_item)s
@@ -105,30 +577,65 @@ class TagManager(models.Manager):
         WHERE %(tagged_item)s.content_type_id = %(content_type_id)s
             %%s
         GROUP BY %(tag)s.id, %(tag)s.namespace, %(tag)s.name, %(tag)s.value
-        %%s
-        ORDER BY %(tag)s.namespace, %(tag)s.name, %(tag)s.value ASC""" % {
+        %%s"""
+        query = query % {
             'tag': qn(self.model._meta.db_table),
-            'count_sql': counts and (', COUNT(%s)' % model_pk) or '',
+            'select_sql': select_sql,
             'tagged_item': qn(TaggedItem._meta.db_table),
+            'tag_usage': qn(TagUsage._meta.db_table),
+            'count': count_sql,
             'model': model_table,
             'model_pk': model_pk,
             'content_type_id': ContentType.objects.get_for_model(model).pk,
         }
 
+        params = list(params or [])
         min_count_sql = ''
         if min_count is not None:
-            min_count_sql = 'HAVING COUNT(%s) >= %%s' % model_pk
+            if use_counts_table:
+                min_count_sql = 'AND %s >= %%s' % count_sql
+            else:
+                min_count_sql = 'HAVING %s >= %%s' % count_sql
             params.append(min_count)
+        if use_counts_table:
+            query = query % min_count_sql
+        else:
+            query = query % (extra_joins or '', extra_criteria or '',
+                             min_count_sql)
+
+        order_by = '%(tag)s.namespace, %(tag)s.name, %(tag)s.value ASC' % {
+            'tag': qn(self.model._meta.db_table)}
+        if num is None:
+            query += """
+        ORDER BY %s""" % order_by
+        else:
+            # Pick the most used tags first, then order them like all
+            # other usage queries.
+            query = """
+        SELECT * FROM (%s
+        ORDER BY %s DESC, %s
+        LIMIT %d) %s
+        ORDER BY %s ASC""" % (query, qn('count'), order_by, int(num),
+                qn('usage'), ', '.join([qn(column)
+                    for column in ('namespace', 'name', 'value')]))
+        return query, params
 
+    def _get_usage_bounds(self, model, min_count=None, extra_joins=None, extra_criteria=None, params=None, num=None):
+        """
+        Return the minimum and maximum count of the tags which would be
+        returned by ``_get_usage``, or ``(None, None)`` if there are none.
+        """
+        flush_active_buffer()
+        query, params = self._get_usage_sql(model, True, min_count,
+            extra_joins, extra_criteria, params, num)
+        query = 'SELECT MIN(%(count)s), MAX(%(count)s) FROM (%(query)s) %(bounds)s' % {
+            'count': qn('count'),
+            'query': query,
+            'bounds': qn('bounds'),
+        }
         cursor = connection.cursor()
-        cursor.execute(query % (extra_joins, extra_criteria, min_count_sql), params)
-        tags = []
-        for row in cursor.fetchall():
-            t = self.model(*row[:4])
-            if counts:
-                t.count = row[4]
-            tags.append(t)
-        return tags
+        cursor.execute(query, params)
+        return cursor.fetchone()
 
     def usage_for_model(self, model, counts=False, min_count=None, filters=None):
         """
@@ -170,7 +677,14 @@ class TagManager(models.Manager):
         greater than or equal to ``min_count`` will be returned.
         Passing a value for ``min_count`` implies ``counts=True``.
         """
+        extra_joins, extra_criteria, params = self._get_queryset_sql(queryset)
+        return self._get_usage(queryset.model, counts, min_count, extra_joins, extra_criteria, params)
 
+    def _get_queryset_sql(self, queryset):
+        """
+        Return the additional joins, criteria and parameters which restrict
+        the usage queries to the instances in ``queryset``.
+        """
         if getattr(queryset.query, 'get_compiler', None):
             # Django 1.2+
             compiler = queryset.query.get_compiler(using='default')
@@ -187,7 +701,7 @@ class TagManager(models.Manager):
             extra_criteria = 'AND %s' % where
         else:
             extra_criteria = ''
-        return self._get_usage(queryset.model, counts, min_count, extra_joins, extra_criteria, params)
+        return extra_joins, extra_criteria, params
 
     def related_for_model(self, tags, model, counts=False, min_count=None,
                           wildcard=None, default_namespace=None):
@@ -203,9 +717,14 @@ class TagManager(models.Manager):
         greater than or equal to ``min_count`` will be returned.
         Passing a value for ``min_count`` implies ``counts=True``.
         """
+        flush_active_buffer()
         if min_count is not None: counts = True
         tags = get_tag_list(tags,
             wildcard=wildcard, default_namespace=default_namespace)
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            return self._related_for_model_from_snapshot(snapshot, tags,
+                model, counts, min_count)
         tag_count = len(tags)
         tagged_item_table = qn(TaggedItem._meta.db_table)
         query = """
@@ -249,8 +768,33 @@ class TagManager(models.Manager):
             related.append(tag)
         return related
 
+    def _related_for_model_from_snapshot(self, snapshot, tags, model,
+                                         counts, min_count):
+        """
+        Answers ``related_for_model`` from a tag snapshot, which only needs
+        a query to fetch the related tags.
+        """
+        content_type = ContentType.objects.get_for_model(model)
+        tag_counts = snapshot.related_tags(content_type.pk,
+            [tag.pk for tag in tags])
+        if min_count is not None:
+            tag_counts = dict([(tag_id, count)
+                               for tag_id, count in tag_counts.items()
+                               if count >= min_count])
+        tag_ids = tag_counts.keys()
+        related = []
+        for i in range(0, len(tag_ids), MAX_TAGS_PER_QUERY):
+            related.extend(self.filter(
+                pk__in=tag_ids[i:i + MAX_TAGS_PER_QUERY]).order_by())
+        related.sort(key=lambda tag: (tag.name, tag.namespace, tag.value))
+        if counts is True:
+            for tag in related:
+                tag.count = tag_counts[tag.pk]
+        return related
+
     def cloud_for_model(self, model, steps=4, distribution=LOGARITHMIC,
-                        filters=None, min_count=None):
+                        filters=None, min_count=None, num=None,
+                        in_database=False):
         """
         Obtain a list of tags associated with instances of the given
         Model, giving each tag a ``count`` attribute indicating how
@@ -273,10 +817,38 @@ class TagManager(models.Manager):
         To limit the tags displayed in the cloud to those with a
         ``count`` greater than or equal to ``min_count``, pass a value
         for the ``min_count`` argument.
+
+        To limit the tags displayed in the cloud to the ``num`` most
+        used tags, pass a value for the ``num`` argument.
+
+        If ``in_database`` is True, the font sizes are calculated by the
+        database, so only the tags of the cloud are fetched and no
+        calculation is left to Python.
         """
-        tags = list(self.usage_for_model(model, counts=True, filters=filters,
-                                         min_count=min_count))
-        return calculate_cloud(tags, steps, distribution)
+        if filters is None: filters = {}
+
+        queryset = model._default_manager.filter()
+        for f in filters.items():
+            queryset.query.add_filter(f)
+        extra_joins, extra_criteria, params = self._get_queryset_sql(queryset)
+
+        if not in_database:
+            tags = self._get_usage(model, True, min_count, extra_joins,
+                extra_criteria, params, num)
+            return calculate_cloud(tags, steps, distribution)
+
+        min_weight, max_weight = self._get_usage_bounds(model, min_count,
+            extra_joins, extra_criteria, params, num)
+        if max_weight is None:
+            return []
+        font_size_sql = ['CASE']
+        for font_size, max_count in enumerate(calculate_cloud_count_thresholds(
+                min_weight, max_weight, steps, distribution)):
+            font_size_sql.append('WHEN %%(count)s <= %d THEN %d' % (
+                max_count, font_size + 1))
+        font_size_sql.append('END')
+        return self._get_usage(model, True, min_count, extra_joins,
+            extra_criteria, params, num, ' '.join(font_size_sql))
 
 class TaggedItemManager(models.Manager):
     """
@@ -284,9 +856,10 @@ class TaggedItemManager(models.Manager):
           SQL clauses required by many of this manager's methods into
           Django's ORM.
 
-          For now, we manually execute a query to retrieve the PKs of
-          objects we're interested in, then use the ORM's ``__in``
-          lookup to return a ``QuerySet``.
+          For now, the queries are added to the returned ``QuerySet`` as
+          subqueries using ``extra``, or, where the results must be ordered
+          by them, we manually execute a query to retrieve the PKs of
+          objects we're interested in.
 
           Now that the queryset-refactor branch is in the trunk, this can be
           tidied up significantly.
@@ -299,22 +872,24 @@ class TaggedItemManager(models.Manager):
 
         The ``wildcard`` and the ``default_namespace`` parameters are
         allowed. For more details see the ``get_tag_list`` function.
+
+        The query is chosen by the number of tagged items of each tag, see
+        ``explain_by_model``.
         """
-        tags = get_tag_list(tags,
+        flush_active_buffer()
+        queryset, model = get_queryset_and_model(queryset_or_model)
+        plan = self.explain_by_model(model, tags,
             wildcard=wildcard, default_namespace=default_namespace)
-        tag_count = len(tags)
-        if tag_count == 0:
-            # No existing tags were given
-            queryset, model = get_queryset_and_model(queryset_or_model)
+        if plan.strategy == 'empty':
             return model._default_manager.none()
-        elif tag_count == 1:
-            # Optimisation for single tag - fall through to the simpler
-            # query below.
-            tag = tags[0]
-        else:
-            return self.get_intersection_by_model(queryset_or_model, tags)
+        elif plan.strategy in ('bitmap', 'snapshot'):
+            return queryset.filter(pk__in=plan.object_ids)
+        elif plan.strategy == 'exists':
+            return self._get_by_model_with_exists(queryset, plan.tags)
+        elif plan.strategy == 'group_by':
+            return self._get_by_model_with_group_by(queryset, plan.tags)
 
-        queryset, model = get_queryset_and_model(queryset_or_model)
+        tag = plan.tags[0]
         content_type = ContentType.objects.get_for_model(model)
         opts = self.model._meta
         tagged_item_table = qn(opts.db_table)
@@ -330,6 +905,53 @@ class TaggedItemManager(models.Manager):
             params=[content_type.pk, tag.pk],
         )
 
+    def explain_by_model(self, queryset_or_model, tags,
+                         wildcard=None, default_namespace=None):
+        """
+        Returns the ``TagQueryPlan`` which ``get_by_model`` uses for the
+        given arguments.
+        """
+        tags = get_tag_list(tags,
+            wildcard=wildcard, default_namespace=default_namespace)
+        queryset, model = get_queryset_and_model(queryset_or_model)
+        return plan_query(list(tags), ContentType.objects.get_for_model(model))
+
+    def _get_by_model_with_exists(self, queryset, tags):
+        """
+        Create a ``QuerySet`` of the instances in ``queryset`` which have all
+        of the given tags, reading the tagged items of the first tag and
+        checking the others with ``EXISTS`` subqueries in the given order.
+        """
+        model = queryset.model
+        tagged_item_table = qn(self.model._meta.db_table)
+        exists_sql = """
+              AND EXISTS (
+                  SELECT 1
+                  FROM %(tagged_item)s %(alias)s
+                  WHERE %(alias)s.content_type_id = %(first)s.content_type_id
+                    AND %(alias)s.object_id = %(first)s.object_id
+                    AND %(alias)s.tag_id = %%s
+              )"""
+        where = """%(model_pk)s IN (
+            SELECT %(first)s.object_id
+            FROM %(tagged_item)s %(first)s
+            WHERE %(first)s.content_type_id = %%s
+              AND %(first)s.tag_id = %%s%(exists)s
+        )""" % {
+            'model_pk': '%s.%s' % (qn(model._meta.db_table),
+                                   qn(model._meta.pk.column)),
+            'tagged_item': tagged_item_table,
+            'first': qn('first_item'),
+            'exists': ''.join([exists_sql % {
+                'tagged_item': tagged_item_table,
+                'alias': qn('item_%d' % i),
+                'first': qn('first_item'),
+            } for i in range(1, len(tags))]),
+        }
+        content_type = ContentType.objects.get_for_model(model)
+        return queryset.extra(where=[where],
+            params=[content_type.pk] + [tag.pk for tag in tags])
+
     def get_intersection_by_model(self, queryset_or_model, tags,
                                   wildcard=None, default_namespace=None):
         """
@@ -339,6 +961,7 @@ class TaggedItemManager(models.Manager):
         The ``wildcard`` and the ``default_namespace`` parameters are
         allowed. For more details see the ``get_tag_list`` function.
         """
+        flush_active_buffer()
         tags = get_tag_list(tags,
             wildcard=wildcard, default_namespace=default_namespace)
         tag_count = len(tags)
@@ -347,32 +970,40 @@ class TaggedItemManager(models.Manager):
         if not tag_count:
             return model._default_manager.none()
 
-        model_table = qn(model._meta.db_table)
-        # This query selects the ids of all objects which have all the
-        # given tags.
-        query = """
-        SELECT %(model_pk)s
-        FROM %(model)s, %(tagged_item)s
-        WHERE %(tagged_item)s.content_type_id = %(content_type_id)s
-          AND %(tagged_item)s.tag_id IN (%(tag_id_placeholders)s)
-          AND %(model_pk)s = %(tagged_item)s.object_id
-        GROUP BY %(model_pk)s
-        HAVING COUNT(%(model_pk)s) = %(tag_count)s""" % {
-            'model_pk': '%s.%s' % (model_table, qn(model._meta.pk.column)),
-            'model': model_table,
+        if bitmap_index.enabled or get_snapshot() is not None:
+            plan = plan_query(tags, ContentType.objects.get_for_model(model))
+            if plan.strategy == 'empty':
+                return model._default_manager.none()
+            elif plan.strategy in ('bitmap', 'snapshot'):
+                return queryset.filter(pk__in=plan.object_ids)
+        return self._get_by_model_with_group_by(queryset, tags)
+
+    def _get_by_model_with_group_by(self, queryset, tags):
+        """
+        Create a ``QuerySet`` of the instances in ``queryset`` which have all
+        of the given tags, grouping their tagged items by object.
+        """
+        model = queryset.model
+        tag_ids = list(set([tag.pk for tag in tags]))
+        content_type = ContentType.objects.get_for_model(model)
+        # This subquery selects the ids of all objects which have all the
+        # given tags. It is evaluated together with the returned queryset.
+        where = """%(model_pk)s IN (
+            SELECT object_id
+            FROM %(tagged_item)s
+            WHERE content_type_id = %%s
+              AND tag_id IN (%(tag_id_placeholders)s)
+            GROUP BY object_id
+            HAVING COUNT(tag_id) = %(tag_count)s
+        )""" % {
+            'model_pk': '%s.%s' % (qn(model._meta.db_table),
+                                   qn(model._meta.pk.column)),
             'tagged_item': qn(self.model._meta.db_table),
-            'content_type_id': ContentType.objects.get_for_model(model).pk,
-            'tag_id_placeholders': ','.join(['%s'] * tag_count),
-            'tag_count': tag_count,
+            'tag_id_placeholders': ','.join(['%s'] * len(tag_ids)),
+            'tag_count': len(tag_ids),
         }
-
-        cursor = connection.cursor()
-        cursor.execute(query, [tag.pk for tag in tags])
-        object_ids = [row[0] for row in cursor.fetchall()]
-        if len(object_ids) > 0:
-            return queryset.filter(pk__in=object_ids)
-        else:
-            return model._default_manager.none()
+        return queryset.extra(where=[where],
+                              params=[content_type.pk] + tag_ids)
 
     def get_union_by_model(self, queryset_or_model, tags,
                            wildcard=None, default_namespace=None):
@@ -383,6 +1014,7 @@ class TaggedItemManager(models.Manager):
         The ``wildcard`` and the ``default_namespace`` parameters are
         allowed. For more details see the ``get_tag_list`` function.
         """
+        flush_active_buffer()
         tags = get_tag_list(tags,
             wildcard=wildcard, default_namespace=default_namespace)
         tag_count = len(tags)
@@ -391,30 +1023,129 @@ class TaggedItemManager(models.Manager):
         if not tag_count:
             return model._default_manager.none()
 
-        model_table = qn(model._meta.db_table)
-        # This query selects the ids of all objects which have any of
-        # the given tags.
+        tag_ids = list(set([tag.pk for tag in tags]))
+        content_type = ContentType.objects.get_for_model(model)
+        bitmaps = bitmap_index.get_bitmaps(content_type.pk)
+        if bitmaps is not None:
+            object_ids = unite([bitmaps[tag_id] for tag_id in tag_ids
+                                if tag_id in bitmaps])
+            if not object_ids:
+                return model._default_manager.none()
+            elif len(object_ids) <= BITMAP_MAX_IDS:
+                return queryset.filter(pk__in=list(object_ids))
+        # This subquery selects the ids of all objects which have any of
+        # the given tags. It is evaluated together with the returned
+        # queryset.
+        where = """%(model_pk)s IN (
+            SELECT object_id
+            FROM %(tagged_item)s
+            WHERE content_type_id = %%s
+              AND tag_id IN (%(tag_id_placeholders)s)
+        )""" % {
+            'model_pk': '%s.%s' % (qn(model._meta.db_table),
+                                   qn(model._meta.pk.column)),
+            'tagged_item': qn(self.model._meta.db_table),
+            'tag_id_placeholders': ','.join(['%s'] * len(tag_ids)),
+        }
+        return queryset.extra(where=[where],
+                              params=[content_type.pk] + tag_ids)
+
+    @_commit_on_success
+    def tag_queryset(self, queryset, tag, default_namespace=None):
+        """
+        Associates all instances in ``queryset`` with a tag, which is
+        created if it doesn't exist yet. ``tag`` is a ``Tag`` object or a
+        tag string, which is validated like by ``Tag.objects.add_tag``.
+
+        The tagged items are inserted with a single ``INSERT ... SELECT``
+        statement, which skips the instances already having the tag.
+        Returns the number of tagged items created.
+        """
+        flush_active_buffer()
+        if not isinstance(tag, Tag):
+            tag_parts = _parse_single_tag(tag, default_namespace)
+            tag = Tag._default_manager._get_or_create_tags(
+                [tag_parts])[tag_parts]
+        content_type = ContentType.objects.get_for_model(queryset.model)
+        if _has_denormalized_tag_fields(queryset.model):
+            object_ids = list(queryset.values_list('pk', flat=True))
+        subquery, params = _get_pk_subquery_sql(queryset)
+        insert_sql, conflict_sql = _get_insert_sql(ignore_conflicts=True)
         query = """
-        SELECT %(model_pk)s
-        FROM %(model)s, %(tagged_item)s
-        WHERE %(tagged_item)s.content_type_id = %(content_type_id)s
-          AND %(tagged_item)s.tag_id IN (%(tag_id_placeholders)s)
-          AND %(model_pk)s = %(tagged_item)s.object_id
-        GROUP BY %(model_pk)s""" % {
-            'model_pk': '%s.%s' % (model_table, qn(model._meta.pk.column)),
-            'model': model_table,
+        %(insert)s INTO %(tagged_item)s (tag_id, content_type_id, object_id)
+        SELECT %%s, %%s, %(pk)s
+        FROM (%(subquery)s) %(objects)s
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM %(tagged_item)s
+            WHERE tag_id = %%s
+              AND content_type_id = %%s
+              AND object_id = %(objects)s.%(pk)s
+        )%(conflict)s""" % {
+            'insert': insert_sql,
             'tagged_item': qn(self.model._meta.db_table),
-            'content_type_id': ContentType.objects.get_for_model(model).pk,
-            'tag_id_placeholders': ','.join(['%s'] * tag_count),
+            'pk': qn(queryset.model._meta.pk.column),
+            'subquery': subquery,
+            'objects': qn('objects'),
+            'conflict': conflict_sql,
         }
+        cursor = connection.cursor()
+        cursor.execute(query, [tag.pk, content_type.pk] + list(params) +
+                       [tag.pk, content_type.pk])
+        transaction.commit_unless_managed()
+        _tags_changed()
+        inserted = cursor.rowcount
+        usage = _TagUsageChanges()
+        usage.add([(tag.pk, content_type.pk)], inserted)
+        usage.save()
+        if inserted:
+            # The tagged objects aren't known, so the bitmaps are loaded again.
+            bitmap_index.clear(content_type.pk)
+            if _has_denormalized_tag_fields(queryset.model):
+                _sync_tag_fields(queryset.model, object_ids)
+        return inserted
 
+    @_commit_on_success
+    def untag_queryset(self, queryset, tag, default_namespace=None):
+        """
+        Removes a tag from all instances in ``queryset``. ``tag`` is a
+        ``Tag`` object or a tag string, which is validated like by
+        ``Tag.objects.add_tag``.
+
+        The tagged items are removed with a single ``DELETE`` statement.
+        Returns the number of tagged items deleted.
+        """
+        flush_active_buffer()
+        if not isinstance(tag, Tag):
+            tag_parts = _parse_single_tag(tag, default_namespace)
+            tag = get_tags_in_bulk([tag_parts])[tag_parts]
+            if tag is None:
+                return 0
+        content_type = ContentType.objects.get_for_model(queryset.model)
+        if _has_denormalized_tag_fields(queryset.model):
+            object_ids = list(queryset.values_list('pk', flat=True))
+        subquery, params = _get_pk_subquery_sql(queryset)
+        query = """
+        DELETE FROM %(tagged_item)s
+        WHERE tag_id = %%s
+          AND content_type_id = %%s
+          AND object_id IN (%(subquery)s)""" % {
+            'tagged_item': qn(self.model._meta.db_table),
+            'subquery': subquery,
+        }
         cursor = connection.cursor()
-        cursor.execute(query, [tag.pk for tag in tags])
-        object_ids = [row[0] for row in cursor.fetchall()]
-        if len(object_ids) > 0:
-            return queryset.filter(pk__in=object_ids)
-        else:
-            return model._default_manager.none()
+        cursor.execute(query, [tag.pk, content_type.pk] + list(params))
+        transaction.commit_unless_managed()
+        _tags_changed()
+        deleted = cursor.rowcount
+        usage = _TagUsageChanges()
+        usage.add([(tag.pk, content_type.pk)], -deleted)
+        usage.save()
+        if deleted:
+            bitmap_index.clear(content_type.pk)
+            if _has_denormalized_tag_fields(queryset.model):
+                _sync_tag_fields(queryset.model, object_ids)
+        return deleted
 
     def get_related(self, obj, queryset_or_model, num=None):
         """
@@ -425,10 +1156,18 @@ class TaggedItemManager(models.Manager):
         If ``num`` is given, a maximum of ``num`` instances will be
         returned.
         """
+        flush_active_buffer()
         queryset, model = get_queryset_and_model(queryset_or_model)
         model_table = qn(model._meta.db_table)
         content_type = ContentType.objects.get_for_model(obj)
         related_content_type = ContentType.objects.get_for_model(model)
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            object_ids = snapshot.related_objects(content_type.pk, obj.pk,
+                related_content_type.pk, num=num)
+            object_dict = queryset.in_bulk(object_ids)
+            return [object_dict[object_id] for object_id in object_ids \
+                    if object_id in object_dict]
         query = """
         SELECT %(model_pk)s, COUNT(related_tagged_item.object_id) AS %(count)s
         FROM %(model)s, %(tagged_item)s, %(tag)s, %(tagged_item)s related_tagged_item
@@ -496,12 +1235,11 @@ class Tag(models.Model):
         verbose_name_plural = _('tags')
 
     def __unicode__(self):
-        name = normalize_tag_part(self.name)
-        if self.namespace:
-            name = '%s:%s' % (normalize_tag_part(self.namespace), name)
-        if self.value:
-            name = '%s=%s' % (name, normalize_tag_part(self.value))
-        return name
+        return unicode(self.parts)
+
+    def _get_parts(self):
+        return TagParts(self.namespace, self.name, self.value)
+    parts = property(_get_parts)
 
 class TaggedItem(models.Model):
     """
@@ -522,3 +1260,157 @@ class TaggedItem(models.Model):
 
     def __unicode__(self):
         return u'%s [%s]' % (self.object, self.tag)
+
+class TagUsageManager(models.Manager):
+    def update_counts(self, deltas, recount=()):
+        """
+        Adds the changes in ``deltas``, a dictionary mapping
+        ``(tag_id, content_type_id)`` pairs to numbers, to the usage counts.
+        The counts of the pairs in ``recount`` are counted again from the
+        tagged items instead.
+        """
+        table = self.model._meta.db_table
+        recount = list(recount)
+        recount.sort()
+        deltas = [(key, delta) for key, delta in deltas.items()
+                  if delta and key not in recount]
+        new_keys = set([key for key, delta in deltas if delta > 0])
+        new_keys.update(recount)
+        if len(new_keys):
+            _insert_rows(table, ('tag_id', 'content_type_id', 'count'),
+                [(tag_id, ctype_id, 0) for tag_id, ctype_id in new_keys],
+                ignore_conflicts=True)
+        tag_ids = {}
+        for (tag_id, ctype_id), delta in deltas:
+            tag_ids.setdefault((ctype_id, delta), []).append(tag_id)
+        keys = tag_ids.keys()
+        keys.sort()
+        cursor = connection.cursor()
+        for ctype_id, delta in keys:
+            ids = tag_ids[(ctype_id, delta)]
+            ids.sort()
+            for i in range(0, len(ids), MAX_TAGS_PER_QUERY):
+                chunk = ids[i:i + MAX_TAGS_PER_QUERY]
+                cursor.execute('UPDATE %(tag_usage)s SET %(count)s = %(count)s + %%s WHERE content_type_id = %%s AND tag_id IN (%(tag_ids)s)' % {
+                    'tag_usage': qn(table),
+                    'count': qn('count'),
+                    'tag_ids': ', '.join(['%s'] * len(chunk)),
+                }, [delta, ctype_id] + chunk)
+        for tag_id, ctype_id in recount:
+            cursor.execute("""
+            UPDATE %(tag_usage)s SET %(count)s = (
+                SELECT COUNT(*)
+                FROM %(tagged_item)s
+                WHERE tag_id = %%s AND content_type_id = %%s
+            )
+            WHERE tag_id = %%s AND content_type_id = %%s""" % {
+                'tag_usage': qn(table),
+                'count': qn('count'),
+                'tagged_item': qn(TaggedItem._meta.db_table),
+            }, [tag_id, ctype_id, tag_id, ctype_id])
+        transaction.commit_unless_managed()
+
+    @_commit_on_success
+    def rebuild(self):
+        """
+        Counts all tagged items again.
+        """
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s' % qn(self.model._meta.db_table))
+        cursor.execute("""
+        INSERT INTO %(tag_usage)s (tag_id, content_type_id, %(count)s)
+        SELECT tag_id, content_type_id, COUNT(*)
+        FROM %(tagged_item)s
+        GROUP BY tag_id, content_type_id""" % {
+            'tag_usage': qn(self.model._meta.db_table),
+            'count': qn('count'),
+            'tagged_item': qn(TaggedItem._meta.db_table),
+        })
+        transaction.commit_unless_managed()
+
+class TagUsage(models.Model):
+    """
+    The number of tagged items of a tag for a content type, which is kept
+    up to date if the ``TAG_USAGE_COUNTS`` setting is enabled.
+    """
+    tag          = models.ForeignKey(Tag, verbose_name=_('tag'), related_name='usage')
+    content_type = models.ForeignKey(ContentType, verbose_name=_('content type'))
+    count        = models.IntegerField(_('count'), default=0)
+
+    objects = TagUsageManager()
+
+    class Meta:
+        unique_together = (('tag', 'content_type'),)
+        verbose_name = _('tag usage')
+        verbose_name_plural = _('tag usage')
+
+    def __unicode__(self):
+        return u'%s [%s]: %s' % (self.tag, self.content_type, self.count)
+
+class _TagUsageChanges(object):
+    """
+    Collects the changes of the usage counts made by writing tagged items,
+    and saves them if the ``TAG_USAGE_COUNTS`` setting is enabled.
+    """
+    def __init__(self):
+        self.deltas = {}
+        self.recount = set()
+
+    def add(self, keys, delta, affected=None):
+        """
+        Adds ``delta`` to the count of each ``(tag_id, content_type_id)``
+        pair in ``keys``. If ``affected``, the number of rows the statement
+        changed, doesn't match the number of keys, some rows were skipped
+        and the pairs are recounted.
+        """
+        if affected is not None and affected != len(keys):
+            self.recount.update(keys)
+            return
+        for key in keys:
+            self.deltas[key] = self.deltas.get(key, 0) + delta
+
+    def save(self):
+        """
+        Writes the collected changes to the ``TagUsage`` table.
+        """
+        if settings.TAG_USAGE_COUNTS and (self.deltas or self.recount):
+            TagUsage._default_manager.update_counts(self.deltas, self.recount)
+
+def _sync_tagged_item_fields(tagged_item):
+    model = ContentType.objects.get_for_id(
+        tagged_item.content_type_id).model_class()
+    if model is not None:
+        _sync_tag_fields(model, [tagged_item.object_id])
+
+def _tagged_item_saved(sender, instance, created=False, **kwargs):
+    if created:
+        usage = _TagUsageChanges()
+        usage.add([(instance.tag_id, instance.content_type_id)], 1)
+        usage.save()
+    _sync_tagged_item_fields(instance)
+
+def _tagged_item_deleted(sender, instance, **kwargs):
+    usage = _TagUsageChanges()
+    usage.add([(instance.tag_id, instance.content_type_id)], -1)
+    usage.save()
+    _sync_tagged_item_fields(instance)
+
+# Keep the usage counts and denormalized tag fields up to date with tagged
+# items saved by the ORM.
+models.signals.post_save.connect(_tagged_item_saved, sender=TaggedItem)
+models.signals.post_delete.connect(_tagged_item_deleted, sender=TaggedItem)
+
+# Discard the tags shared by model instances when tags or tagged items are
+# saved by the ORM.
+models.signals.post_save.connect(_tags_changed, sender=TaggedItem)
+models.signals.post_delete.connect(_tags_changed, sender=TaggedItem)
+models.signals.post_save.connect(_tags_changed, sender=Tag)
+models.signals.post_delete.connect(_tags_changed, sender=Tag)
+
+# Keep the bitmap index up to date with tagged items saved by the ORM.
+models.signals.post_save.connect(bitmap_index.item_saved, sender=TaggedItem)
+models.signals.post_delete.connect(bitmap_index.item_deleted, sender=TaggedItem)
+
+# Keep the tag vocabulary cache up to date with the tags of this process.
+models.signals.post_save.connect(vocabulary.tag_saved, sender=Tag)
+models.signals.post_delete.connect(vocabulary.tag_deleted, sender=Tag)
@@ -0,0 +1,155 @@
+"""
+Chooses how to query the objects which have all of a list of tags.
+"""
+import time
+
+from django.db import connection
+
+from tagging import settings
+from tagging.bitmap import BITMAP_MAX_IDS, Bitmap, bitmap_index, intersect
+from tagging.snapshot import get_snapshot
+from tagging.utils import LRUCache
+
+qn = connection.ops.quote_name
+
+# The estimated cost of looking up a single tagged item by its tag,
+# content type and object id, relative to reading one tagged item of a tag.
+EXISTS_PROBE_COST = 3
+
+# Caches the number of tagged items of ``(tag_id, content_type_id)`` pairs
+# as ``(count, time)`` tuples, when the ``TagUsage`` table isn't enabled.
+tag_statistics = LRUCache(10000)
+
+def get_tag_counts(tags, content_type):
+    """
+    Returns a dictionary mapping the ids of the given tags to their number
+    of tagged items for ``content_type``, and whether the counts are exact.
+
+    The counts are read from the ``TagUsage`` table if the
+    ``TAG_USAGE_COUNTS`` setting is enabled. Otherwise they are counted and
+    cached for ``TAG_STATISTICS_TIMEOUT`` seconds.
+    """
+    from tagging.models import TaggedItem, TagUsage
+    tag_ids = [tag.pk for tag in tags]
+    counts = dict([(tag_id, 0) for tag_id in tag_ids])
+    if settings.TAG_USAGE_COUNTS:
+        for tag_id, count in TagUsage._default_manager.filter(
+                content_type__pk=content_type.pk,
+                tag__in=tag_ids).values_list('tag', 'count'):
+            counts[tag_id] = count
+        return counts, True
+
+    now = time.time()
+    missing = []
+    for tag_id in tag_ids:
+        cached = tag_statistics.get((tag_id, content_type.pk))
+        if cached is None or now - cached[1] > settings.TAG_STATISTICS_TIMEOUT:
+            missing.append(tag_id)
+        else:
+            counts[tag_id] = cached[0]
+    if len(missing):
+        cursor = connection.cursor()
+        cursor.execute("""
+        SELECT tag_id, COUNT(*)
+        FROM %s
+        WHERE content_type_id = %%s
+          AND tag_id IN (%s)
+        GROUP BY tag_id""" % (qn(TaggedItem._meta.db_table),
+                              ', '.join(['%s'] * len(missing))),
+            [content_type.pk] + missing)
+        for tag_id, count in cursor.fetchall():
+            counts[tag_id] = count
+        for tag_id in missing:
+            tag_statistics.set((tag_id, content_type.pk), (counts[tag_id], now))
+    return counts, False
+
+class TagQueryPlan(object):
+    """
+    The strategy chosen to query the objects which have all of the given
+    tags, for debugging.
+
+    ``strategy`` is one of:
+
+    * ``'empty'`` -- no tags were given, or one of them is known to be
+      unused, so no query is needed.
+    * ``'single'`` -- a single tag is looked up with a join.
+    * ``'exists'`` -- the tagged items of the rarest tag are read, and each
+      of the other tags is checked with an ``EXISTS`` subquery.
+    * ``'group_by'`` -- the tagged items of all tags are read and grouped
+      by object, keeping the objects which have all tags.
+    * ``'bitmap'`` -- the objects were found in the bitmap index, and
+      ``object_ids`` is the list of their ids.
+    * ``'snapshot'`` -- the objects were found in the tag snapshot, and
+      ``object_ids`` is the list of their ids.
+
+    ``tags`` are ordered from the rarest to the most common tag, ``counts``
+    maps their ids to the number of tagged items and ``costs`` maps the
+    considered strategies to their estimated costs.
+    """
+    def __init__(self, strategy, tags, counts=None, costs=None,
+                 object_ids=None):
+        self.strategy = strategy
+        self.tags = tags
+        self.counts = counts or {}
+        self.costs = costs or {}
+        self.object_ids = object_ids
+
+    def __repr__(self):
+        return '<TagQueryPlan: %s %s>' % (self.strategy, ' '.join([
+            '%s(%s)' % (tag, self.counts.get(tag.pk, '?'))
+            for tag in self.tags]))
+
+def plan_query(tags, content_type):
+    """
+    Returns the ``TagQueryPlan`` for querying the objects of
+    ``content_type`` which have all of the given tags.
+
+    If the ``TAG_BITMAP_INDEX`` setting is enabled, or else if a tag
+    snapshot is available, the objects are found there, and only queried
+    with SQL if there are more than ``BITMAP_MAX_IDS`` of them.
+    """
+    tags = dict([(tag.pk, tag) for tag in tags]).values()
+    if len(tags) == 0:
+        return TagQueryPlan('empty', tags)
+
+    bitmaps = bitmap_index.get_bitmaps(content_type.pk)
+    snapshot = bitmaps is None and get_snapshot() or None
+    if bitmaps is not None or snapshot is not None:
+        if bitmaps is not None:
+            strategy = 'bitmap'
+            tag_bitmaps = [bitmaps.get(tag.pk, Bitmap()) for tag in tags]
+            counts = dict([(tag.pk, len(bitmap))
+                           for tag, bitmap in zip(tags, tag_bitmaps)])
+            object_ids = intersect(tag_bitmaps)
+        else:
+            strategy = 'snapshot'
+            counts = dict([(tag.pk, snapshot.get_tag_count(content_type.pk,
+                                                           tag.pk))
+                           for tag in tags])
+            object_ids = snapshot.intersection(content_type.pk, counts.keys())
+        tags.sort(key=lambda tag: (counts[tag.pk], tag.pk))
+        if not object_ids:
+            return TagQueryPlan('empty', tags, counts)
+        elif len(object_ids) <= BITMAP_MAX_IDS:
+            return TagQueryPlan(strategy, tags, counts,
+                object_ids=list(object_ids))
+        exact = True
+    elif len(tags) == 1:
+        return TagQueryPlan('single', tags)
+    else:
+        counts, exact = get_tag_counts(tags, content_type)
+        tags.sort(key=lambda tag: (counts[tag.pk], tag.pk))
+    if len(tags) == 1:
+        return TagQueryPlan('single', tags, counts)
+    rarest_count = counts[tags[0].pk]
+    if exact and rarest_count == 0:
+        return TagQueryPlan('empty', tags, counts)
+    costs = {
+        'exists': rarest_count * (1 + (len(tags) - 1) * EXISTS_PROBE_COST),
+        'group_by': sum(counts.values()),
+    }
+    if costs['exists'] < costs['group_by']:
+        strategy = 'exists'
+    else:
+        strategy = 'group_by'
+    return TagQueryPlan(strategy, tags, counts, costs)
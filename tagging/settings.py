@@ -23,3 +23,40 @@ if MAX_TAG_VALUE_LENGTH is None or MAX_TAG_VALUE_LENGTH > 50:
 # Whether to force all tags to lowercase before they are saved to the
 # database.
 FORCE_LOWERCASE_TAGS = getattr(settings, 'FORCE_LOWERCASE_TAGS', False)
+
+# The number of results of the tag parsing functions in ``tagging.utils``
+# which are kept in memory. Caching is disabled if this is ``0`` or ``None``.
+TAG_PARSE_CACHE_SIZE = getattr(settings, 'TAG_PARSE_CACHE_SIZE', 0)
+
+# Whether every process keeps all tags in memory to look them up without
+# querying the database.
+TAG_VOCABULARY_CACHE = getattr(settings, 'TAG_VOCABULARY_CACHE', False)
+
+# The number of seconds after which the tags kept in memory are reloaded
+# from the database, to pick up changes made by other processes.
+TAG_VOCABULARY_CACHE_TIMEOUT = getattr(settings, 'TAG_VOCABULARY_CACHE_TIMEOUT', 300)
+
+# Whether the number of tagged items of each tag and content type is kept
+# up to date in the ``TagUsage`` table, which answers unfiltered usage
+# queries.
+TAG_USAGE_COUNTS = getattr(settings, 'TAG_USAGE_COUNTS', False)
+
+# The number of seconds for which the number of tagged items of each tag is
+# cached to plan queries, if ``TAG_USAGE_COUNTS`` is disabled.
+TAG_STATISTICS_TIMEOUT = getattr(settings, 'TAG_STATISTICS_TIMEOUT', 300)
+
+# Whether every process keeps the ids of the objects tagged with each tag
+# in memory as compressed bitmaps, to answer tag queries without SQL.
+TAG_BITMAP_INDEX = getattr(settings, 'TAG_BITMAP_INDEX', False)
+
+# The number of seconds after which the bitmaps of a content type are
+# loaded again, to pick up changes made by other processes.
+TAG_BITMAP_INDEX_TIMEOUT = getattr(settings, 'TAG_BITMAP_INDEX_TIMEOUT', 300)
+
+# The path of the tag snapshot written by the ``export_tag_snapshot``
+# management command, which answers related tag, related object and
+# intersection queries if it exists.
+TAG_SNAPSHOT_PATH = getattr(settings, 'TAG_SNAPSHOT_PATH', None)
+
+# The number of seconds after which a tag snapshot is too old to be used.
+TAG_SNAPSHOT_MAX_AGE = getattr(settings, 'TAG_SNAPSHOT_MAX_AGE', 600)
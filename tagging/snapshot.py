@@ -0,0 +1,320 @@
+"""
+Read-only snapshots of the tagged items, stored as compressed sparse row
+(CSR) arrays in a single file which processes share by memory-mapping it.
+"""
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_left
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from django.utils import simplejson
+
+from tagging import settings
+
+# The file starts with this magic string, followed by the offset and the
+# length of the JSON header which describes the sections of the file.
+MAGIC = 'TAGCSR01'
+_PREFIX = '<8sQQ'
+_PREFIX_SIZE = struct.calcsize(_PREFIX)
+
+# Sections are arrays of little-endian unsigned 32 bit integers, which are
+# written and read as arrays of the typecode with 4 byte items.
+_ITEM = '<I'
+if array('I').itemsize == 4:
+    _UINT32 = 'I'
+else:
+    _UINT32 = 'L'
+
+def _check_uint32():
+    assert array(_UINT32).itemsize == 4, \
+        'Tag snapshots need an array typecode of 4 byte unsigned integers.'
+
+# The sections stored for each content type. ``tags`` and ``objects`` are
+# the sorted ids of the tags and objects with tagged items, the rows of
+# ``tag_objects`` and ``object_tags`` start at the positions given by the
+# ``*_indptr`` sections.
+TAG_SECTIONS = ('tags', 'tag_indptr', 'tag_objects')
+OBJECT_SECTIONS = ('objects', 'object_indptr', 'object_tags')
+
+def _write_array(f, values):
+    if sys.byteorder != 'little':
+        values = array(_UINT32, values)
+        values.byteswap()
+    values.tofile(f)
+
+def _read_csr(key_column, value_column, chunk_size):
+    """
+    Yields the ``(content_type_id, keys, indptr, values)`` CSR arrays of
+    the tagged items of each content type, grouped by ``key_column``.
+    """
+    from django.db import connection
+    from tagging.models import TaggedItem
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.execute('SELECT content_type_id, %(key)s, %(value)s FROM %(tagged_item)s ORDER BY content_type_id, %(key)s, %(value)s' % {
+        'key': qn(key_column),
+        'value': qn(value_column),
+        'tagged_item': qn(TaggedItem._meta.db_table),
+    })
+    content_type_id = None
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not len(rows):
+            break
+        for row_content_type_id, key, value in rows:
+            if row_content_type_id != content_type_id:
+                if content_type_id is not None:
+                    indptr.append(len(values))
+                    yield content_type_id, keys, indptr, values
+                content_type_id = row_content_type_id
+                keys, indptr, values = (array(_UINT32), array(_UINT32),
+                                        array(_UINT32))
+            if not len(keys) or keys[-1] != key:
+                keys.append(key)
+                indptr.append(len(values))
+            values.append(value)
+    if content_type_id is not None:
+        indptr.append(len(values))
+        yield content_type_id, keys, indptr, values
+
+def write_snapshot(path, chunk_size=10000):
+    """
+    Writes a snapshot of all tagged items to the file at ``path``.
+
+    The snapshot is written to a temporary file first, which then replaces
+    the file at ``path``, so readers never see a partially written file.
+    """
+    _check_uint32()
+    created = time.time()
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    f = open(temp_path, 'wb')
+    try:
+        f.write(struct.pack(_PREFIX, MAGIC, 0, 0))
+        content_types = {}
+        for key_column, value_column, names in (
+                ('tag_id', 'object_id', TAG_SECTIONS),
+                ('object_id', 'tag_id', OBJECT_SECTIONS)):
+            for content_type_id, keys, indptr, values in _read_csr(
+                    key_column, value_column, chunk_size):
+                sections = content_types.setdefault(str(content_type_id), {})
+                for name, data in zip(names, (keys, indptr, values)):
+                    sections[name] = (f.tell(), len(data))
+                    _write_array(f, data)
+        header = simplejson.dumps({
+            'created': created,
+            'content_types': content_types,
+        })
+        offset = f.tell()
+        f.write(header)
+        f.seek(0)
+        f.write(struct.pack(_PREFIX, MAGIC, offset, len(header)))
+        f.close()
+        os.rename(temp_path, path)
+    except:
+        f.close()
+        os.remove(temp_path)
+        raise
+
+class _UIntView(object):
+    """
+    A read-only sequence of the integers in a section of a memory map,
+    which reads only the accessed integers.
+    """
+    def __init__(self, buffer, offset, length):
+        _check_uint32()
+        self.buffer = buffer
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.length)
+            values = array(_UINT32, self.buffer[
+                self.offset + start * 4:self.offset + stop * 4])
+            if sys.byteorder != 'little':
+                values.byteswap()
+            return values
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('index out of range')
+        offset = self.offset + index * 4
+        return struct.unpack(_ITEM, self.buffer[offset:offset + 4])[0]
+
+class TagSnapshot(object):
+    """
+    Reads a snapshot written by ``write_snapshot``. The file is
+    memory-mapped, so all processes reading it share its pages.
+    """
+    def __init__(self, path):
+        f = open(path, 'rb')
+        try:
+            stat = os.fstat(f.fileno())
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        self.path = path
+        self.file_id = (stat.st_dev, stat.st_ino, stat.st_mtime)
+        magic, offset, length = struct.unpack(_PREFIX,
+            self._mmap[:_PREFIX_SIZE])
+        if magic != MAGIC:
+            raise ValueError('%s is not a tag snapshot.' % path)
+        header = simplejson.loads(self._mmap[offset:offset + length])
+        self.created = header['created']
+        self._content_types = dict([(int(content_type_id), sections)
+            for content_type_id, sections in header['content_types'].items()])
+        self._sections = {}
+
+    def _get_section(self, content_type_id, name):
+        key = (content_type_id, name)
+        section = self._sections.get(key)
+        if section is None:
+            sections = self._content_types.get(content_type_id, {})
+            offset, length = sections.get(name, (0, 0))
+            if numpy is not None:
+                section = numpy.frombuffer(self._mmap, dtype='<u4',
+                    count=length, offset=offset)
+            else:
+                section = _UIntView(self._mmap, offset, length)
+            self._sections[key] = section
+        return section
+
+    def _find_row(self, content_type_id, names, key):
+        """
+        Returns the start and the end of the row of ``key`` in the values
+        section of ``names``.
+        """
+        keys, indptr = [self._get_section(content_type_id, name)
+                        for name in names[:2]]
+        if numpy is not None:
+            i = int(keys.searchsorted(key))
+        else:
+            i = bisect_left(keys, key)
+        if i == len(keys) or keys[i] != key:
+            return 0, 0
+        return int(indptr[i]), int(indptr[i + 1])
+
+    def _get_row(self, content_type_id, names, key):
+        start, end = self._find_row(content_type_id, names, key)
+        return self._get_section(content_type_id, names[2])[start:end].tolist()
+
+    def get_object_ids(self, content_type_id, tag_id):
+        """
+        Returns the sorted list of the ids of the objects of a content type
+        which have a tag.
+        """
+        return self._get_row(content_type_id, TAG_SECTIONS, tag_id)
+
+    def get_tag_ids(self, content_type_id, object_id):
+        """
+        Returns the sorted list of the ids of the tags of an object.
+        """
+        return self._get_row(content_type_id, OBJECT_SECTIONS, object_id)
+
+    def get_tag_count(self, content_type_id, tag_id):
+        """
+        Returns the number of objects of a content type which have a tag.
+        """
+        start, end = self._find_row(content_type_id, TAG_SECTIONS, tag_id)
+        return end - start
+
+    def intersection(self, content_type_id, tag_ids):
+        """
+        Returns the sorted list of the ids of the objects of a content type
+        which have all of the given tags.
+        """
+        tag_ids = list(tag_ids)
+        if not len(tag_ids):
+            return []
+        tag_ids.sort(key=lambda tag_id: self.get_tag_count(content_type_id,
+                                                           tag_id))
+        object_ids = set(self.get_object_ids(content_type_id, tag_ids[0]))
+        for tag_id in tag_ids[1:]:
+            if not len(object_ids):
+                break
+            object_ids.intersection_update(
+                self.get_object_ids(content_type_id, tag_id))
+        object_ids = list(object_ids)
+        object_ids.sort()
+        return object_ids
+
+    def related_tags(self, content_type_id, tag_ids):
+        """
+        Returns a dictionary mapping the ids of the tags used by the
+        objects of a content type which have all of the given tags, except
+        the given tags, to the number of those objects.
+        """
+        tag_ids = set(tag_ids)
+        counts = {}
+        for object_id in self.intersection(content_type_id, tag_ids):
+            for tag_id in self.get_tag_ids(content_type_id, object_id):
+                if tag_id not in tag_ids:
+                    counts[tag_id] = counts.get(tag_id, 0) + 1
+        return counts
+
+    def related_objects(self, content_type_id, object_id,
+                        related_content_type_id, num=None):
+        """
+        Returns the ids of the objects of ``related_content_type_id`` which
+        share tags with an object, ordered by the number of shared tags in
+        descending order. At most ``num`` ids are returned if it's given.
+        """
+        counts = {}
+        for tag_id in self.get_tag_ids(content_type_id, object_id):
+            for related_id in self.get_object_ids(related_content_type_id,
+                                                  tag_id):
+                counts[related_id] = counts.get(related_id, 0) + 1
+        if content_type_id == related_content_type_id:
+            counts.pop(object_id, None)
+        related = counts.items()
+        related.sort(key=lambda item: (-item[1], item[0]))
+        if num is not None:
+            related = related[:num]
+        return [related_id for related_id, count in related]
+
+_lock = threading.Lock()
+_snapshot = None
+
+def get_snapshot():
+    """
+    Returns the ``TagSnapshot`` of the file at ``TAG_SNAPSHOT_PATH``, or
+    ``None`` if there is no such file or it was written more than
+    ``TAG_SNAPSHOT_MAX_AGE`` seconds ago.
+
+    The file is opened again when it has been replaced.
+    """
+    global _snapshot
+    path = settings.TAG_SNAPSHOT_PATH
+    if not path:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    snapshot = _snapshot
+    if snapshot is None or snapshot.path != path or \
+            snapshot.file_id != (stat.st_dev, stat.st_ino, stat.st_mtime):
+        _lock.acquire()
+        try:
+            snapshot = _snapshot = TagSnapshot(path)
+        finally:
+            _lock.release()
+    max_age = settings.TAG_SNAPSHOT_MAX_AGE
+    if max_age is not None and time.time() - snapshot.created > max_age:
+        return None
+    return snapshot
@@ -60,3 +60,7 @@ class DefaultNamespaceTest2(models.Model):
 class DefaultNamespaceTest3(models.Model):
     foos = TagField('Foobars', namespace='foo')
     categories = TagField('Categories', namespace='category')
+
+class DenormalizedTest(models.Model):
+    tags = TagField('Tags', denormalized=True)
+    categories = TagField('Categories', namespace='category', denormalized=True)
@@ -1,18 +1,26 @@
 # -*- coding: utf-8 -*-
 
-import sys, os
+import sys, os, tempfile
 from django import forms
+from django.core.management import call_command
 from django.db import models
 from django.db.models import Q
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.contrib.contenttypes.models import ContentType
 from tagging.forms import TagAdminForm, TagField
 from tagging import settings
-from tagging.generic import fetch_content_objects
-from tagging.models import Tag, TaggedItem
-from tagging.tests.models import Article, Link, Perch, Parrot, FormTest, FormTestNull, DefaultNamespaceTest, DefaultNamespaceTest2, DefaultNamespaceTest3
-from tagging.utils import calculate_cloud, check_tag_length, edit_string_for_tags, get_tag_list, get_tag_parts, get_tag, parse_tag_input, split_strip
-from tagging.utils import LINEAR
+from tagging.bitmap import Bitmap, BITMAP_MAX_IDS, bitmap_index
+from tagging.buffer import TaggingBuffer
+from tagging.generic import fetch_content_objects, prefetch_tags
+from tagging.models import Tag, TaggedItem, TagUsage
+from tagging.planner import tag_statistics
+from tagging import snapshot
+from tagging.snapshot import get_snapshot, write_snapshot
+from tagging.tests.models import Article, Link, Perch, Parrot, FormTest, FormTestNull, DefaultNamespaceTest, DefaultNamespaceTest2, DefaultNamespaceTest3, DenormalizedTest
+from tagging.utils import calculate_cloud, calculate_cloud_count_thresholds, check_tag_length, edit_string_for_tags, get_tag_filter_lookup, get_tag_list, get_tag_parts, get_tag, get_tags_in_bulk, parse_tag_input, split_strip, tag_parse_cache
+from tagging.utils import iter_tag_input, ParsedTags, TagParts
+from tagging.utils import LINEAR, LOGARITHMIC
+from tagging.vocabulary import vocabulary
 
 #############
 # Utilities #
@@ -173,6 +181,49 @@ class TestParseTagInput(TestCase):
         self.assertEquals(parse_tag_input('foo bar', default_namespace='equ=al'), [u'"equ=al":bar', u'"equ=al":foo'])
         self.assertEquals(parse_tag_input(' ', default_namespace='equ=al'), [])
 
+    def test_with_newlines(self):
+        self.assertEquals(parse_tag_input('one,\ntwo'), [u'one', u'two'])
+        self.assertEquals(parse_tag_input('"one"\ntwo:three'), [u'one', u'two:three'])
+
+    def test_with_many_tags(self):
+        input = ', '.join(['ns:tag%d=value' % i for i in range(5000)])
+        tags = parse_tag_input(input)
+        self.assertEquals(len(tags), 5000)
+        self.assertEquals(tags[0], u'ns:tag0=value')
+
+class TestIterTagInput(TestCase):
+    def test_yields_unique_tags_in_input_order(self):
+        self.assertEquals(list(iter_tag_input('one two one')), [u'one', u'two'])
+        self.assertEquals(list(iter_tag_input('b:two, "a,one" b:two')),
+            [u'b:two', u'a,one b:two'])
+        self.assertEquals(list(iter_tag_input('two "one" two', default_namespace='ns')),
+            [u'ns:two', u'ns:one'])
+        self.assertEquals(list(iter_tag_input(None)), [])
+
+    def test_max_tags(self):
+        self.assertEquals(list(iter_tag_input('one two one', max_tags=2)),
+            [u'one', u'two'])
+        tags = iter_tag_input(' '.join(['tag%d' % i for i in range(1000)]),
+            max_tags=3)
+        self.assertEquals([tags.next() for i in range(3)],
+            [u'tag0', u'tag1', u'tag2'])
+        try:
+            tags.next()
+        except ValueError, e:
+            self.assertEquals(e.args[1:], ('tags', 3))
+        else:
+            self.fail()
+
+    def test_max_chars(self):
+        self.assertEquals(list(iter_tag_input('one two', max_chars=7)),
+            [u'one', u'two'])
+        try:
+            list(iter_tag_input('one two', max_chars=6))
+        except ValueError, e:
+            self.assertEquals(e.args[1:], ('input', 6))
+        else:
+            self.fail()
+
 class TestSplitStrip(TestCase):
     def test_with_empty_input(self):
         self.assertEquals(split_strip(' foo '), [u'foo'])
@@ -420,6 +471,22 @@ class TestNormalisedTagListInput(TestCase):
         self.failUnless(self.cheese in ret)
         self.failUnless(self.food_egg in ret)
     
+    def test_grouped_lookups(self):
+        tags = ['food:tag%d' % i for i in range(300)] + ['food:cheese', 'cheese',
+            'toast', 'spam:cheese', 'cheese=*', 'food:egg=good']
+        q = get_tag_filter_lookup(tags)
+        self.assertEquals(len(q.children), 5)
+        ret = Tag.objects.filter(q)
+        self.assertEquals(len(ret), 4)
+        self.failUnless(self.cheese in ret)
+        self.failUnless(self.toast in ret)
+        self.failUnless(self.food_cheese in ret)
+        self.failUnless(self.none_cheese_star in ret)
+
+        q = get_tag_filter_lookup('a:cheese b:cheese c:cheese food:cheese')
+        self.failIf(' OR ' in str(Tag.objects.filter(q).query))
+        self.assertEquals(list(Tag.objects.filter(q)), [self.food_cheese])
+
     def test_with_tag_instance(self):
         self.assertEquals(get_tag(self.cheese), self.cheese)
         self.assertEquals(get_tag(self.cheese), self.cheese)
@@ -471,6 +538,17 @@ class TestCalculateCloud(TestCase):
         self.assertEquals(sizes[4], 2)
         self.assertEquals(sizes[5], 4)
     
+    def test_without_numpy(self):
+        from tagging import utils
+        original_numpy = utils.numpy
+        utils.numpy = None
+        try:
+            self.test_default_distribution()
+            self.test_linear_distribution()
+            self.test_invalid_distribution()
+        finally:
+            utils.numpy = original_numpy
+
     def test_invalid_distribution(self):
         try:
             calculate_cloud(self.tags, steps=5, distribution='cheese')
@@ -504,6 +582,49 @@ class TestGetTag(TestCase):
         self.failUnless(get_tag('one:"two three"=four'), self.one_tag)
         self.failUnless(get_tag('":=":":="=":="'), self.sign_tag)
 
+    def test_get_tags_in_bulk(self):
+        strings = ['foo', '"foo:bar"', 'foo:bar', '"bar=baz"', 'bar=baz',
+            'foo:bar=baz', '"foo":"bar"="baz"', 'one:"two three"=four',
+            '":=":":="=":="', 'nonexistent', 'foo:nonexistent', '']
+        tags = get_tags_in_bulk(strings + [self.foo_tag.pk, 12345, self.one_tag])
+        self.assertEquals(tags, {
+            'foo': self.foo_tag,
+            '"foo:bar"': self.foobar_tag,
+            'foo:bar': self.foo_bar_tag,
+            '"bar=baz"': self.barbaz_tag,
+            'bar=baz': self.bar_baz_tag,
+            'foo:bar=baz': self.foo_bar_baz_tag,
+            '"foo":"bar"="baz"': self.foo_bar_baz_tag,
+            'one:"two three"=four': self.one_tag,
+            '":=":":="=":="': self.sign_tag,
+            'nonexistent': None,
+            'foo:nonexistent': None,
+            '': None,
+            self.foo_tag.pk: self.foo_tag,
+            12345: None,
+            self.one_tag: self.one_tag,
+        })
+        for string in strings[:-1]:
+            self.assertEquals(tags[string], get_tag(string))
+
+    def test_get_tags_in_bulk_with_default_namespace(self):
+        tags = get_tags_in_bulk(['bar', ':foo', 'bar=baz'], default_namespace='foo')
+        self.assertEquals(tags, {'bar': self.foo_bar_tag, ':foo': self.foo_tag,
+            'bar=baz': self.foo_bar_baz_tag})
+
+    def test_get_tags_in_bulk_in_chunks(self):
+        from tagging import utils
+        for i in range(10):
+            Tag.objects.create(namespace='chunk%d' % i, name='foo')
+        original_max_tags_per_query = utils.MAX_TAGS_PER_QUERY
+        utils.MAX_TAGS_PER_QUERY = 3
+        try:
+            tags = get_tags_in_bulk(['chunk%d:foo' % i for i in range(10)])
+        finally:
+            utils.MAX_TAGS_PER_QUERY = original_max_tags_per_query
+        self.assertEquals(len(tags), 10)
+        self.failIf(None in tags.values())
+
 class TestGetTagParts(TestCase):
     def test_simple_cases(self):
         self.assertEquals(get_tag_parts('bar'),
@@ -553,6 +674,86 @@ class TestGetTagParts(TestCase):
         self.assertEquals(get_tag_parts('baz:bar', default_namespace='foo'),
             {'namespace': 'baz', 'name': 'bar', 'value': None})
 
+class TestTagParts(TestCase):
+    def test_hashing_and_equality(self):
+        parts = TagParts('foo', 'bar', 'baz')
+        self.assertEquals(parts, TagParts('foo', 'bar', 'baz'))
+        self.assertEquals(hash(parts), hash(TagParts('foo', 'bar', 'baz')))
+        self.assertNotEquals(parts, TagParts('foo', 'bar'))
+        self.assertEquals(TagParts('', 'bar', ''), TagParts(None, 'bar', None))
+        self.assertEquals(len(set([parts, get_tag_parts('foo:bar=baz'),
+            get_tag_parts('bar')])), 2)
+        self.assertEquals(parts,
+            {'namespace': 'foo', 'name': 'bar', 'value': 'baz'})
+
+    def test_canonical_string(self):
+        self.assertEquals(unicode(TagParts(None, 'bar')), u'bar')
+        self.assertEquals(unicode(TagParts('foo', 'bar', 'baz')), u'foo:bar=baz')
+        self.assertEquals(unicode(TagParts('sp:am', 'b=ar')), u'"sp:am":"b=ar"')
+        self.assertEquals(unicode(get_tag_parts('"sp:am":bar')), u'"sp:am":bar')
+        self.assertEquals(unicode(Tag(namespace='foo', name='bar').parts),
+            u'foo:bar')
+
+    def test_immutable(self):
+        parts = TagParts('foo', 'bar')
+        self.assertRaises(AttributeError, setattr, parts, 'name', 'baz')
+        self.assertRaises(AttributeError, delattr, parts, 'name')
+        self.assertRaises(AttributeError, setattr, parts, 'spam', 'egg')
+
+    def test_mapping_access(self):
+        parts = TagParts('foo', 'bar')
+        self.assertEquals(parts['namespace'], 'foo')
+        self.assertRaises(KeyError, parts.__getitem__, 'spam')
+        self.assertEquals(dict(**parts),
+            {'namespace': 'foo', 'name': 'bar', 'value': None})
+
+class TestTagParseCache(TestCase):
+    def setUp(self):
+        self.original_cache_size = settings.TAG_PARSE_CACHE_SIZE
+        tag_parse_cache.clear()
+
+    def tearDown(self):
+        settings.TAG_PARSE_CACHE_SIZE = self.original_cache_size
+        tag_parse_cache.clear()
+
+    def test_disabled_cache(self):
+        settings.TAG_PARSE_CACHE_SIZE = 0
+        self.assertEquals(parse_tag_input('foo bar'), [u'bar', u'foo'])
+        self.assertEquals(tag_parse_cache.stats()['size'], 0)
+        self.assertEquals(tag_parse_cache.stats()['misses'], 0)
+
+    def test_hits_and_misses(self):
+        settings.TAG_PARSE_CACHE_SIZE = 10
+        self.assertEquals(parse_tag_input('foo bar'), [u'bar', u'foo'])
+        misses = tag_parse_cache.misses
+        self.assertEquals(parse_tag_input('foo bar'), [u'bar', u'foo'])
+        self.assertEquals(tag_parse_cache.misses, misses)
+        self.assertEquals(tag_parse_cache.hits, 1)
+        self.assertEquals(parse_tag_input('foo bar', default_namespace='ns'),
+            [u'ns:bar', u'ns:foo'])
+        self.assertEquals(parse_tag_input('"*":foo', keep_quotes=['*']),
+            [u'"*":foo'])
+        self.assertEquals(parse_tag_input('"*":foo'), [u'*:foo'])
+
+    def test_results_are_copied(self):
+        settings.TAG_PARSE_CACHE_SIZE = 10
+        parse_tag_input('foo').append(u'bar')
+        self.assertEquals(parse_tag_input('foo'), [u'foo'])
+        self.assert_(get_tag_parts('foo:bar') is get_tag_parts('foo:bar'))
+
+    def test_evictions(self):
+        settings.TAG_PARSE_CACHE_SIZE = 2
+        get_tag_parts('one')
+        get_tag_parts('two')
+        get_tag_parts('one')
+        get_tag_parts('three')
+        stats = tag_parse_cache.stats()
+        self.assertEquals(stats['size'], 2)
+        self.assertEquals(stats['evictions'], 1)
+        get_tag_parts('one')
+        self.assertEquals(tag_parse_cache.hits, 2)
+        get_tag_parts('two')
+        self.assertEquals(tag_parse_cache.misses, 4)
 
 class TestCheckTagLength(TestCase):
     def setUp(self):
@@ -627,6 +828,90 @@ class TestTagModel(TestCase):
         self.assertEqual(unicode(Tag(name='foo:bar=baz', value='spam:egg')), u'"foo:bar=baz"="spam:egg"')
         self.assertEqual(unicode(Tag(namespace=':', name=':=', value='=')), u'":":":="="="')
 
+class TestTagVocabulary(TestCase):
+    def setUp(self):
+        self.original_vocabulary_cache = settings.TAG_VOCABULARY_CACHE
+        settings.TAG_VOCABULARY_CACHE = True
+        vocabulary.clear()
+        Tag.objects.create(name='foo')
+        Tag.objects.create(namespace='spam', name='egg', value='ham')
+
+    def tearDown(self):
+        settings.TAG_VOCABULARY_CACHE = self.original_vocabulary_cache
+        vocabulary.clear()
+
+    def test_lookups(self):
+        foo = Tag.objects.get(name='foo')
+        self.assertEquals(vocabulary.get_id('foo'), foo.pk)
+        self.assertEquals(vocabulary.get_id(TagParts(name='foo')), foo.pk)
+        self.assertEquals(vocabulary.get_id('bar'), None)
+        self.assertEquals(get_tag('foo'), foo)
+        self.assertEquals(get_tag('bar'), None)
+        self.assertEquals(get_tag('egg', default_namespace='spam'), None)
+        self.assertEquals(get_tag('egg=ham', default_namespace='spam'),
+            Tag.objects.get(name='egg'))
+        self.assertEquals(get_tags_in_bulk(['foo', 'bar']),
+            {'foo': foo, 'bar': None})
+
+    def test_get_tag_list(self):
+        tags = get_tag_list('spam:egg=ham foo bar')
+        self.assertEquals([unicode(tag) for tag in tags],
+            [u'foo', u'spam:egg=ham'])
+        tags = get_tag_list(['foo', 'spam:egg=ham'])
+        self.assertEquals([unicode(tag) for tag in tags],
+            [u'foo', u'spam:egg=ham'])
+        tags = get_tag_list('spam:*=*', wildcard='*')
+        self.assertEquals([unicode(tag) for tag in tags], [u'spam:egg=ham'])
+
+    def test_new_tags(self):
+        snapshot = vocabulary.snapshot()
+        bar = Tag.objects.create(name='bar')
+        self.assertEquals(vocabulary.get_id('bar'), bar.pk)
+        self.failUnless(vocabulary.snapshot() is snapshot)
+
+    def test_invalidation(self):
+        foo = Tag.objects.get(name='foo')
+        vocabulary.snapshot()
+        foo.name = 'bar'
+        foo.save()
+        self.assertEquals(vocabulary.get_id('foo'), None)
+        self.assertEquals(vocabulary.get_id('bar'), foo.pk)
+        foo.delete()
+        self.assertEquals(vocabulary.get_id('bar'), None)
+
+    def test_tags_from_other_processes(self):
+        vocabulary.snapshot()
+        # Updates which send no signals, like those of other processes.
+        Tag.objects.filter(name='foo').update(name='bar')
+        self.assertEquals(get_tag('foo').name, u'foo')
+        self.assertEquals(get_tag('bar').name, u'bar')
+        vocabulary.reload()
+        self.assertEquals(get_tag('foo'), None)
+
+    def test_update_tags(self):
+        parrot = Parrot.objects.create(state='dead')
+        Tag.objects.update_tags(parrot, 'foo bar spam:egg=ham')
+        self.assertEquals([unicode(tag) for tag in Tag.objects.get_for_object(parrot)],
+            [u'bar', u'foo', u'spam:egg=ham'])
+        self.assertEquals(vocabulary.get_id('bar'),
+            Tag.objects.get(name='bar').pk)
+
+    def test_stale_ids_not_written(self):
+        from django.db import connection
+        parrot = Parrot.objects.create(state='dead')
+        foo_id = vocabulary.get_id('foo')
+        # Deleted by another process, the cache still knows the tag.
+        connection.cursor().execute('DELETE FROM %s WHERE id = %%s' %
+            connection.ops.quote_name(Tag._meta.db_table), [foo_id])
+        self.assertEquals(vocabulary.get_id('foo'), foo_id)
+        Tag.objects.update_tags(parrot, 'foo')
+        Tag.objects.add_tag(parrot, 'spam:egg=ham')
+        tag_ids = set(TaggedItem.objects.values_list('tag', flat=True))
+        self.failIf(foo_id in tag_ids)
+        self.assertEquals(Tag.objects.filter(pk__in=tag_ids).count(), 2)
+        self.assertEquals([unicode(tag) for tag in Tag.objects.get_for_object(parrot)],
+            [u'foo', u'spam:egg=ham'])
+
 ###########
 # Manager #
 ###########
@@ -753,6 +1038,63 @@ class TestModelTaggedItemManager(TestCase):
         self.failUnless(self.pining_for_the_fjords_parrot in related_objs)
         self.failUnless(self.passed_on_parrot in related_objs)
 
+    def test_tag_and_untag_queryset(self):
+        smelly_parrots = Parrot.objects.filter(perch__smelly=True)
+        self.assertEquals(TaggedItem.objects.tag_queryset(smelly_parrots, 'bar'), 1)
+        self.assertEquals(list(Parrot.objects.filter(perch__smelly=True).exclude(
+            pk__in=TaggedItem.objects.get_by_model(Parrot, 'bar'))), [])
+        self.assertEquals(TaggedItem.objects.tag_queryset(smelly_parrots, 'bar'), 0)
+        self.assertEquals(TaggedItem.objects.filter(tag=get_tag('bar')).count(), 3)
+
+        self.assertEquals(TaggedItem.objects.tag_queryset(
+            Parrot.objects.all(), 'egg', default_namespace='spam'), 4)
+        self.assertEquals(len(TaggedItem.objects.get_by_model(Parrot, 'spam:egg')), 4)
+        self.assertEquals(TaggedItem.objects.tag_queryset(
+            Parrot.objects.filter(state='late'), get_tag('foo')), 1)
+
+        self.assertEquals(TaggedItem.objects.untag_queryset(
+            Parrot.objects.exclude(state='late'), 'spam:egg'), 3)
+        self.assertEquals(list(TaggedItem.objects.get_by_model(Parrot, 'spam:egg')),
+            [self.late_parrot])
+        self.assertEquals(TaggedItem.objects.untag_queryset(
+            Parrot.objects.all(), 'missing'), 0)
+        self.assertEquals(TaggedItem.objects.untag_queryset(
+            TaggedItem.objects.get_by_model(Parrot, 'bar'), 'bar'), 3)
+        self.assertEquals(TaggedItem.objects.filter(tag=get_tag('bar')).count(), 0)
+
+    def test_tag_and_untag_queryset_lowercase(self):
+        original_force_lower_case_tags = settings.FORCE_LOWERCASE_TAGS
+        settings.FORCE_LOWERCASE_TAGS = True
+        try:
+            self.assertEquals(TaggedItem.objects.tag_queryset(
+                Parrot.objects.all(), 'Spam:Bacon'), 4)
+            self.assertEquals(len(TaggedItem.objects.get_by_model(
+                Parrot, 'spam:bacon')), 4)
+            self.assertEquals(TaggedItem.objects.untag_queryset(
+                Parrot.objects.all(), 'SPAM:Bacon'), 4)
+            self.assertEquals(len(TaggedItem.objects.get_by_model(
+                Parrot, 'spam:bacon')), 0)
+        finally:
+            settings.FORCE_LOWERCASE_TAGS = original_force_lower_case_tags
+
+    def test_tag_and_untag_queryset_invalid_input(self):
+        for method in (TaggedItem.objects.tag_queryset,
+                       TaggedItem.objects.untag_queryset):
+            for input in ['', '     ', ':', ':=']:
+                try:
+                    method(Parrot.objects.all(), input)
+                except AttributeError, ae:
+                    self.assertEquals(str(ae), 'No tags were given: "%s".' % input)
+                else:
+                    raise self.failureException('an AttributeError exception was supposed to be raised!')
+            try:
+                method(Parrot.objects.all(), 'foo bar')
+            except AttributeError, ae:
+                self.assertEquals(str(ae), 'Multiple tags were given: "foo bar".')
+            else:
+                raise self.failureException('an AttributeError exception was supposed to be raised!')
+        self.assertEquals(Tag.objects.filter(name='foo bar').count(), 0)
+
 class TestTagDescriptor(TestCase):
     def setUp(self):
         parrot_details = (
@@ -783,6 +1125,7 @@ class TestTagDescriptor(TestCase):
         self.failUnless(get_tag('spam:foo') in tags)
 
         tags = self.pining_for_the_fjords_parrot.tags
+        self.failUnless(type(tags) is list)
         self.assertEquals(len(tags), 3)
         self.failUnless(get_tag('foo') in tags)
         self.failUnless(get_tag('bar') in tags)
@@ -1168,6 +1511,258 @@ class TestBasicTagging(TestCase):
         tags = Tag.objects.get_for_object(self.dead_parrot)
         self.assertEquals(len(tags), 0)
 
+    def test_update_tags_with_parsed_tags(self):
+        from tagging import utils
+        parsed_tags = TagField(default_namespace='spam').clean('foo :bar')
+        self.assertEquals(parsed_tags, u'foo :bar')
+        self.assertEquals(parsed_tags.tags,
+            (get_tag_parts('bar'), get_tag_parts('spam:foo')))
+        calls = []
+        original_parse_tag_input = utils.parse_tag_input
+        def parse_tag_input(*args, **kwargs):
+            calls.append(args)
+            return original_parse_tag_input(*args, **kwargs)
+        utils.parse_tag_input = parse_tag_input
+        try:
+            Tag.objects.update_tags(self.dead_parrot, parsed_tags,
+                default_namespace='spam')
+            self.assertEquals(calls, [])
+            Tag.objects.update_tags(self.dead_parrot, parsed_tags)
+            self.assertEquals(len(calls), 1)
+        finally:
+            utils.parse_tag_input = original_parse_tag_input
+        tags = Tag.objects.get_for_object(self.dead_parrot)
+        self.assertEquals(map(unicode, tags), [u'bar', u'foo'])
+
+    def test_update_tags_in_bulk(self):
+        from tagging import models
+        Tag.objects.create(name='tag0')
+        tag_names = ['tag%d' % i for i in range(7)]
+        original_max_tags_per_query = models.MAX_TAGS_PER_QUERY
+        models.MAX_TAGS_PER_QUERY = 3
+        try:
+            Tag.objects.update_tags(self.dead_parrot, ' '.join(tag_names))
+            tags = Tag.objects.get_for_object(self.dead_parrot)
+            self.assertEquals(map(unicode, tags), tag_names)
+            self.assertEquals(Tag.objects.count(), 7)
+
+            Tag.objects.update_tags(self.dead_parrot, 'tag1 tag5 tag7 tag8')
+            tags = Tag.objects.get_for_object(self.dead_parrot)
+            self.assertEquals(map(unicode, tags),
+                [u'tag1', u'tag5', u'tag7', u'tag8'])
+            self.assertEquals(TaggedItem.objects.count(), 4)
+            self.assertEquals(Tag.objects.count(), 9)
+        finally:
+            models.MAX_TAGS_PER_QUERY = original_max_tags_per_query
+
+    def test_update_tags_many(self):
+        parrot = Parrot.objects.create(state='pining for the fjords')
+        perch = Perch.objects.create(size=7, smelly=True)
+        Tag.objects.update_tags(self.dead_parrot, 'foo bar')
+        Tag.objects.update_tags(parrot, 'foo')
+        Tag.objects.update_tags_many({
+            self.dead_parrot: 'bar baz spam:egg',
+            parrot: '',
+            perch: 'foo spam',
+        }, default_namespace='ns', batch_size=2)
+        self.assertEquals(map(unicode, Tag.objects.get_for_object(self.dead_parrot)),
+            [u'ns:bar', u'ns:baz', u'spam:egg'])
+        self.assertEquals(map(unicode, Tag.objects.get_for_object(parrot)), [])
+        self.assertEquals(map(unicode, Tag.objects.get_for_object(perch)),
+            [u'ns:foo', u'ns:spam'])
+
+        Tag.objects.update_tags_many([
+            (self.dead_parrot, 'ns:bar foo'),
+            (parrot, 'foo'),
+        ])
+        self.assertEquals(map(unicode, Tag.objects.get_for_object(self.dead_parrot)),
+            [u'foo', u'ns:bar'])
+        self.assertEquals(map(unicode, Tag.objects.get_for_object(parrot)),
+            [u'foo'])
+        self.assertEquals(TaggedItem.objects.count(), 5)
+
+    def test_concurrent_tag_creation(self):
+        from tagging import models
+        original_get_tags_by_parts = models._get_tags_by_parts
+        def get_tags_by_parts(tags):
+            # Another writer creates the tag and the tagged item after this
+            # one found them missing.
+            models._get_tags_by_parts = original_get_tags_by_parts
+            tag = Tag.objects.create(namespace='spam', name='egg', value='ham')
+            TaggedItem.objects.create(tag=tag, object=self.dead_parrot)
+            return {}
+        models._get_tags_by_parts = get_tags_by_parts
+        try:
+            Tag.objects.update_tags(self.dead_parrot, 'spam:egg=ham')
+        finally:
+            models._get_tags_by_parts = original_get_tags_by_parts
+        self.assertEquals(Tag.objects.count(), 1)
+        self.assertEquals(TaggedItem.objects.count(), 1)
+
+        Tag.objects.add_tag(self.dead_parrot, 'spam:egg=ham')
+        self.assertEquals(TaggedItem.objects.count(), 1)
+
+    def test_concurrent_tag_creation_not_visible(self):
+        from tagging import models
+        original_get_tags_by_parts = models._get_tags_by_parts
+        original_get_tags_for_update = Tag.objects._get_tags_for_update
+        def get_tags_by_parts(tags):
+            # Another transaction committed the tags after this one started,
+            # so neither the INSERT nor a plain SELECT see them.
+            for tag_parts in tags:
+                if not Tag.objects.filter(**tag_parts).count():
+                    Tag.objects.create(**tag_parts)
+            return {}
+        models._get_tags_by_parts = get_tags_by_parts
+        try:
+            Tag.objects.update_tags(self.dead_parrot, 'spam:foo=1 spam:bar=1')
+            self.assertEquals(map(unicode,
+                Tag.objects.get_for_object(self.dead_parrot)), [u'spam:bar=1', u'spam:foo=1'])
+            # Tags which even the locking read misses
+            Tag.objects._get_tags_for_update = lambda tag_parts: {}
+            Tag.objects.add_tag(self.dead_parrot, 'spam:baz=1')
+        finally:
+            models._get_tags_by_parts = original_get_tags_by_parts
+            del Tag.objects._get_tags_for_update
+        self.assertEquals(map(unicode,
+            Tag.objects.get_for_object(self.dead_parrot)),
+            [u'spam:bar=1', u'spam:baz=1', u'spam:foo=1'])
+        self.assertEquals(Tag.objects.count(), 3)
+
+    def test_insert_without_multirow_values(self):
+        from tagging import models
+        original_supports_multirow_insert = models._supports_multirow_insert
+        original_get_insert_sql = models._get_insert_sql
+        # A backend without multi-row VALUES nor an upsert, like Oracle
+        models._supports_multirow_insert = lambda: False
+        models._get_insert_sql = lambda ignore_conflicts=False: ('INSERT', '')
+        try:
+            Tag.objects.update_tags(self.dead_parrot, 'foo bar')
+            self.assertEquals(models._insert_rows(TaggedItem._meta.db_table,
+                ('tag_id', 'content_type_id', 'object_id'),
+                [(tag.pk, ContentType.objects.get_for_model(Parrot).pk,
+                  self.dead_parrot.pk) for tag in Tag.objects.all()],
+                ignore_conflicts=True), 0)
+            Tag.objects.update_tags(self.dead_parrot, 'foo baz')
+        finally:
+            models._supports_multirow_insert = original_supports_multirow_insert
+            models._get_insert_sql = original_get_insert_sql
+        self.assertEquals(map(unicode,
+            Tag.objects.get_for_object(self.dead_parrot)), [u'baz', u'foo'])
+        self.assertEquals(TaggedItem.objects.count(), 2)
+
+class TestConcurrentTagging(TransactionTestCase):
+    def test_concurrent_writers(self):
+        from django.db import connection
+        if 'sqlite' in connection.settings_dict['ENGINE'] and \
+                connection.settings_dict['NAME'] == ':memory:':
+            # Every thread would use its own in-memory database. Set
+            # TEST_DATABASE_NAME to run this test with an SQLite file.
+            return
+        import threading
+        parrots = [Parrot.objects.create(state='dead %d' % i)
+                   for i in range(10)]
+        tag_names = ['spam:tag%d=value' % i for i in range(20)]
+        errors = []
+        def tag_parrots(offset):
+            try:
+                try:
+                    for i in range(len(tag_names)):
+                        tag_name = tag_names[(offset + i) % len(tag_names)]
+                        for parrot in parrots:
+                            Tag.objects.add_tag(parrot, tag_name)
+                    for parrot in parrots:
+                        Tag.objects.update_tags(parrot,
+                            ' '.join(tag_names[offset % 2::2]))
+                    Tag.objects.update_tags_many(
+                        [(parrot, ' '.join(tag_names)) for parrot in parrots])
+                except Exception, e:
+                    errors.append(e)
+            finally:
+                connection.close()
+        threads = [threading.Thread(target=tag_parrots, args=(i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(errors, [])
+        # No tag was created twice and no tagged item was lost or duplicated.
+        self.assertEquals(Tag.objects.count(), len(tag_names))
+        self.assertEquals(TaggedItem.objects.count(),
+            len(tag_names) * len(parrots))
+        self.assertEquals(len(set(TaggedItem.objects.values_list(
+            'tag', 'object_id'))), len(tag_names) * len(parrots))
+
+class TestTaggingBuffer(TestCase):
+    def setUp(self):
+        self.dead_parrot = Parrot.objects.create(state='dead')
+        self.late_parrot = Parrot.objects.create(state='late')
+        Tag.objects.update_tags(self.dead_parrot, 'foo spam:egg')
+
+    def test_buffered_changes(self):
+        buffer = TaggingBuffer()
+        buffer.__enter__()
+        try:
+            Tag.objects.add_tag(self.dead_parrot, 'bar')
+            Tag.objects.update_tags(self.late_parrot, 'foo')
+            self.dead_parrot.spam = 'ham'
+            Tag.objects.add_tag(self.late_parrot, 'baz')
+            # Nothing is written until the buffer is flushed.
+            self.assertEquals(TaggedItem.objects.count(), 2)
+            self.assertEquals(map(unicode, self.dead_parrot.tags),
+                [u'bar', u'foo', u'spam:ham'])
+            self.assertEquals(map(unicode, self.late_parrot.tags),
+                [u'baz', u'foo'])
+        finally:
+            buffer.__exit__(None, None, None)
+        self.assertEquals(map(unicode, Tag.objects.get_for_object(self.dead_parrot)),
+            [u'bar', u'foo', u'spam:ham'])
+        self.assertEquals(map(unicode, Tag.objects.get_for_object(self.late_parrot)),
+            [u'baz', u'foo'])
+
+    def test_discarded_changes(self):
+        buffer = TaggingBuffer()
+        buffer.__enter__()
+        try:
+            Tag.objects.update_tags(self.dead_parrot, 'bar')
+        finally:
+            buffer.__exit__(ValueError, ValueError(), None)
+        self.assertEquals(map(unicode, Tag.objects.get_for_object(self.dead_parrot)),
+            [u'foo', u'spam:egg'])
+
+    def test_flush_before_queries(self):
+        buffer = TaggingBuffer()
+        buffer.__enter__()
+        try:
+            Tag.objects.add_tag(self.late_parrot, 'foo')
+            self.assertEquals(len(Parrot.tagged_items.with_all('foo')), 2)
+            self.assertEquals(TaggedItem.objects.count(), 3)
+            # Filters which can't be evaluated in memory are run directly.
+            Tag.objects.add_tag(self.late_parrot, 'bar')
+            Tag.objects.update_tags(self.late_parrot, 'baz',
+                q=Q(name__startswith='f'))
+            self.assertEquals(map(unicode, Tag.objects.get_for_object(self.late_parrot)),
+                [u'bar', u'baz'])
+        finally:
+            buffer.__exit__(None, None, None)
+
+    def test_tag_field(self):
+        buffer = TaggingBuffer()
+        buffer.__enter__()
+        try:
+            test = DefaultNamespaceTest2.objects.create(tags='foo',
+                categories='spam')
+            test.tags = 'bar category:egg'
+            test.save()
+            self.assertEquals(map(unicode, Tag.objects.get_for_object(test)),
+                [u'bar', u'category:spam'])
+        finally:
+            buffer.__exit__(None, None, None)
+        test = DefaultNamespaceTest2.objects.get(pk=test.pk)
+        self.assertEquals(test.tags, u'bar')
+        self.assertEquals(test.categories, u'spam')
+
 class TestModelTagField(TestCase):
     """ Test the 'tags' field on models. """
     
@@ -1561,6 +2156,67 @@ class TestModelTagField(TestCase):
         self.failIf('two' in f1again.tags)
         self.failUnless('new' in f1again.tags)
     
+    def test_tags_loaded_lazily(self):
+        f1 = FormTest.objects.create(tags=u'one two')
+        calls = []
+        original_get_for_object = Tag.objects.get_for_object
+        def get_for_object(obj):
+            calls.append(obj.pk)
+            return original_get_for_object(obj)
+        Tag.objects.get_for_object = get_for_object
+        try:
+            f1again = FormTest.objects.get(pk=f1.pk)
+            self.assertEquals(calls, [])
+            self.assertEquals(f1again.tags, u'one two')
+            self.assertEquals(f1again.tags, u'one two')
+            self.assertEquals(calls, [f1.pk])
+            # Tags which are set aren't loaded
+            f1again = FormTest.objects.get(pk=f1.pk)
+            f1again.tags = u'three'
+            f1again.save()
+            self.assertEquals(calls, [f1.pk])
+            # Saving an instance keeps its tags
+            f1again = FormTest.objects.get(pk=f1.pk)
+            f1again.save()
+            self.assertEquals(FormTest.objects.get(pk=f1.pk).tags, u'three')
+        finally:
+            del Tag.objects.get_for_object
+        self.assertEquals(FormTest(pk=f1.pk, tags=u'ignored').tags, u'three')
+
+    def test_unchanged_tags_not_saved(self):
+        f1 = FormTest.objects.create(tags=u'one two')
+        calls = []
+        original_update_tags = Tag.objects.update_tags
+        def update_tags(obj, tag_names, **kwargs):
+            calls.append(tag_names)
+            return original_update_tags(obj, tag_names, **kwargs)
+        Tag.objects.update_tags = update_tags
+        try:
+            # Tags which weren't loaded
+            f1again = FormTest.objects.get(pk=f1.pk)
+            f1again.save()
+            # Tags which were loaded, set to an equivalent value or saved
+            f1again = FormTest.objects.get(pk=f1.pk)
+            self.assertEquals(f1again.tags, u'one two')
+            f1again.save()
+            f1again.tags = u'two, one'
+            f1again.save()
+            f1.save()
+            self.assertEquals(calls, [])
+            f1again.tags = u'three'
+            f1again.save()
+            f1again.save()
+            self.assertEquals(calls, [u'three'])
+            self.assertEquals(FormTest.objects.get(pk=f1.pk).tags, u'three')
+            # The stored value of tags which weren't loaded is kept
+            self.assertEquals(FormTest.objects.filter(pk=f1.pk).values_list(
+                'tags', flat=True)[0], u'three')
+            FormTest.objects.get(pk=f1.pk).save()
+            self.assertEquals(FormTest.objects.filter(pk=f1.pk).values_list(
+                'tags', flat=True)[0], u'three')
+        finally:
+            del Tag.objects.update_tags
+
     def test_creation_without_specifying_tags(self):
         f1 = FormTest()
         self.assertEquals(f1.tags, '')
@@ -1569,6 +2225,153 @@ class TestModelTagField(TestCase):
         f1 = FormTestNull()
         self.assertEquals(f1.tags, '')
 
+    def test_parsed_tags_from_form_field(self):
+        from tagging import utils
+        form_field = DefaultNamespaceTest._meta.get_field('categories').formfield()
+        parsed_tags = form_field.clean('foo bar other:baz')
+        calls = []
+        original_parse_tag_input = utils.parse_tag_input
+        def parse_tag_input(*args, **kwargs):
+            calls.append(args)
+            return original_parse_tag_input(*args, **kwargs)
+        utils.parse_tag_input = parse_tag_input
+        try:
+            f1 = DefaultNamespaceTest.objects.create(categories=parsed_tags)
+        finally:
+            utils.parse_tag_input = original_parse_tag_input
+        self.assertEquals(calls, [])
+        self.assertEquals(f1.categories, u'bar foo')
+        tags = Tag.objects.get_for_object(f1)
+        self.assertEquals(map(unicode, tags), [u'category:bar', u'category:foo'])
+
+    def test_parsed_tags_saved_as_unicode(self):
+        from django.db import connection
+        field = DefaultNamespaceTest._meta.get_field('categories')
+        parsed_tags = field.formfield().clean('foo bar')
+        self.failUnless(isinstance(parsed_tags, ParsedTags))
+        f1 = DefaultNamespaceTest(categories=parsed_tags)
+        value = field.get_db_prep_save(field.pre_save(f1, True),
+                                       connection=connection)
+        self.assertEquals(value, u'bar foo')
+        self.failUnless(type(value) is unicode)
+
+class TestDenormalizedTagField(TestCase):
+    def setUp(self):
+        self.original_stdout = sys.stdout
+        self.obj = DenormalizedTest.objects.create(tags='b a category:x',
+            categories='c')
+
+    def tearDown(self):
+        sys.stdout = self.original_stdout
+        Tag.objects.__dict__.pop('get_for_object', None)
+
+    def get_columns(self, obj):
+        return tuple(DenormalizedTest.objects.filter(pk=obj.pk).values_list(
+            'tags', 'categories')[0])
+
+    def test_reads_from_column(self):
+        self.assertEquals(self.obj.tags, u'a b')
+        self.assertEquals(self.obj.categories, u'c')
+        self.assertEquals(self.get_columns(self.obj), (u'a b', u'c'))
+        def get_for_object(obj):
+            self.fail('Tags were queried.')
+        Tag.objects.get_for_object = get_for_object
+        obj = DenormalizedTest.objects.get(pk=self.obj.pk)
+        self.assertEquals((obj.tags, obj.categories), (u'a b', u'c'))
+        obj.save()
+
+    def test_columns_written_as_unicode(self):
+        from django.db.models.query import QuerySet
+        field = DenormalizedTest._meta.get_field('tags')
+        self.obj.tags = u'b, a'
+        value = field.pre_save(self.obj, False)
+        self.assertEquals(value, u'a b')
+        self.failUnless(type(value) is unicode)
+        updates = []
+        original_update = QuerySet.update
+        def update(queryset, **kwargs):
+            updates.append(kwargs)
+            return original_update(queryset, **kwargs)
+        QuerySet.update = update
+        try:
+            Tag.objects.update_tags(self.obj, 'd category:e')
+        finally:
+            QuerySet.update = original_update
+        self.assertEquals(updates, [{'tags': u'd', 'categories': u'e'}])
+        for value in updates[0].values():
+            self.failUnless(type(value) is unicode)
+
+    def test_write_paths(self):
+        Tag.objects.update_tags(self.obj, 'd category:e')
+        self.assertEquals(self.get_columns(self.obj), (u'd', u'e'))
+        self.assertEquals((self.obj.tags, self.obj.categories), (u'd', u'e'))
+        Tag.objects.add_tag(self.obj, 'category:f')
+        self.assertEquals(self.get_columns(self.obj), (u'd', u'e f'))
+        other = DenormalizedTest.objects.create()
+        Tag.objects.update_tags_many({self.obj: 'g', other: 'h'})
+        self.assertEquals(self.get_columns(self.obj), (u'g', u''))
+        self.assertEquals(self.get_columns(other), (u'h', u''))
+        TaggedItem.objects.tag_queryset(DenormalizedTest.objects.all(), 'category:i')
+        self.assertEquals(self.get_columns(other), (u'h', u'i'))
+        TaggedItem.objects.untag_queryset(
+            TaggedItem.objects.get_by_model(DenormalizedTest, 'category:i'), 'category:i')
+        self.assertEquals(self.get_columns(other), (u'h', u''))
+        TaggedItem.objects.create(tag=Tag.objects.get(name='g'), object=other)
+        self.assertEquals(self.get_columns(other), (u'g h', u''))
+        TaggedItem.objects.filter(tag__name='h').delete()
+        self.assertEquals(self.get_columns(other), (u'g', u''))
+        buffer = TaggingBuffer()
+        buffer.__enter__()
+        try:
+            Tag.objects.update_tags(other, 'j')
+            self.assertEquals(self.get_columns(other), (u'g', u''))
+        finally:
+            buffer.__exit__(None, None, None)
+        self.assertEquals(self.get_columns(other), (u'j', u''))
+        obj = DenormalizedTest.objects.get(pk=other.pk)
+        obj.categories = 'k'
+        obj.save()
+        self.assertEquals(self.get_columns(other), (u'j', u'k'))
+
+    def test_unchanged_tags_not_saved(self):
+        calls = []
+        original_update_tags = Tag.objects.update_tags
+        def update_tags(obj, tag_names, **kwargs):
+            calls.append(tag_names)
+            return original_update_tags(obj, tag_names, **kwargs)
+        Tag.objects.update_tags = update_tags
+        try:
+            obj = DenormalizedTest.objects.get(pk=self.obj.pk)
+            obj.save()
+            obj.tags = u'b, a'
+            obj.save()
+            self.assertEquals(calls, [])
+            obj.categories = u'd'
+            obj.save()
+            obj.save()
+            self.assertEquals(calls, [u'd'])
+        finally:
+            del Tag.objects.update_tags
+        self.assertEquals(self.get_columns(self.obj), (u'a b', u'd'))
+
+    def test_sync_tag_fields_command(self):
+        tag = Tag.objects.get(name='a')
+        tag.name = 'z'
+        tag.save()
+        DenormalizedTest.objects.filter(pk=self.obj.pk).update(categories='drift')
+        self.assertEquals(self.get_columns(self.obj), (u'a b', u'drift'))
+        output = []
+        class Output(object):
+            def write(self, text):
+                output.append(text)
+        sys.stdout = Output()
+        call_command('sync_tag_fields', batch_size=1)
+        self.assertEquals(self.get_columns(self.obj), (u'b z', u'c'))
+        self.assertEquals(''.join(output), 'tests.DenormalizedTest: 1 rows updated\n')
+        output[:] = []
+        call_command('sync_tag_fields', 'tests.DenormalizedTest')
+        self.assertEquals(''.join(output), 'tests.DenormalizedTest: 0 rows updated\n')
+
 class TestSettings(TestCase):
     def setUp(self):
         self.original_force_lower_case_tags = settings.FORCE_LOWERCASE_TAGS
@@ -1648,6 +2451,93 @@ class TestTagUsageForModelBaseCase(TestCase):
     def test_tag_usage_for_model_empty(self):
         self.assertEquals(Tag.objects.usage_for_model(Parrot), [])
 
+class TestTagUsageCounts(TestCase):
+    def setUp(self):
+        self.original_tag_usage_counts = settings.TAG_USAGE_COUNTS
+        settings.TAG_USAGE_COUNTS = True
+        self.parrots = [Parrot.objects.create(state='parrot %d' % i)
+                        for i in range(4)]
+        self.link = Link.objects.create(name='link')
+
+    def tearDown(self):
+        settings.TAG_USAGE_COUNTS = self.original_tag_usage_counts
+
+    def get_counts(self, model):
+        return [(unicode(tag), tag.count)
+                for tag in Tag.objects.usage_for_model(model, counts=True)]
+
+    def assertCountsMatch(self):
+        for model in (Parrot, Link):
+            counts = self.get_counts(model)
+            settings.TAG_USAGE_COUNTS = False
+            try:
+                self.assertEquals(counts, self.get_counts(model))
+            finally:
+                settings.TAG_USAGE_COUNTS = True
+
+    def test_counts(self):
+        Tag.objects.update_tags(self.parrots[0], 'foo bar')
+        Tag.objects.update_tags(self.parrots[1], 'foo baz')
+        Tag.objects.update_tags(self.link, 'foo')
+        self.assertEquals(self.get_counts(Parrot),
+            [(u'bar', 1), (u'baz', 1), (u'foo', 2)])
+        self.assertEquals(self.get_counts(Link), [(u'foo', 1)])
+        self.assertCountsMatch()
+
+        Tag.objects.update_tags(self.parrots[0], 'bar spam')
+        Tag.objects.add_tag(self.parrots[2], 'foo')
+        Tag.objects.add_tag(self.parrots[2], 'foo')
+        Tag.objects.update_tags_many({self.parrots[1]: 'spam',
+                                      self.parrots[3]: 'foo spam'})
+        self.assertEquals(self.get_counts(Parrot),
+            [(u'bar', 1), (u'foo', 2), (u'spam', 3)])
+        self.assertCountsMatch()
+
+        TaggedItem.objects.tag_queryset(Parrot.objects.all(), 'bar')
+        TaggedItem.objects.untag_queryset(Parrot.objects.all(), 'spam')
+        TaggedItem.objects.create(tag=get_tag('spam'), object=self.link)
+        TaggedItem.objects.get(tag=get_tag('foo'),
+            object_id=self.parrots[2].pk).delete()
+        self.assertEquals(self.get_counts(Parrot), [(u'bar', 4), (u'foo', 1)])
+        self.assertEquals(self.get_counts(Link), [(u'foo', 1), (u'spam', 1)])
+        self.assertCountsMatch()
+
+        cloud = Tag.objects.cloud_for_model(Parrot, steps=2)
+        self.assertEquals([(unicode(tag), tag.count, tag.font_size)
+            for tag in cloud], [(u'bar', 4, 2), (u'foo', 1, 1)])
+        usage = Tag.objects.usage_for_model(Parrot, min_count=2)
+        self.assertEquals([(unicode(tag), tag.count) for tag in usage],
+            [(u'bar', 4)])
+
+    def test_recount(self):
+        Tag.objects.update_tags(self.parrots[0], 'foo bar')
+        tag = get_tag('foo')
+        # Simulate a concurrent writer, which inserted the same tagged item.
+        from tagging import models
+        original_insert_rows = models._insert_rows
+        def insert_rows(table, columns, rows, ignore_conflicts=False):
+            models._insert_rows = original_insert_rows
+            TaggedItem.objects.create(tag=tag, object=self.parrots[1])
+            return original_insert_rows(table, columns, rows,
+                ignore_conflicts=ignore_conflicts)
+        models._insert_rows = insert_rows
+        try:
+            Tag.objects.update_tags(self.parrots[1], 'foo bar')
+        finally:
+            models._insert_rows = original_insert_rows
+        self.assertEquals(self.get_counts(Parrot), [(u'bar', 2), (u'foo', 2)])
+
+    def test_rebuild(self):
+        settings.TAG_USAGE_COUNTS = False
+        Tag.objects.update_tags(self.parrots[0], 'foo bar')
+        Tag.objects.update_tags(self.link, 'foo')
+        settings.TAG_USAGE_COUNTS = True
+        self.assertEquals(self.get_counts(Parrot), [])
+        from django.core import management
+        management.call_command('rebuild_tag_usage')
+        self.assertEquals(self.get_counts(Parrot), [(u'bar', 1), (u'foo', 1)])
+        self.assertCountsMatch()
+
 class TestTagUsageForModel(TestCase):
     def setUp(self):
         parrot_details = (
@@ -1913,7 +2803,44 @@ class TestTagsCalculateCloud(TestCase):
         self.failUnless((u'foo', 1, 1) in relevant_attribute_list)
         self.failUnless((u'baz', 1, 1) in relevant_attribute_list)
         self.failUnless((u'spam:egg=ham', 1, 1) in relevant_attribute_list)
-        
+
+    def test_tag_manager_calculate_cloud_method_in_database(self):
+        for kwargs in ({}, {'steps': 10}, {'steps': 10, 'distribution': LINEAR},
+                {'min_count': 2}, {'min_count': 4}, {'min_count': 5},
+                {'filters': dict(state__startswith='p')},
+                {'num': 3}, {'num': 3, 'steps': 10}):
+            expected = [(unicode(tag), tag.count, getattr(tag, 'font_size', None))
+                for tag in Tag.objects.cloud_for_model(Parrot, **kwargs)]
+            cloud_tags = Tag.objects.cloud_for_model(Parrot, in_database=True, **kwargs)
+            self.assertEquals([(unicode(tag), tag.count, getattr(tag, 'font_size', None))
+                for tag in cloud_tags], expected)
+
+    def test_tag_manager_calculate_cloud_method_with_num(self):
+        cloud_tags = Tag.objects.cloud_for_model(Parrot, num=3)
+        relevant_attribute_list = [(unicode(tag), tag.count, tag.font_size) for tag in cloud_tags]
+        self.assertEquals(relevant_attribute_list,
+            [(u'bar', 4, 4), (u'foo', 2, 1), (u'ter', 3, 3)])
+
+    def test_calculate_cloud_count_thresholds(self):
+        for distribution in (LINEAR, LOGARITHMIC):
+            for min_count, max_count, steps in ((1, 1, 4), (1, 4, 4), (2, 4, 4),
+                    (1, 100, 10), (7, 9999, 6), (1, 2, 8)):
+                max_counts = calculate_cloud_count_thresholds(min_count,
+                    max_count, steps, distribution)
+                tags = []
+                for count in range(min_count, max_count + 1):
+                    tag = Tag(name=str(count))
+                    tag.count = count
+                    tags.append(tag)
+                for tag in calculate_cloud(tags, steps, distribution):
+                    font_size = getattr(tag, 'font_size', None)
+                    expected = None
+                    for i, highest_count in enumerate(max_counts):
+                        if tag.count <= highest_count:
+                            expected = i + 1
+                            break
+                    self.assertEquals(font_size, expected)
+
 class TestGetTaggedObjectsByModel(TestCase):
     def setUp(self):
         parrot_details = (
@@ -2046,6 +2973,285 @@ class TestGetTaggedObjectsByModel(TestCase):
         parrots = TaggedItem.objects.get_union_by_model(Parrot, [])
         self.assertEquals(len(parrots), 0)
 
+class TestGetTaggedObjectsWithSubqueries(TestCase):
+    def test_many_objects(self):
+        # More objects than SQLite allows query parameters.
+        for i in range(1200):
+            Parrot.objects.create(state='parrot %04d' % i)
+        TaggedItem.objects.tag_queryset(Parrot.objects.all(), 'foo')
+        TaggedItem.objects.tag_queryset(
+            Parrot.objects.filter(state__lt='parrot 1000'), 'bar')
+        foo, bar = get_tag('foo'), get_tag('bar')
+
+        parrots = TaggedItem.objects.get_intersection_by_model(Parrot, [foo, bar])
+        self.failUnless('HAVING' in str(parrots.query))
+        self.assertEquals(parrots.count(), 1000)
+        self.assertEquals([parrot.state for parrot in parrots[998:1001]],
+            [u'parrot 0998', u'parrot 0999'])
+
+        parrots = TaggedItem.objects.get_union_by_model(
+            Parrot.objects.filter(state__gte='parrot 0900'), [foo, bar])
+        self.assertEquals(parrots.count(), 300)
+
+class TestTagQueryPlanner(TestCase):
+    def setUp(self):
+        self.original_tag_usage_counts = settings.TAG_USAGE_COUNTS
+        tag_statistics.clear()
+        self.rare_parrot = Parrot.objects.create(state='rare')
+        Tag.objects.update_tags(self.rare_parrot, 'rare common some')
+        for i in range(20):
+            parrot = Parrot.objects.create(state='common %d' % i)
+            Tag.objects.update_tags(parrot, 'common some')
+
+    def tearDown(self):
+        settings.TAG_USAGE_COUNTS = self.original_tag_usage_counts
+
+    def test_strategies(self):
+        plan = TaggedItem.objects.explain_by_model(Parrot, 'common rare')
+        self.assertEquals(plan.strategy, 'exists')
+        self.assertEquals(map(unicode, plan.tags), [u'rare', u'common'])
+        self.assertEquals(repr(plan), '<TagQueryPlan: exists rare(1) common(21)>')
+        self.assertEquals(list(TaggedItem.objects.get_by_model(Parrot, 'common rare')),
+            [self.rare_parrot])
+        self.assertEquals(list(TaggedItem.objects.get_by_model(
+            Parrot.objects.exclude(state='rare'), 'common rare')), [])
+
+        plan = TaggedItem.objects.explain_by_model(Parrot, 'common some')
+        self.assertEquals(plan.strategy, 'group_by')
+        self.assertEquals(plan.costs, {'exists': 84, 'group_by': 42})
+        self.assertEquals(len(TaggedItem.objects.get_by_model(Parrot, 'common some')), 21)
+
+        self.assertEquals(TaggedItem.objects.explain_by_model(Parrot, 'rare').strategy,
+            'single')
+        self.assertEquals(TaggedItem.objects.explain_by_model(Parrot, 'missing').strategy,
+            'empty')
+
+    def test_empty_tags(self):
+        Tag.objects.create(name='unused')
+        plan = TaggedItem.objects.explain_by_model(Parrot, 'common unused')
+        self.assertEquals(plan.strategy, 'exists')
+        settings.TAG_USAGE_COUNTS = True
+        TagUsage.objects.rebuild()
+        plan = TaggedItem.objects.explain_by_model(Parrot, 'common unused')
+        self.assertEquals(plan.strategy, 'empty')
+        self.assertEquals(list(TaggedItem.objects.get_by_model(Parrot, 'common unused')), [])
+
+    def test_planned_once(self):
+        from tagging import models, planner
+        original_plan_query = models.plan_query
+        original_bitmap_max_ids = planner.BITMAP_MAX_IDS
+        original_tag_bitmap_index = settings.TAG_BITMAP_INDEX
+        plans = []
+        def plan_query(*args, **kwargs):
+            plans.append(original_plan_query(*args, **kwargs))
+            return plans[-1]
+        models.plan_query = plan_query
+        # The bitmaps find too many objects, so SQL is used after all.
+        planner.BITMAP_MAX_IDS = 5
+        settings.TAG_BITMAP_INDEX = True
+        bitmap_index.clear()
+        try:
+            parrots = TaggedItem.objects.get_by_model(Parrot, 'common some')
+        finally:
+            models.plan_query = original_plan_query
+            planner.BITMAP_MAX_IDS = original_bitmap_max_ids
+            settings.TAG_BITMAP_INDEX = original_tag_bitmap_index
+            bitmap_index.clear()
+        self.assertEquals([plan.strategy for plan in plans], ['group_by'])
+        self.failUnless('HAVING' in str(parrots.query))
+        self.assertEquals(len(parrots), 21)
+
+class TestBitmap(TestCase):
+    def test_set_operations(self):
+        # Sparse and dense chunks, spread over several chunks of ids
+        a = set(range(0, 20000, 3) + range(70000, 70100) + [200000])
+        b = set(range(0, 20000, 2) + range(65536, 80000, 5))
+        bitmap_a, bitmap_b = Bitmap(a), Bitmap(b)
+        self.assertEquals(len(bitmap_a), len(a))
+        self.assertEquals(list(bitmap_a), sorted(a))
+        self.assertEquals(list(bitmap_a & bitmap_b), sorted(a & b))
+        self.assertEquals(list(bitmap_a | bitmap_b), sorted(a | b))
+        self.assertEquals(list(bitmap_a - bitmap_b), sorted(a - b))
+        self.assertEquals(list(bitmap_b - bitmap_a), sorted(b - a))
+        self.assertEquals(bitmap_a.ids(2, 3), [6, 9, 12])
+        self.failUnless(200000 in bitmap_a)
+        self.failIf(200001 in bitmap_a)
+        self.failIf(Bitmap())
+
+    def test_add_and_discard(self):
+        bitmap = Bitmap([5])
+        for value in range(0, 10000, 2):
+            bitmap.add(value)
+        self.assertEquals(len(bitmap), 5001)
+        for value in range(0, 10000, 2):
+            bitmap.discard(value)
+        self.assertEquals(list(bitmap), [5])
+        copy = bitmap.copy()
+        bitmap.discard(5)
+        self.assertEquals(list(copy), [5])
+        self.failIf(bitmap)
+
+class TestTagBitmapIndex(TestCase):
+    def setUp(self):
+        self.original_tag_bitmap_index = settings.TAG_BITMAP_INDEX
+        settings.TAG_BITMAP_INDEX = True
+        bitmap_index.clear()
+        self.parrots = []
+        for i in range(6):
+            parrot = Parrot.objects.create(state='parrot %d' % i)
+            self.parrots.append(parrot)
+        Tag.objects.update_tags(self.parrots[0], 'foo bar')
+        Tag.objects.update_tags(self.parrots[1], 'foo')
+        Tag.objects.update_tags(self.parrots[2], 'bar baz')
+        Tag.objects.update_tags(self.parrots[3], 'foo bar baz')
+
+    def tearDown(self):
+        settings.TAG_BITMAP_INDEX = self.original_tag_bitmap_index
+        bitmap_index.clear()
+
+    def ids(self, bitmap):
+        return [self.parrots.index(Parrot.objects.get(pk=pk)) for pk in bitmap]
+
+    def test_query(self):
+        self.assertEquals(self.ids(bitmap_index.query(Parrot, with_all='foo bar')), [0, 3])
+        self.assertEquals(self.ids(bitmap_index.query(Parrot, with_any='foo baz')), [0, 1, 2, 3])
+        self.assertEquals(self.ids(bitmap_index.query(Parrot, with_any='foo baz',
+            without='bar')), [1])
+        self.assertEquals(self.ids(bitmap_index.query(Parrot, with_all='bar',
+            with_any='foo baz', without='foo')), [2])
+        self.assertEquals(len(bitmap_index.query(Parrot, with_all='bar')), 3)
+        self.assertEquals(len(bitmap_index.query(Link, with_all='bar')), 0)
+        self.assertRaises(ValueError, bitmap_index.query, Parrot, without='bar')
+        settings.TAG_BITMAP_INDEX = False
+        self.assertEquals(bitmap_index.query(Parrot, with_all='bar'), None)
+
+    def test_lookups(self):
+        plan = TaggedItem.objects.explain_by_model(Parrot, 'foo bar')
+        self.assertEquals(plan.strategy, 'bitmap')
+        self.assertEquals(repr(plan), '<TagQueryPlan: bitmap bar(3) foo(3)>')
+        self.assertEquals(list(TaggedItem.objects.get_by_model(Parrot, 'foo bar')),
+            [self.parrots[0], self.parrots[3]])
+        self.assertEquals(list(TaggedItem.objects.get_by_model(
+            Parrot.objects.exclude(pk=self.parrots[0].pk), 'foo bar')),
+            [self.parrots[3]])
+        self.assertEquals(TaggedItem.objects.explain_by_model(Parrot, 'foo baz missing').strategy,
+            'bitmap')
+        Tag.objects.create(name='unused')
+        self.assertEquals(TaggedItem.objects.explain_by_model(Parrot, 'foo unused').strategy,
+            'empty')
+        self.assertEquals(list(TaggedItem.objects.get_intersection_by_model(Parrot, 'foo baz')),
+            [self.parrots[3]])
+        self.assertEquals(list(TaggedItem.objects.get_union_by_model(Parrot, 'foo baz')),
+            self.parrots[:4])
+        self.assertEquals(list(TaggedItem.objects.get_union_by_model(Parrot, 'unused')), [])
+
+    def test_updates(self):
+        bitmap_index.get_bitmaps(ContentType.objects.get_for_model(Parrot).pk)
+        Tag.objects.update_tags(self.parrots[1], 'bar')
+        Tag.objects.add_tag(self.parrots[4], 'foo')
+        Tag.objects.update_tags_many({self.parrots[5]: 'foo', self.parrots[0]: 'baz'})
+        self.assertEquals(self.ids(bitmap_index.query(Parrot, with_all='foo')), [3, 4, 5])
+        self.assertEquals(self.ids(bitmap_index.query(Parrot, with_all='bar')), [1, 2, 3])
+        self.assertEquals(self.ids(bitmap_index.query(Parrot, with_all='baz')), [0, 2, 3])
+        TaggedItem.objects.get(tag__name='baz', object_id=self.parrots[2].pk).delete()
+        TaggedItem.objects.create(tag=Tag.objects.get(name='baz'),
+            object=self.parrots[1])
+        self.assertEquals(self.ids(bitmap_index.query(Parrot, with_all='baz')), [0, 1, 3])
+        TaggedItem.objects.tag_queryset(Parrot.objects.all(), 'baz')
+        self.assertEquals(len(bitmap_index.query(Parrot, with_all='baz')), 6)
+        TaggedItem.objects.untag_queryset(Parrot.objects.all(), 'baz')
+        self.assertEquals(len(bitmap_index.query(Parrot, with_all='baz')), 0)
+
+    def test_large_results_use_sql(self):
+        parrot_ids = [self.parrots[0].pk] + [Parrot.objects.create(
+            state='common %d' % i).pk for i in range(BITMAP_MAX_IDS)]
+        TaggedItem.objects.tag_queryset(Parrot.objects.filter(pk__in=parrot_ids), 'common')
+        plan = TaggedItem.objects.explain_by_model(Parrot, 'common foo')
+        self.assertEquals(plan.strategy, 'bitmap')
+        plan = TaggedItem.objects.explain_by_model(Parrot, 'common')
+        self.assertEquals(plan.strategy, 'single')
+        self.assertEquals(plan.counts.values(), [BITMAP_MAX_IDS + 1])
+        self.assertEquals(TaggedItem.objects.get_by_model(Parrot, 'common').count(),
+            BITMAP_MAX_IDS + 1)
+        self.assertEquals(TaggedItem.objects.get_union_by_model(Parrot, 'common foo').count(),
+            BITMAP_MAX_IDS + 3)
+
+class TestTagSnapshot(TestCase):
+    def setUp(self):
+        self.original_tag_snapshot_path = settings.TAG_SNAPSHOT_PATH
+        self.original_tag_snapshot_max_age = settings.TAG_SNAPSHOT_MAX_AGE
+        self.original_numpy = snapshot.numpy
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        parrot_details = (
+            ('pining for the fjords', 'foo bar spam:egg=ham'),
+            ('passed on',             'bar baz ter'),
+            ('no more',               'foo ter spam:egg=ham'),
+            ('late',                  'bar ter spam:foo'),
+        )
+        self.parrots = []
+        for state, tags in parrot_details:
+            parrot = Parrot.objects.create(state=state)
+            Tag.objects.update_tags(parrot, tags)
+            self.parrots.append(parrot)
+        self.link = Link.objects.create(name='link')
+        Tag.objects.update_tags(self.link, 'bar ter')
+
+    def tearDown(self):
+        settings.TAG_SNAPSHOT_PATH = self.original_tag_snapshot_path
+        settings.TAG_SNAPSHOT_MAX_AGE = self.original_tag_snapshot_max_age
+        snapshot.numpy = self.original_numpy
+        snapshot._snapshot = None
+        os.remove(self.path)
+
+    def get_results(self):
+        return (
+            [(unicode(tag), tag.count) for tag in
+             Tag.objects.related_for_model('bar', Parrot, counts=True)],
+            [unicode(tag) for tag in
+             Tag.objects.related_for_model('bar ter', Parrot, min_count=2)],
+            set(TaggedItem.objects.get_related(self.parrots[1], Parrot)),
+            TaggedItem.objects.get_related(self.parrots[1], Link),
+            TaggedItem.objects.get_related(self.parrots[1], Parrot, num=1),
+            list(TaggedItem.objects.get_by_model(Parrot, 'bar ter')),
+            list(TaggedItem.objects.get_intersection_by_model(Parrot, 'foo spam:egg=ham')),
+        )
+
+    def test_results_match_sql(self):
+        expected = self.get_results()
+        self.assertEquals(expected[0], [(u'baz', 1), (u'spam:egg=ham', 1),
+            (u'foo', 1), (u'spam:foo', 1), (u'ter', 2)])
+        for numpy in (self.original_numpy, None):
+            snapshot.numpy = numpy
+            write_snapshot(self.path)
+            settings.TAG_SNAPSHOT_PATH = self.path
+            snapshot._snapshot = None
+            self.assertEquals(TaggedItem.objects.explain_by_model(Parrot, 'bar ter').strategy,
+                'snapshot')
+            self.assertEquals(self.get_results(), expected)
+            self.assertEquals(TaggedItem.objects.explain_by_model(Parrot, 'foo baz').strategy,
+                'empty')
+            settings.TAG_SNAPSHOT_PATH = None
+
+    def test_staleness(self):
+        call_command('export_tag_snapshot', self.path)
+        settings.TAG_SNAPSHOT_PATH = self.path
+        self.failIf(get_snapshot() is None)
+        Tag.objects.update_tags(self.parrots[0], 'bar')
+        # The snapshot doesn't see the change until it's exported again
+        self.assertEquals(TaggedItem.objects.get_related(self.parrots[1], Parrot, num=1),
+            [self.parrots[3]])
+        settings.TAG_SNAPSHOT_MAX_AGE = 0
+        self.assertEquals(get_snapshot(), None)
+        self.assertEquals(TaggedItem.objects.get_by_model(Parrot, 'bar').count(), 3)
+        settings.TAG_SNAPSHOT_MAX_AGE = 600
+        call_command('export_tag_snapshot')
+        self.assertEquals(get_snapshot().get_object_ids(
+            ContentType.objects.get_for_model(Parrot).pk,
+            Tag.objects.get(name='foo', namespace=None).pk), [self.parrots[2].pk])
+        settings.TAG_SNAPSHOT_PATH = self.path + '.missing'
+        self.assertEquals(get_snapshot(), None)
+
 class TestGetRelatedTaggedItems(TestCase):
     def setUp(self):
         self.l1 = Link.objects.create(name='link 1')
@@ -2318,6 +3524,27 @@ class TestTagFieldInForms(TestCase):
         else:
             raise self.failureException('a ValidationError exception was supposed to have been raised.')
 
+    def test_tag_d_validation_with_max_tags(self):
+        t = TagField(max_tags=2)
+        self.assertEquals(t.clean('foo bar foo'), u'foo bar foo')
+        try:
+            t.clean('foo bar baz')
+        except forms.ValidationError, ve:
+            self.assertEquals(unicode(list(ve.messages)), u"[u'Please enter no more than 2 tags.']")
+        else:
+            raise self.failureException('a ValidationError exception was supposed to have been raised.')
+
+    def test_tag_d_validation_with_max_length(self):
+        t = TagField(max_length=7)
+        self.assertEquals(t.clean('foo bar'), u'foo bar')
+        try:
+            t.clean('foo bar baz')
+        except forms.ValidationError, ve:
+            self.assertEquals(unicode(list(ve.messages)),
+                u"[u'Ensure this value has at most 7 characters (it has 11).']")
+        else:
+            raise self.failureException('a ValidationError exception was supposed to have been raised.')
+
     def test_tag_d_validation_with_non_string_input(self):
         t = TagField()
         self.assertEquals(t.clean(Tag(name='foo')), 'foo')
@@ -2568,3 +3795,126 @@ class TestFetchContentObjects(TestCase):
         tagged_objects = [tagged_item.object for tagged_item in tagged_items]
         prefetched_objects = [tagged_item.object for tagged_item in prefetched_items]
         self.assertEquals(set(tagged_objects), set(prefetched_objects))
+
+class TestPrefetchTags(TestCase):
+    def setUp(self):
+        self.parrot = Parrot.objects.create(state='dead')
+        Tag.objects.update_tags(self.parrot, 'foo bar spam:egg spam:ham')
+        self.link = Link.objects.create(name='link')
+        Tag.objects.update_tags(self.link, 'baz')
+        self.form_tests = [FormTest.objects.create(tags='foo %d' % i)
+                           for i in range(3)]
+        self.default_namespace_test = DefaultNamespaceTest2.objects.create(
+            tags='foo category:bar', categories='baz')
+
+    def test_prefetch_tags(self):
+        from django.db import connection
+        from django.conf import settings as django_settings
+        objects = list(FormTest.objects.all()) + [self.parrot, self.link,
+            DefaultNamespaceTest2.objects.get(pk=self.default_namespace_test.pk)]
+        original_debug = django_settings.DEBUG
+        django_settings.DEBUG = True
+        try:
+            connection.queries = []
+            self.assertEquals(prefetch_tags(objects), objects)
+            self.assertEquals(len(connection.queries), 4)
+            connection.queries = []
+            self.assertEquals([obj.tags for obj in objects[:3]],
+                [u'0 foo', u'1 foo', u'2 foo'])
+            self.assertEquals(map(unicode, objects[3].tags),
+                [u'bar', u'foo', u'spam:egg', u'spam:ham'])
+            self.assertEquals(map(unicode, objects[3].spam), [u'spam:egg', u'spam:ham'])
+            self.assertEquals(map(unicode, Tag.objects.get_for_object(objects[4])), [u'baz'])
+            self.assertEquals(objects[5].tags, u'foo')
+            self.assertEquals(objects[5].categories, u'baz')
+            self.assertEquals(len(connection.queries), 0)
+        finally:
+            django_settings.DEBUG = original_debug
+        # Changed tags are queried again
+        Tag.objects.update_tags(objects[3], 'foo')
+        self.assertEquals(map(unicode, objects[3].tags), [u'foo'])
+        Tag.objects.add_tag(objects[4], 'ter')
+        self.assertEquals(map(unicode, Tag.objects.get_for_object(objects[4])),
+            [u'baz', u'ter'])
+
+    def test_prefetched_tags_changed(self):
+        parrot = prefetch_tags([Parrot.objects.get(pk=self.parrot.pk)])[0]
+        self.assertEquals(map(unicode, parrot.spam), [u'spam:egg', u'spam:ham'])
+        TaggedItem.objects.tag_queryset(Parrot.objects.all(), 'spam:bacon')
+        self.assertEquals(map(unicode, parrot.spam),
+            [u'spam:bacon', u'spam:egg', u'spam:ham'])
+        from django.db.models.query import QuerySet
+        prefetch_tags([parrot])
+        self.failUnless(type(Tag.objects.get_for_object(parrot)) is list)
+        Tag.objects.update_tags(Parrot.objects.get(pk=parrot.pk), 'foo')
+        tags = Tag.objects.get_for_object(parrot)
+        self.failUnless(isinstance(tags, QuerySet))
+        self.assertEquals(map(unicode, tags), [u'foo'])
+        self.assertEquals(list(tags.filter(name='bar')), [])
+
+    def test_fields(self):
+        obj = prefetch_tags(DefaultNamespaceTest2.objects.all(),
+            fields=['categories'])[0]
+        self.failUnless('_categories_cache' in obj.__dict__)
+        self.failIf('_tags_cache' in obj.__dict__)
+        self.assertEquals(obj.tags, u'foo')
+        self.assertEquals(prefetch_tags([]), [])
+
+    def test_shared_instance_tags(self):
+        from django.db import connection
+        from django.conf import settings as django_settings
+        obj = DefaultNamespaceTest3.objects.create(foos='a b', categories='c')
+        obj = DefaultNamespaceTest3.objects.get(pk=obj.pk)
+        parrot = Parrot.objects.get(pk=self.parrot.pk)
+        original_debug = django_settings.DEBUG
+        django_settings.DEBUG = True
+        try:
+            connection.queries = []
+            self.assertEquals((obj.foos, obj.categories), (u'a b', u'c'))
+            self.assertEquals(len(connection.queries), 1)
+            connection.queries = []
+            self.assertEquals(map(unicode, parrot.tags),
+                [u'bar', u'foo', u'spam:egg', u'spam:ham'])
+            self.assertEquals(map(unicode, parrot.spam), [u'spam:egg', u'spam:ham'])
+            self.assertEquals(map(unicode, parrot.attrs), [])
+            self.assertEquals(len(connection.queries), 1)
+        finally:
+            django_settings.DEBUG = original_debug
+        # Writes through any field or descriptor discard the shared tags
+        parrot.attrs = 'attr:x'
+        self.assertEquals(map(unicode, parrot.tags),
+            [u'bar', u'foo', u'attr:x', u'spam:egg', u'spam:ham'])
+        obj.categories = 'd'
+        obj.save()
+        obj.__dict__.pop('_foos_cache')
+        self.assertEquals(obj.foos, u'a b')
+        self.failIf('_prefetched_tags_cache' in obj.__dict__)
+        # Tags of unsaved instances aren't kept
+        parrot = Parrot(state='alive')
+        self.assertEquals(list(parrot.tags), [])
+        parrot.save()
+        TaggedItem.objects.create(tag=Tag.objects.get(name='bar'), object=parrot)
+        self.assertEquals(map(unicode, parrot.tags), [u'bar'])
+
+    def test_shared_instance_tags_changed(self):
+        parrot = Parrot.objects.get(pk=self.parrot.pk)
+        self.assertEquals(map(unicode, parrot.tags),
+            [u'bar', u'foo', u'spam:egg', u'spam:ham'])
+        # get_for_object isn't served from the shared tags
+        TaggedItem.objects.create(tag=Tag.objects.get(name='baz', namespace=None), object=parrot)
+        self.assertEquals(map(unicode, Tag.objects.get_for_object(parrot)),
+            [u'bar', u'baz', u'foo', u'spam:egg', u'spam:ham'])
+        self.assertEquals(map(unicode, parrot.tags),
+            [u'bar', u'baz', u'foo', u'spam:egg', u'spam:ham'])
+        # Tags changed through other instances and querysets
+        Tag.objects.add_tag(Parrot.objects.get(pk=parrot.pk), 'spam:bacon')
+        self.assertEquals(map(unicode, parrot.spam),
+            [u'spam:bacon', u'spam:egg', u'spam:ham'])
+        TaggedItem.objects.tag_queryset(Parrot.objects.all(), 'attr:x')
+        self.assertEquals(map(unicode, parrot.attrs), [u'attr:x'])
+        TaggedItem.objects.untag_queryset(Parrot.objects.all(), 'attr:x')
+        self.assertEquals(map(unicode, parrot.attrs), [])
+        Tag.objects.update_tags_many([(Parrot.objects.get(pk=parrot.pk), 'foo')])
+        self.assertEquals(map(unicode, parrot.tags), [u'foo'])
+        Tag.objects.get(name='foo', namespace=None).delete()
+        self.assertEquals(map(unicode, parrot.tags), [])
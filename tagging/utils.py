@@ -5,25 +5,178 @@ calculation.
 import re
 import math
 import types
+from bisect import bisect_left
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
 
 from django.db.models import Q
 from django.db.models.query import QuerySet
 from django.utils.encoding import force_unicode
 from django.utils.translation import ugettext as _
 
-# Python 2.3 compatibility
+from tagging import settings
+
+# NumPy is optional, it speeds up the calculation of large tag clouds.
 try:
-    set
-except NameError:
-    from sets import Set as set
+    import numpy
+except ImportError:
+    numpy = None
+
+# A single scanner for tag input. The alternatives are tried in order at
+# each position: tag parts (including quoted strings and the ``:``/``=``
+# delimiters), whitespace, loose commas and finally any unclosed quote run.
+RE_TAG_TOKEN = re.compile(
+    r'(?P<part>[:=]|"[^"]*"|[^,\s:="]+)'
+    r'|(?P<space>\s+)'
+    r'|(?P<comma>\s*,\s*)'
+    r'|(?P<char>[:=]|[^,\s:=]+)'
+)
+
+# Finds the unquoted commas in tag input by skipping over quoted strings.
+RE_QUOTED_OR_COMMA = re.compile(r'"[^"]*"|,')
+RE_SPACE_DELIMITED_WORD = re.compile(r'[^ ]+')
+
+class LRUCache(object):
+    """
+    A thread safe, size bounded cache which discards the least recently used
+    entries first.
+
+    The ``hits``, ``misses`` and ``evictions`` attributes count the lookups
+    and discarded entries since the cache was created or last cleared.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        """
+        Removes all entries and resets the counters.
+        """
+        self._lock.acquire()
+        try:
+            # Entries are nodes ``[previous, next, key, value]`` of a
+            # circular doubly linked list, the most recently used entry is
+            # next to the root.
+            self._data = {}
+            self._root = root = []
+            root[:] = [root, root, None, None]
+            self.hits = self.misses = self.evictions = 0
+        finally:
+            self._lock.release()
+
+    def get(self, key, default=None):
+        """
+        Returns the value stored for ``key`` and marks it as most recently
+        used. Returns ``default`` if the key is not cached.
+        """
+        self._lock.acquire()
+        try:
+            node = self._data.get(key)
+            if node is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(node)
+            self._link(node)
+            return node[3]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        """
+        Stores ``value`` for ``key`` and discards the least recently used
+        entries which exceed ``max_size``.
+        """
+        self._lock.acquire()
+        try:
+            node = self._data.get(key)
+            if node is not None:
+                self._unlink(node)
+                node[3] = value
+            else:
+                node = [None, None, key, value]
+                self._data[key] = node
+            self._link(node)
+            while len(self._data) > max(self.max_size, 0):
+                oldest = self._root[0]
+                self._unlink(oldest)
+                del self._data[oldest[2]]
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        Returns a dictionary with the counters, the current and the maximum
+        size of the cache.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._data),
+            'max_size': self.max_size,
+        }
+
+    def _link(self, node):
+        root = self._root
+        node[0], node[1] = root, root[1]
+        root[1][0] = node
+        root[1] = node
 
-RE_TAG_PART_TOKEN = re.compile(r"^(%s)(.*)$" % r'[:=]|"[^"]*"|[^,\s:="]+')
-RE_SPACE_TOKEN = re.compile(r"^(%s)(.*)$" % r"\s+")
-RE_COMMA_TOKEN = re.compile(r"^(%s)(.*)$" % r"\s*,\s*")
-RE_CHAR_TOKEN = re.compile(r"^(%s)(.*)$" % r"[:=]|[^,\s:=]+")
+    def _unlink(self, node):
+        node[0][1] = node[1]
+        node[1][0] = node[0]
 
-RE_STRING_TOKEN = re.compile(r'^(%s)(.*)$' % r'"[^"]*"')
+# Shared by all memoized tag parsing functions, sized by the
+# ``TAG_PARSE_CACHE_SIZE`` setting.
+tag_parse_cache = LRUCache(0)
 
+def _freeze(value):
+    if isinstance(value, (types.ListType, types.TupleType, set)):
+        return tuple(value)
+    return value
+
+def _memoize(func):
+    """
+    Caches the results of the pure function ``func`` in ``tag_parse_cache``
+    if the ``TAG_PARSE_CACHE_SIZE`` setting is enabled. Lists and
+    dictionaries are copied, so callers may modify the returned values.
+    """
+    name = func.__name__
+    def wrapper(*args, **kwargs):
+        max_size = settings.TAG_PARSE_CACHE_SIZE
+        if not max_size:
+            return func(*args, **kwargs)
+        if tag_parse_cache.max_size != max_size:
+            tag_parse_cache.max_size = max_size
+        key = (name, tuple([_freeze(arg) for arg in args]),
+            tuple(sorted([(k, _freeze(v)) for k, v in kwargs.items()])))
+        try:
+            result = tag_parse_cache.get(key, wrapper)
+        except TypeError:
+            # unhashable input
+            return func(*args, **kwargs)
+        if result is wrapper:
+            result = func(*args, **kwargs)
+            tag_parse_cache.set(key, result)
+        if isinstance(result, types.ListType):
+            return list(result)
+        if isinstance(result, types.DictType):
+            return dict(result)
+        return result
+    wrapper.__name__ = name
+    wrapper.__doc__ = func.__doc__
+    wrapper.__module__ = func.__module__
+    return wrapper
+
+@_memoize
 def parse_tag_input(input, default_namespace=None, keep_quotes=None):
     """
     Parses tag input, with multiple word input being activated and
@@ -42,6 +195,28 @@ def parse_tag_input(input, default_namespace=None, keep_quotes=None):
     """
     if not input:
         return []
+    words = list(set(iter_tag_input(input,
+        default_namespace=default_namespace, keep_quotes=keep_quotes)))
+    words.sort()
+    return words
+
+def iter_tag_input(input, default_namespace=None, keep_quotes=None,
+    max_tags=None, max_chars=None):
+    """
+    Parses tag input like ``parse_tag_input`` but yields each unique tag
+    name as soon as its delimiter is found, in the order of the input.
+
+    If ``max_chars`` is given, input longer than ``max_chars`` characters is
+    rejected before it is parsed. If ``max_tags`` is given, the parsing
+    stops as soon as more than ``max_tags`` unique tags are found. In both
+    cases a ``ValueError`` is raised whose second and third arguments are
+    ``'input'`` or ``'tags'`` and the exceeded limit.
+    """
+    if not input:
+        return
+    input = force_unicode(input)
+    if max_chars is not None and len(input) > max_chars:
+        raise ValueError("Tag input is too long.", 'input', max_chars)
 
     if keep_quotes is None:
         keep_quotes = ()
@@ -50,61 +225,62 @@ def parse_tag_input(input, default_namespace=None, keep_quotes=None):
             default_namespace,
             keep_quotes=keep_quotes) or None
 
-    input = force_unicode(input)
+    seen = set()
+    for word in _iter_tag_words(input, default_namespace, keep_quotes):
+        if word in seen:
+            continue
+        if max_tags is not None and len(seen) >= max_tags:
+            raise ValueError("Too many tags.", 'tags', max_tags)
+        seen.add(word)
+        yield word
 
+def _iter_tag_words(input, default_namespace, keep_quotes):
+    """
+    Helper: yields the tag names of ``input``, including duplicates.
+    """
     # Special case - if there are no commas, colons or double quotes in the
     # input, we don't *do* a recall... I mean, we know we only need to
     # split on spaces.
     if u',' not in input and u'"' not in input and \
         ':' not in input and '=' not in input and \
         not [part for part in keep_quotes if part in input]:
-        words = list(set(split_strip(input, u' ')))
-        if default_namespace:
-            words = ['%s:%s' % (default_namespace, word) for word in words]
-        words.sort()
-        return words
-
-    token_list = []
-    token_definition = (
-        (RE_TAG_PART_TOKEN, 'part'),
-        (RE_SPACE_TOKEN, 'space'),
-        (RE_COMMA_TOKEN, 'comma'),
-        (RE_CHAR_TOKEN, 'char'),
-    )
-    saw_loose_comma = False
-    while input:
-        for token, name in token_definition:
-            m = token.match(input)
-            if m:
-                content, input = m.groups()
-                token_list.append((name, content))
-                if name == 'comma':
-                    saw_loose_comma = True
-                break
-
-    if saw_loose_comma:
-        delimiter = 'comma'
-    else:
-        delimiter = 'space'
-    words = set()
+        for m in RE_SPACE_DELIMITED_WORD.finditer(input):
+            word = m.group().strip()
+            if word:
+                if default_namespace:
+                    word = '%s:%s' % (default_namespace, word)
+                yield word
+        return
+
+    # The delimiter must be known before the first tag is complete, so look
+    # ahead for a comma outside of double quotes.
+    delimiter = 'space'
+    for m in RE_QUOTED_OR_COMMA.finditer(input):
+        if m.group() == u',':
+            delimiter = 'comma'
+            break
+
     word = []
-    for token, content in token_list:
+    match = RE_TAG_TOKEN.match
+    pos, end = 0, len(input)
+    while pos < end:
+        m = match(input, pos)
+        token = m.lastgroup
+        pos = m.end()
         if token == delimiter:
             word = build_tag(word, default_namespace=default_namespace,
                 keep_quotes=keep_quotes)
             if word:
-                words.add(word)
+                yield word
             word = []
         else:
-            word.append(content)
+            word.append(m.group(token))
     word = build_tag(word, default_namespace=default_namespace,
         keep_quotes=keep_quotes)
     if word:
-        words.add(word)
-    words = list(words)
-    words.sort()
-    return words
+        yield word
 
+@_memoize
 def build_tag(tokens, default_namespace=None, keep_quotes=None):
     """
     Gets a list of strings and chars and builds a tag with correctly quoted
@@ -205,6 +381,9 @@ def edit_string_for_tags(tags, default_namespace=None,
     will be not be displayed. If ``default_namespace`` is given, all namespaces
     that are ``None`` will be explicitly displayed (like ``:name``).
 
+    The string is returned as ``ParsedTags`` which already carry the tags,
+    so it does not need to be parsed again.
+
     Parts of tags which contain commas will be double quoted.
 
     If any tag name which isn't being quoted contains whitespace, the
@@ -217,60 +396,53 @@ def edit_string_for_tags(tags, default_namespace=None,
     if exclude_namespaces is None:
         exclude_namespaces = ()
     if isinstance(tags, types.StringTypes):
-        tags = [get_tag_parts(tag)
-                for tag in parse_tag_input(tags,
-                    default_namespace=default_namespace)]
-    quote_chars = ',:='
-    fields = {'namespace': '', 'name': '', 'value': ''}
+        tags = sorted(parse_tags(tags, default_namespace=default_namespace).tags,
+            key=unicode)
     names = []
+    kept_tags = []
     use_commas = False
     for tag in tags:
         if isinstance(tag, Tag):
-            tag = {
-                'namespace': tag.namespace,
-                'name': tag.name,
-                'value': tag.value,
-            }
-        skip_tag = False
-        for field in fields:
-            fields[field] = tag[field] or ''
-            if field == 'namespace':
-                if  filter_namespaces and \
-                    fields['namespace'] not in filter_namespaces or \
-                    exclude_namespaces and \
-                    fields['namespace'] in exclude_namespaces:
-                    skip_tag = True
-                    break
+            tag = tag.parts
+        elif not isinstance(tag, TagParts):
+            tag = TagParts(**tag)
+        namespace = tag.namespace or ''
+        if  filter_namespaces and namespace not in filter_namespaces or \
+            exclude_namespaces and namespace in exclude_namespaces:
+            continue
+        kept_tags.append(tag)
+        parts = []
+        for part in (namespace, tag.name or '', tag.value or ''):
             quoted = False
-            for char in quote_chars:
-                if char in fields[field]:
-                    fields[field] = '"%s"' % fields[field]
+            for char in ',:=':
+                if char in part:
+                    part = '"%s"' % part
                     quoted = True
                     break
             # Skip the comma test if namespace is default_namespace.
             # The comma won't get printed.
-            if not (field == 'namespace' and
+            if not (not parts and
                     default_namespace and
-                    fields['namespace'] == default_namespace) and \
-               not quoted and ' ' in fields[field]:
+                    part == default_namespace) and \
+               not quoted and ' ' in part:
                 use_commas = True
-        if skip_tag:
-            continue
-        name = fields['name']
-        if fields['namespace'] and fields['namespace'] != default_namespace:
-                name = '%s:%s' % (fields['namespace'], name)
-        elif not fields['namespace'] and default_namespace:
+            parts.append(part)
+        namespace, name, value = parts
+        if namespace and namespace != default_namespace:
+                name = '%s:%s' % (namespace, name)
+        elif not namespace and default_namespace:
                 name = '%s:%s' % ('', name)
         else:
             pass # no namespace is added
-        if fields['value']:
-            name = '%s=%s' % (name, fields['value'])
+        if value:
+            name = '%s=%s' % (name, value)
         names.append(name)
     if use_commas:
         glue = u', '
     else:
         glue = u' '
-    return glue.join(names)
+    return ParsedTags(glue.join(names), kept_tags,
+        default_namespace=default_namespace)
 
 def get_queryset_and_model(queryset_or_model):
     """
@@ -325,11 +497,15 @@ def get_tag_list(tags, wildcard=None, default_namespace=None):
     explicitly have an empty namespace (like ``:name``).
     """
     from tagging.models import Tag
+    from tagging.vocabulary import vocabulary
     if isinstance(tags, Tag):
         return [tags]
     elif isinstance(tags, QuerySet) and tags.model is Tag:
         return tags
     elif isinstance(tags, types.StringTypes):
+        if not wildcard and vocabulary.enabled:
+            return _get_cached_tag_list(parse_tag_input(tags,
+                default_namespace=default_namespace))
         q = get_tag_filter_lookup(tags,
             wildcard=wildcard, default_namespace=default_namespace)
         if q is None:
@@ -348,6 +524,12 @@ def get_tag_list(tags, wildcard=None, default_namespace=None):
                 contents.add('int')
         if len(contents) == 1:
             if 'string' in contents:
+                if not wildcard and vocabulary.enabled:
+                    tag_names = set()
+                    for tag in tags:
+                        tag_names.update(parse_tag_input(force_unicode(tag),
+                            default_namespace=default_namespace))
+                    return _get_cached_tag_list(tag_names)
                 q = get_tag_filter_lookup(
                     [force_unicode(tag) for tag in tags],
                     wildcard=wildcard, default_namespace=default_namespace)
@@ -363,6 +545,28 @@ def get_tag_list(tags, wildcard=None, default_namespace=None):
     else:
         raise ValueError(_('The tag input given was invalid.'))
 
+def _get_cached_tag_list(tag_names):
+    """
+    Returns a list of the ``Tag`` objects matching the given parsed tag
+    strings, looked up in the tag vocabulary cache. Only the tags which
+    are not found in the cache are queried from the database.
+    """
+    from tagging.models import Tag
+    from tagging.vocabulary import vocabulary
+    tag_parts = set([get_tag_parts(tag_name) for tag_name in tag_names])
+    found = vocabulary.get_tags(tag_parts)
+    tags = found.values()
+    lookups = [dict(parts.items()) for parts in tag_parts
+        if parts not in found]
+    for i in range(0, len(lookups), MAX_TAGS_PER_QUERY):
+        q = _group_tag_lookups(lookups[i:i + MAX_TAGS_PER_QUERY])
+        tags.extend(Tag.objects.filter(q))
+    # Same order as the ``Tag`` model's default ordering, with empty
+    # namespaces and values first.
+    tags.sort(key=lambda tag: (tag.namespace is not None, tag.namespace,
+        tag.name, tag.value is not None, tag.value))
+    return tags
+
 def get_tag_filter_lookup(tags, wildcard=None, default_namespace=None):
     """
     Takes a user entered string or an iteratable of strings and returns a
@@ -409,27 +613,68 @@ def get_tag_filter_lookup(tags, wildcard=None, default_namespace=None):
                 keep_quotes=keep_quotes,
                 default_namespace=default_namespace))
         tags = tag_parsed
-    tags = [get_tag_parts(tag, keep_quotes=keep_quotes) for tag in tags]
-    tag_names, tag_parts = [], []
+    tags = set([get_tag_parts(tag, keep_quotes=keep_quotes) for tag in tags])
+    lookups = []
     for tag in tags:
-        if tag['namespace'] is None and tag['value'] is None:
-            tag_names.append(tag['name'])
+        if tag.namespace is None and tag.value is None:
+            lookups.append({'namespace': None, 'name': tag.name, 'value': None})
         else:
-            if wildcard:
-                for key, value in tag.items():
+            lookup = {}
+            for key, value in tag.items():
+                if wildcard:
                     if value == '"%s"' % wildcard:
-                        tag[key] = tag[key][1:-1]
+                        value = value[1:-1]
                     elif value == wildcard:
-                        del tag[key]
-            tag_parts.append(tag)
+                        continue
+                lookup[key] = value
+            lookups.append(lookup)
+    return _group_tag_lookups(lookups)
+
+def _group_tag_lookups(lookups):
+    """
+    Helper: combines the tag field lookups into a ``Q`` object, or returns
+    ``None`` if there are no lookups.
+
+    Lookups which only differ in one field are merged into a single ``IN``
+    lookup, so the query stays small and can use the index on the
+    namespace, name and value of tags. The field which results in the
+    fewest groups is chosen. ``NULL`` values can't be matched by ``IN``,
+    so they are never merged.
+    """
+    if not lookups:
+        return None
+    best_groups = None
+    for field in ('name', 'namespace', 'value'):
+        groups = {}
+        for lookup in lookups:
+            value = lookup.get(field)
+            if value is None:
+                key = (None, tuple(sorted(lookup.items())))
+                groups[key] = None
+            else:
+                key = (field, tuple(sorted([item for item in lookup.items()
+                    if item[0] != field])))
+                groups.setdefault(key, set()).add(value)
+        if best_groups is None or len(groups) < len(best_groups):
+            best_groups = groups
     q = None
-    if len(tag_names):
-        q = Q(name__in=tag_names, namespace=None, value=None)
-    for tag in tag_parts:
+    keys = best_groups.keys()
+    keys.sort()
+    for key in keys:
+        field, items = key
+        kwargs = dict([(str(name), value) for name, value in items])
+        values = best_groups[key]
+        if values is not None:
+            values = list(values)
+            values.sort()
+            if len(values) == 1:
+                kwargs[field] = values[0]
+            else:
+                kwargs['%s__in' % field] = values
         if q is None:
-            q = Q(**tag)
+            q = Q(**kwargs)
         else:
-            q = q | Q(**tag)
+            q = q | Q(**kwargs)
     return q
 
 def get_tag(tag, default_namespace=None):
@@ -447,13 +692,19 @@ def get_tag(tag, default_namespace=None):
     explicitly have an empty namespace (like ``:name``).
     """
     from tagging.models import Tag
+    from tagging.vocabulary import vocabulary
     if isinstance(tag, Tag):
         return tag
 
     try:
         if isinstance(tag, types.StringTypes):
-            return Tag.objects.get(**get_tag_parts(tag,
-                default_namespace=default_namespace))
+            tag_parts = get_tag_parts(tag,
+                default_namespace=default_namespace)
+            if vocabulary.enabled:
+                cached = vocabulary.get_tags([tag_parts])
+                if tag_parts in cached:
+                    return cached[tag_parts]
+            return Tag.objects.get(**tag_parts)
         elif isinstance(tag, (types.IntType, types.LongType)):
             return Tag.objects.get(id=tag)
     except Tag.DoesNotExist:
@@ -461,12 +712,185 @@ def get_tag(tag, default_namespace=None):
 
     return None
 
+# The maximum number of tags that are looked up by a single query. Each
+# tag needs up to three query parameters, which keeps the queries below
+# the parameter limits of all database backends (SQLite allows 999).
+MAX_TAGS_PER_QUERY = 300
+
+def get_tags_in_bulk(tags, default_namespace=None):
+    """
+    Utility function for looking up many single tags at once, like
+    ``get_tag`` does for a single one.
+
+    ``tags`` is an iteratable of tag strings, ``TagParts``, tag ids or
+    ``Tag`` objects.
+    Returns a dictionary which maps each of them to the matching ``Tag``,
+    or to ``None`` if no matching tag can be found. The lookups are done
+    with as few queries as possible.
+
+    The ``default_namespace`` is used for tag strings that have no
+    namespace specified. The default namespace is not applied to tags which
+    explicitly have an empty namespace (like ``:name``).
+    """
+    from tagging.models import Tag
+    from tagging.vocabulary import vocabulary
+    result = {}
+    tag_ids = set()
+    tag_parts = {}
+    for tag in tags:
+        if tag in result:
+            continue
+        result[tag] = None
+        if isinstance(tag, Tag):
+            result[tag] = tag
+        elif isinstance(tag, TagParts):
+            tag_parts[tag] = tag
+        elif isinstance(tag, types.StringTypes):
+            match = RE_TAG_PARTS.match(tag)
+            if match is not None:
+                tag_parts[tag] = get_tag_parts(tag,
+                    default_namespace=default_namespace)
+        elif isinstance(tag, (types.IntType, types.LongType)):
+            tag_ids.add(tag)
+
+    tags_by_id = {}
+    tag_ids = list(tag_ids)
+    for i in range(0, len(tag_ids), MAX_TAGS_PER_QUERY):
+        for tag in Tag.objects.filter(
+                id__in=tag_ids[i:i + MAX_TAGS_PER_QUERY]):
+            tags_by_id[tag.pk] = tag
+
+    tags_by_parts = {}
+    if vocabulary.enabled:
+        tags_by_parts.update(vocabulary.get_tags(set(tag_parts.values())))
+    tags_by_parts.update(_get_tags_by_parts([parts
+        for parts in set(tag_parts.values()) if parts not in tags_by_parts]))
+
+    for tag in result:
+        if tag in tag_parts:
+            result[tag] = tags_by_parts.get(tag_parts[tag])
+        elif tag in tags_by_id:
+            result[tag] = tags_by_id[tag]
+    return result
+
+def _get_tags_by_parts(tag_parts):
+    """
+    Helper: returns a dictionary mapping the given ``TagParts`` to their
+    ``Tag`` objects, which are always queried from the database. Tags
+    which don't exist are left out.
+    """
+    from tagging.models import Tag
+    lookups = [dict(parts.items()) for parts in tag_parts]
+    tags = {}
+    for i in range(0, len(lookups), MAX_TAGS_PER_QUERY):
+        q = _group_tag_lookups(lookups[i:i + MAX_TAGS_PER_QUERY])
+        for tag in Tag.objects.filter(q):
+            tags[tag.parts] = tag
+    return tags
+
+class TagParts(object):
+    """
+    The namespace, name and value of a single tag.
+
+    Instances are immutable and hashable, so they can be used to compare
+    and deduplicate tags without building strings. ``unicode()`` returns the
+    canonical string representation of the tag, which is computed once.
+
+    For backwards compatibility the parts can also be read like the keys of
+    a dictionary, e.g. ``Tag.objects.get(**parts)`` or ``parts['name']``.
+    """
+    __slots__ = ('namespace', 'name', 'value', '_hash', '_string')
+
+    def __init__(self, namespace=None, name=None, value=None):
+        init = object.__setattr__
+        init(self, 'namespace', namespace or None)
+        init(self, 'name', name)
+        init(self, 'value', value or None)
+        init(self, '_hash', hash((self.namespace, name, self.value)))
+        init(self, '_string', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(_('TagParts instances are immutable.'))
+
+    def __delattr__(self, name):
+        raise AttributeError(_('TagParts instances are immutable.'))
+
+    def __reduce__(self):
+        return (TagParts, (self.namespace, self.name, self.value))
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if isinstance(other, TagParts):
+            return self._hash == other._hash and \
+                self.name == other.name and \
+                self.namespace == other.namespace and \
+                self.value == other.value
+        elif isinstance(other, types.DictType):
+            return dict(self.items()) == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __unicode__(self):
+        if self._string is None:
+            name = normalize_tag_part(self.name or '')
+            if self.namespace:
+                name = u'%s:%s' % (normalize_tag_part(self.namespace), name)
+            if self.value:
+                name = u'%s=%s' % (name, normalize_tag_part(self.value))
+            object.__setattr__(self, '_string', force_unicode(name))
+        return self._string
+
+    def __str__(self):
+        return self.__unicode__().encode('utf-8')
+
+    def __repr__(self):
+        return '<TagParts: %s>' % self
+
+    def lower(self):
+        """
+        Returns the tag parts in lowercase.
+        """
+        return TagParts(self.namespace and self.namespace.lower(),
+            self.name and self.name.lower(), self.value and self.value.lower())
+
+    def keys(self):
+        return ['namespace', 'name', 'value']
+
+    def items(self):
+        return [('namespace', self.namespace), ('name', self.name),
+            ('value', self.value)]
+
+    def __getitem__(self, key):
+        if key in ('namespace', 'name', 'value'):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
 RE_TAG_PARTS = re.compile(
     r'^(?P<namespace>(?:"[^"]+"|[^:="]+)?:)?'
     r'(?P<name>"[^"]+"|[^="]+)'
     r'(?P<value>=(?:"[^"]+"|[^"]+)?)?$'
 )
 
+def _unquote_tag_part(value, keep_quotes):
+    if value and value[0] == value[-1] == '"':
+        if value[1:-1] not in keep_quotes:
+            value = value[1:-1]
+    return value
+
+@_memoize
 def get_tag_parts(tag, default_namespace=None, keep_quotes=None):
     """
     Utility function for accepting single tag string representation that are
@@ -476,26 +900,67 @@ def get_tag_parts(tag, default_namespace=None, keep_quotes=None):
 
     If no namespace is found, the ``default_namespace`` will be applied.
 
-    It returns a dictionary with the keys ``namespace``, ``name`` and
-    ``value``. The values have no quotes.
+    It returns a ``TagParts`` instance with the attributes ``namespace``,
+    ``name`` and ``value``. The values have no quotes.
     """
     if keep_quotes is None:
         keep_quotes = ()
-    default_namespace = default_namespace or None
-    parts = RE_TAG_PARTS.match(tag).groupdict()
-    for key, value in parts.items():
-        if key == 'namespace':
-            if value:
-                value = value[:-1] or None
-            elif value is None:
-                value = default_namespace
-        if key =='value' and value:
-            value = value[1:] or None
-        if value and value[0] == value[-1] == '"':
-            if value[1:-1] not in keep_quotes:
-                value = value[1:-1]
-        parts[key] = value
-    return parts
+    namespace, name, value = RE_TAG_PARTS.match(tag).group(
+        'namespace', 'name', 'value')
+    if namespace:
+        namespace = namespace[:-1] or None
+    elif namespace is None:
+        namespace = default_namespace or None
+    if value:
+        value = value[1:] or None
+    return TagParts(
+        _unquote_tag_part(namespace, keep_quotes),
+        _unquote_tag_part(name, keep_quotes),
+        _unquote_tag_part(value, keep_quotes))
+
+class ParsedTags(unicode):
+    """
+    Tag input which has already been parsed.
+
+    It is the tag input string itself, but carries the parsed tags as a
+    tuple of ``TagParts`` in its ``tags`` attribute and the
+    ``default_namespace`` that was used for parsing. ``parse_tags``,
+    ``edit_string_for_tags``, ``TagManager.update_tags`` and the tag fields
+    use the ``tags`` instead of parsing the string again, as long as the
+    same default namespace applies.
+    """
+    def __new__(cls, input, tags, default_namespace=None):
+        self = unicode.__new__(cls, input)
+        self.tags = tuple(tags)
+        self.default_namespace = default_namespace or None
+        return self
+
+    def __reduce__(self):
+        return (ParsedTags,
+            (unicode(self), self.tags, self.default_namespace))
+
+    def lower(self):
+        tags, seen = [], set()
+        for tag in self.tags:
+            tag = tag.lower()
+            if tag not in seen:
+                seen.add(tag)
+                tags.append(tag)
+        return ParsedTags(unicode.lower(self), tags, self.default_namespace)
+
+def parse_tags(input, default_namespace=None):
+    """
+    Parses tag input like ``parse_tag_input`` and returns it as
+    ``ParsedTags``. Input which already is ``ParsedTags`` for the same
+    ``default_namespace`` is returned as-is.
+    """
+    if isinstance(input, ParsedTags) and \
+            input.default_namespace == (default_namespace or None):
+        return input
+    tags = [get_tag_parts(tag) for tag in parse_tag_input(input,
+        default_namespace=default_namespace)]
+    return ParsedTags(force_unicode(input or u''), tags,
+        default_namespace=default_namespace)
 
 # Font size distribution algorithms
 LOGARITHMIC, LINEAR = 1, 2
@@ -535,15 +1000,78 @@ def calculate_cloud(tags, steps=4, distribution=LOGARITHMIC):
         min_weight = float(min(counts))
         max_weight = float(max(counts))
         thresholds = _calculate_thresholds(min_weight, max_weight, steps)
-        for tag in tags:
-            font_set = False
-            tag_weight = _calculate_tag_weight(tag.count, max_weight, distribution)
-            for i in range(steps):
-                if not font_set and tag_weight <= thresholds[i]:
-                    tag.font_size = i + 1
-                    font_set = True
+        if numpy is not None:
+            font_sizes = _calculate_font_sizes_numpy(counts, thresholds,
+                max_weight, distribution)
+        else:
+            font_sizes = _calculate_font_sizes(counts, thresholds,
+                max_weight, distribution)
+        for tag, font_size in zip(tags, font_sizes):
+            # A weight above the last threshold leaves the tag without a
+            # font size.
+            if font_size <= steps:
+                tag.font_size = font_size
     return tags
 
+def calculate_cloud_count_thresholds(min_count, max_count, steps=4,
+    distribution=LOGARITHMIC):
+    """
+    Returns a list with the highest count a tag may have to get each font
+    size from 1 to ``steps``, as assigned by ``calculate_cloud`` to tags
+    whose counts range from ``min_count`` to ``max_count``.
+
+    This allows to calculate a tag cloud's font sizes with simple count
+    comparisons, e.g. inside the database.
+    """
+    max_weight = float(max_count)
+    thresholds = _calculate_thresholds(float(min_count), max_weight, steps)
+    max_counts = []
+    # The weights grow with the counts, so search the highest count whose
+    # weight doesn't exceed each threshold.
+    low = int(min_count) - 1
+    for threshold in thresholds:
+        high = int(max_count)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if _calculate_tag_weight(middle, max_weight, distribution) <= threshold:
+                low = middle
+            else:
+                high = middle - 1
+        max_counts.append(low)
+    return max_counts
+
+def _calculate_font_sizes(counts, thresholds, max_weight, distribution):
+    """
+    Helper: returns the font size for each of the ``counts``. The weight of
+    every distinct count is calculated once and looked up in the sorted
+    ``thresholds`` with a binary search.
+    """
+    font_sizes = {}
+    result = []
+    for count in counts:
+        font_size = font_sizes.get(count)
+        if font_size is None:
+            weight = _calculate_tag_weight(count, max_weight, distribution)
+            font_size = font_sizes[count] = bisect_left(thresholds, weight) + 1
+        result.append(font_size)
+    return result
+
+def _calculate_font_sizes_numpy(counts, thresholds, max_weight, distribution):
+    """
+    Helper: like ``_calculate_font_sizes``, but groups the counts and looks
+    up the thresholds as NumPy arrays.
+
+    The weights of the distinct counts are still calculated with ``math``,
+    so the results are exactly the same.
+    """
+    distinct_counts, indices = numpy.unique(numpy.asarray(counts),
+        return_inverse=True)
+    weights = numpy.array([
+        _calculate_tag_weight(count, max_weight, distribution)
+        for count in distinct_counts.tolist()], dtype=float)
+    font_sizes = numpy.searchsorted(thresholds, weights, side='left') + 1
+    return font_sizes[indices].tolist()
+
 def check_tag_length(tag_parts):
     """
     Checks the length of the tag parts according to the settings. The lengths
@@ -551,10 +1079,11 @@ def check_tag_length(tag_parts):
     The delimiters for namespace and value (':' and '=') are not counted. They
     are not part of the tag.
     """
-    from tagging import settings
-    namespace_len = len(tag_parts['namespace'] or '')
-    name_len = len(tag_parts['name'] or '')
-    value_len = len(tag_parts['value'] or '')
+    if not isinstance(tag_parts, TagParts):
+        tag_parts = TagParts(**tag_parts)
+    namespace_len = len(tag_parts.namespace or '')
+    name_len = len(tag_parts.name or '')
+    value_len = len(tag_parts.value or '')
     tag_len = name_len + namespace_len + value_len
     if tag_len > settings.MAX_TAG_LENGTH:
         raise ValueError("Tag is too long.", 'tag', settings.MAX_TAG_LENGTH)
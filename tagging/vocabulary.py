@@ -0,0 +1,130 @@
+"""
+An in-process cache of the tag vocabulary.
+"""
+import time
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+
+from tagging import settings
+from tagging.utils import get_tag_parts, TagParts
+
+class TagVocabulary(object):
+    """
+    Maps ``TagParts`` and tag strings to the ids of all tags, which are
+    loaded from the database at once.
+
+    The mapping is only changed under a lock, by single item assignments
+    which threads can read concurrently, or replaced as a whole. It's only
+    used to look tags up: tagging objects always resolves their tags from
+    the database, so ids of tags which were rolled back or deleted by other
+    processes never end up in tagged items.
+
+    Tags saved or deleted in this process update the mapping through
+    signals. Changes made by other processes are picked up when the
+    mapping is reloaded after ``TAG_VOCABULARY_CACHE_TIMEOUT`` seconds.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tag_ids = None
+        self._loaded_at = None
+
+    def _get_enabled(self):
+        return bool(settings.TAG_VOCABULARY_CACHE)
+    enabled = property(_get_enabled)
+
+    def snapshot(self):
+        """
+        Returns the current mapping of ``TagParts`` to tag ids, which is
+        loaded if it's missing or expired.
+        """
+        tag_ids, loaded_at = self._tag_ids, self._loaded_at
+        timeout = settings.TAG_VOCABULARY_CACHE_TIMEOUT
+        if tag_ids is None or \
+                timeout is not None and time.time() - loaded_at > timeout:
+            tag_ids = self.reload()
+        return tag_ids
+
+    def reload(self):
+        """
+        Loads all tags from the database and returns the new mapping.
+        """
+        from tagging.models import Tag
+        loaded_at = time.time()
+        tag_ids = {}
+        for tag_id, namespace, name, value in Tag.objects.values_list(
+                'id', 'namespace', 'name', 'value').order_by().iterator():
+            tag_ids[TagParts(namespace, name, value)] = tag_id
+        self._lock.acquire()
+        try:
+            self._tag_ids, self._loaded_at = tag_ids, loaded_at
+        finally:
+            self._lock.release()
+        return tag_ids
+
+    def clear(self):
+        """
+        Discards the mapping, it will be loaded again on the next lookup.
+        """
+        self._lock.acquire()
+        try:
+            self._tag_ids = self._loaded_at = None
+        finally:
+            self._lock.release()
+
+    def get_id(self, tag):
+        """
+        Returns the id of the tag given as ``TagParts`` or tag string, or
+        ``None`` if the tag is unknown.
+        """
+        if not isinstance(tag, TagParts):
+            tag = get_tag_parts(tag)
+        return self.snapshot().get(tag)
+
+    def get_tags(self, tags):
+        """
+        Returns a dictionary mapping those of the given ``TagParts`` which
+        are known to ``Tag`` objects, without querying the database.
+        """
+        from tagging.models import Tag
+        tag_ids = self.snapshot()
+        result = {}
+        for parts in tags:
+            tag_id = tag_ids.get(parts)
+            if tag_id is not None:
+                result[parts] = Tag(id=tag_id, namespace=parts.namespace,
+                    name=parts.name, value=parts.value)
+        return result
+
+    def add_tags(self, tags):
+        """
+        Adds newly created ``Tag`` objects to the mapping.
+        """
+        self._lock.acquire()
+        try:
+            tag_ids = self._tag_ids
+            if tag_ids is not None:
+                for tag in tags:
+                    tag_ids[tag.parts] = tag.pk
+        finally:
+            self._lock.release()
+
+    def tag_saved(self, sender, instance, created=False, **kwargs):
+        """
+        Signal handler: adds new tags to the mapping and discards it if an
+        existing tag has been changed.
+        """
+        if created:
+            self.add_tags([instance])
+        else:
+            self.clear()
+
+    def tag_deleted(self, sender, instance, **kwargs):
+        """
+        Signal handler: discards the mapping if a tag has been deleted.
+        """
+        self.clear()
+
+# The vocabulary cache shared by the whole process.
+vocabulary = TagVocabulary()